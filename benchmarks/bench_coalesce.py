@@ -0,0 +1,81 @@
+"""
+Compare the throughput of reservations made by many client threads sharing one PowergloveDns
+when each request is committed on its own (an AllocationCoalescer with a batch size of one)
+against group committing the requests that arrive together:
+
+    python benchmarks/bench_coalesce.py [THREAD_COUNT] [REQUESTS_PER_THREAD] [DIRECTORY]
+
+Each variant starts from a fresh SQLite database in DIRECTORY (by default the temporary
+directory), which should be on the disk being deployed to, as syncing commits to it is a large
+part of the per-request cost.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from powerglove_dns.coalescer import AllocationCoalescer
+from powerglove_dns.model import Base, Domain
+from powerglove_dns.powerglove import PowergloveDns, RetryPolicy, SqliteSettings
+
+
+def setup_database(path):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Domain.__table__.insert(), [dict(id=1, name='bench.tld', type='MASTER'),
+                                                       dict(id=2, name='10.in-addr.arpa', type='MASTER')])
+    engine.dispose()
+
+
+variants = [('per-request commits', 0, 1),
+            ('coalesced', 0.002, None)]
+
+
+def run_clients(add_a_record, thread_count, request_count):
+
+    def client(number):
+        for request in xrange(request_count):
+            add_a_record('host%d-%d.bench.tld' % (number, request), ('10.0.0.0/16',))
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in xrange(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    thread_count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    request_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    directory = tempfile.mkdtemp(dir=sys.argv[3] if len(sys.argv) > 3 else None)
+    total = thread_count * request_count
+    try:
+        for number, (name, window, batch_size) in enumerate(variants):
+            path = os.path.join(directory, '%d.sqlite' % number)
+            setup_database(path)
+            pdns = PowergloveDns('sqlite:///%s' % path, sqlite_settings=SqliteSettings(),
+                                 retry_policy=RetryPolicy())
+            # so that allocation doesn't dominate, see PowergloveDns.rebuild_ip_index
+            pdns.rebuild_ip_index()
+
+            with AllocationCoalescer(pdns, window=window, batch_size=batch_size or thread_count) as coalescer:
+                start = time.time()
+                run_clients(coalescer.add_a_record, thread_count, request_count)
+                elapsed = time.time() - start
+
+            name += ' (%.1f per batch)' % (float(coalescer.request_count) / coalescer.batch_count)
+            print '%-36s %d requests from %d threads in %.2fs (%.0f per second)' % (
+                name, total, thread_count, elapsed, total / elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the per-call time of the hot lookups built as a new ORM query on every call (as they
+were) against the baked queries PowergloveDns now uses, whose SQL is compiled once:
+
+    python benchmarks/bench_lookups.py [CALL_COUNT]
+
+Most of either is spent in SQLAlchemy rather than in SQLite, which answers each lookup from an
+index on a small zone.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from powerglove_dns.model import Base, Domain, Record
+from powerglove_dns.powerglove import PowergloveDns
+
+host_count = 1000
+
+
+def setup_database(path):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Domain.__table__.insert(), [dict(id=1, name='bench.tld', type='MASTER'),
+                                                       dict(id=2, name='10.in-addr.arpa', type='MASTER')])
+        rows = []
+        for number in xrange(host_count):
+            name = 'host%d.bench.tld' % number
+            rows.append(dict(domain_id=1, name=name, type='A', content='10.0.%d.%d' % divmod(number, 256)))
+            rows.append(dict(domain_id=2, name='%d.%d.0.10.in-addr.arpa' % tuple(reversed(divmod(number, 256))),
+                             type='PTR', content=name))
+        connection.execute(Record.__table__.insert(), rows)
+    engine.dispose()
+
+
+def lookups(pdns):
+    """
+    @return: C{list} of (name, uncached lookup, baked lookup) of a host number
+    """
+
+    session = pdns.session
+
+    def name(number):
+        return 'host%d.bench.tld' % number
+
+    return [('A record by name',
+             lambda number: session.query(Record).filter_by(type='A', name=name(number)).one(),
+             lambda number: pdns.get_record(name=name(number))),
+            ('PTR records by content',
+             lambda number: session.query(Record).filter_by(type='PTR', content=name(number)).all(),
+             lambda number: pdns.get_records('PTR', content=name(number))),
+            ('fqdn_is_present',
+             lambda number: session.query(Record.id).filter(Record.name == name(number),
+                                                            Record.type.in_(('A', 'CNAME'))).first(),
+             lambda number: pdns.fqdn_is_present(name(number), session))]
+
+
+def time_calls(lookup, call_count):
+    start = time.time()
+    for number in xrange(call_count):
+        lookup(number % host_count)
+    return time.time() - start
+
+
+def main():
+    call_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = tempfile.mktemp(suffix='.sqlite')
+    try:
+        setup_database(path)
+        pdns = PowergloveDns('sqlite:///%s' % path)
+        for name, uncached, baked in lookups(pdns):
+            uncached_time = time_calls(uncached, call_count)
+            baked_time = time_calls(baked, call_count)
+            print '%-24s %d calls: %.1fus each uncached, %.1fus each baked' % (
+                name, call_count, uncached_time * 1e6 / call_count, baked_time * 1e6 / call_count)
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
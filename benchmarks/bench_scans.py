@@ -0,0 +1,73 @@
+"""
+Compare the CPU time and peak memory of scanning every A record's address through full ORM
+objects (get_existing_records) against the Core row path (scan_records).
+
+Each variant runs in its own process, so that its peak RSS is its own:
+
+    python benchmarks/bench_scans.py [RECORD_COUNT]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from powerglove_dns.model import Base, Domain, Record
+from powerglove_dns.powerglove import PowergloveDns
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def setup_database(path, record_count):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Domain.__table__.insert(), [dict(id=1, name='bench.tld', type='MASTER')])
+        rows = [dict(domain_id=1, name='host%d.bench.tld' % number, type='A',
+                     content='10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255),
+                     ttl=300, prio=0, change_date=0)
+                for number in xrange(record_count)]
+        connection.execute(Record.__table__.insert(), rows)
+
+
+def orm_scan(pdns):
+    return [record.content for record in pdns.get_existing_records()]
+
+
+def core_scan(pdns):
+    return [content for content, in pdns.scan_records(('content',))]
+
+
+def run_variant(variant, path):
+    pdns = PowergloveDns('sqlite:///%s' % path)
+    scan = globals()[variant]
+    start = cpu_time()
+    count = len(scan(pdns))
+    elapsed = cpu_time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%-10s %8d records  %7.3fs cpu  %8d KiB peak rss' % (variant, count, elapsed, peak_kb)
+
+
+def main():
+    if len(sys.argv) == 3:
+        return run_variant(*sys.argv[1:])
+
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    path = tempfile.mktemp(suffix='.sqlite')
+    try:
+        setup_database(path, record_count)
+        for variant in ('orm_scan', 'core_scan'):
+            subprocess.check_call([sys.executable, __file__, variant, path])
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
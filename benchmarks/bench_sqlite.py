@@ -0,0 +1,72 @@
+"""
+Time adding hosts to a SQLite database one at a time with SQLite's own settings (rollback
+journal, synchronous=FULL), with Powerglove's (WAL, synchronous=NORMAL, see SqliteSettings),
+and with Powerglove's settings in a bulk load:
+
+    python benchmarks/bench_sqlite.py [HOST_COUNT] [DIRECTORY]
+
+Each variant starts from a fresh database in DIRECTORY (by default the temporary directory),
+which should be on the disk being deployed to, as syncing to it is most of the cost.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from powerglove_dns.model import Base, Domain
+from powerglove_dns.powerglove import PowergloveDns, RetryPolicy, SqliteSettings
+
+
+def setup_database(path):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Domain.__table__.insert(), [dict(id=1, name='bench.tld', type='MASTER'),
+                                                       dict(id=2, name='10.in-addr.arpa', type='MASTER')])
+    engine.dispose()
+
+
+def add_hosts(pdns, host_count):
+    for number in xrange(host_count):
+        pdns.add_a_record('host%d.bench.tld' % number, ('10.0.0.0/16',))
+
+
+def add_hosts_in_bulk(pdns, host_count):
+    with pdns.bulk_load():
+        add_hosts(pdns, host_count)
+
+
+variants = [('sqlite defaults', SqliteSettings(None, None, None, None), add_hosts),
+            ('tuned', SqliteSettings(), add_hosts),
+            ('tuned, bulk load', SqliteSettings(), add_hosts_in_bulk)]
+
+
+def main():
+    host_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    directory = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+    try:
+        for number, (name, settings, add) in enumerate(variants):
+            path = os.path.join(directory, '%d.sqlite' % number)
+            setup_database(path)
+            pdns = PowergloveDns('sqlite:///%s' % path, sqlite_settings=settings,
+                                 retry_policy=RetryPolicy())
+            # so that allocation doesn't dominate, see PowergloveDns.rebuild_ip_index
+            pdns.rebuild_ip_index()
+
+            start = time.time()
+            add(pdns, host_count)
+            elapsed = time.time() - start
+
+            print '%-18s %d hosts in %.2fs (%.2fms each)' % (name, host_count, elapsed,
+                                                             elapsed * 1000 / host_count)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Time planning and applying an inventory sync of a large zone:
+
+    python benchmarks/bench_sync.py [HOST_COUNT]
+
+The zone starts with HOST_COUNT A records (and their PTR records); the inventory changes the
+address of 1% of them, drops 1% and adds 1% new hosts.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy
+
+from powerglove_dns.model import Base, Domain, Record
+from powerglove_dns.powerglove import PowergloveDns
+from powerglove_dns.sync import DesiredRecord, InventorySync
+
+
+def address(number):
+    return '10.%d.%d.%d' % (number >> 16 & 255, number >> 8 & 255, number & 255)
+
+
+def setup_database(path, host_count):
+    engine = sqlalchemy.create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Domain.__table__.insert(), [dict(id=1, name='bench.tld', type='MASTER'),
+                                                       dict(id=2, name='10.in-addr.arpa', type='MASTER')])
+        rows = []
+        for number in xrange(host_count):
+            name = 'host%d.bench.tld' % number
+            rows.append(dict(domain_id=1, name=name, type='A', content=address(number), ttl=300, prio=0))
+            rows.append(dict(domain_id=2, name='.'.join(reversed(address(number).split('.'))) + '.in-addr.arpa',
+                             type='PTR', content=name, ttl=300, prio=0))
+        connection.execute(Record.__table__.insert(), rows)
+
+
+def main():
+    host_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = tempfile.mktemp(suffix='.sqlite')
+    try:
+        setup_database(path, host_count)
+        pdns = PowergloveDns('sqlite:///%s' % path)
+
+        desired = []
+        for number in xrange(host_count + host_count // 100):
+            if number % 100 == 1:
+                continue
+            content = address(number + host_count * 2 if number % 100 == 2 else number)
+            desired.append(DesiredRecord('A', 'host%d.bench.tld' % number, content, None))
+
+        start = time.time()
+        synchronizer = InventorySync(pdns, desired)
+        changes = synchronizer.plan()
+        planned = time.time()
+        synchronizer.apply(changes)
+        applied = time.time()
+
+        print '%d hosts: planned %d changes in %.2fs, applied them in %.2fs' % (
+            host_count, len(changes), planned - start, applied - planned)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
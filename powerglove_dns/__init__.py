@@ -1,9 +1,17 @@
 import argparse
+import contextlib
 import datetime
+import json
+import shlex
+import StringIO
 import sys
 
 
-from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError, chunked
+from powerglove_dns.columns import ColumnExport
+from powerglove_dns.federation import FederatedPowergloveDns
+from powerglove_dns.snapshot import OccupancySnapshot, PlanningPowergloveDns
+from powerglove_dns.sync import InventorySync, load_inventory
 
 parser = argparse.ArgumentParser(description='Reserve an ip address in the network\'s Power DNS install '
                                              'for the given fully-qualified domain name')
@@ -11,6 +19,14 @@ parser = argparse.ArgumentParser(description='Reserve an ip address in the netwo
 parser.add_argument('--pdns_connect_string', dest='pdns_connect_string', default=None,
                     help='the SQL Alchemy-compatible connection string to Power DNS. '
                          'Required in either the configuration file or on the commandline')
+parser.add_argument('--pdns_read_connect_string', dest='pdns_read_connect_string', default=None,
+                    help='the SQL Alchemy-compatible connection string to a read replica of Power DNS, '
+                         'used for lookups. Changes are always checked against the main connection')
+
+parser.add_argument('--snapshot', metavar='SNAPSHOT_PATH', dest='snapshot', default=None,
+                    help='answer --is_present, --assert_is_present and --add from a snapshot written by '
+                         '--export_snapshot instead of Power DNS. Nothing is changed: --add only reports '
+                         'the address that would be reserved')
 
 add_group = parser.add_argument_group('add options',
                                       'options that are used in the event of a record being added')
@@ -24,6 +40,42 @@ add_group.add_argument('--text', metavar='TEXT_RECORD_CONTENTS',
                        help='if specified, make an associated text record with the provided '
                             'contents (as a string)')
 
+add_group.add_argument('--expires', metavar='DURATION', default=None,
+                       help='remove the reservation with --sweep once this long has passed, given in '
+                            'seconds or with a unit of s, m, h, d or w (e.g. 4h)')
+
+remove_group = parser.add_argument_group('remove options',
+                                         'options that are used in the event of a record being removed')
+
+remove_group.add_argument('--cascade', action='store_true', default=False,
+                          help='also remove every CNAME pointing at the removed name (to any depth), '
+                               'rather than refusing to remove it, and list what was removed')
+
+search_group = parser.add_argument_group('search options',
+                                         'options that are used in the event of a search')
+
+search_group.add_argument('--type', dest='search_types', metavar='RECORD_TYPE', action='append',
+                          choices=('A', 'PTR', 'SOA', 'CNAME', 'TXT'), default=None,
+                          help='only search records of this type; may be repeated [default: all types]')
+search_group.add_argument('--zone', dest='search_zone', metavar='ZONE', default=None,
+                          help='only search records in this zone (e.g. stable.tld)')
+
+sync_group = parser.add_argument_group('sync options',
+                                       'options that are used in the event of a sync')
+
+sync_group.add_argument('--plan', action='store_true', default=False,
+                        help='only list the changes --sync would make, without making them')
+
+batch_group = parser.add_argument_group('batch options',
+                                        'options that are used in the event of a batch')
+
+batch_group.add_argument('--keep_going', action='store_true', default=False,
+                         help='carry on with the rest of the batch after a command fails, rather than '
+                              'stopping')
+batch_group.add_argument('--commit_every', metavar='N', type=int, default=None,
+                         help='commit the batch\'s changes every N commands, rather than after each '
+                              'one; a failed command rolls back the rest of its N')
+
 action_group = parser.add_mutually_exclusive_group(required=True)
 
 action_group.add_argument('--set', metavar=('CONFIG_KEY', 'CONFIG_VALUE'),
@@ -38,6 +90,11 @@ action_group.add_argument('--cname', metavar=('CNAME_FQDN', 'A_Record_FQDN'),
                                'cname fully-qualified-domain-name to the provided '
                                'A record fully-qualified domain name.')
 
+action_group.add_argument('--cname_batch', metavar='CNAME_FILE', default=None,
+                          help='create a CNAME alias for each line of the file, given as CNAME_FQDN '
+                               'A_Record_FQDN, all in one transaction. Nothing is created if any alias '
+                               'exists or any A record doesn\'t. Use - to read from stdin')
+
 action_group.add_argument('--is_present', metavar='FQDN', dest='fqdn_to_test',
                           help='returns boolean True (return code 1) if a provided fully-qualified domain '
                                'name is present in the DNS A records, boolean False (0 return code) otherwise')
@@ -56,7 +113,225 @@ action_group.add_argument('--add', metavar=('FQDN', 'RANGE'), nargs='+',
                                'IP Glob (e.g. 192.168.132-133.*), '
                                'start and stop ip (e.g. 192.168.132.2 192.168.133.254), and'
                                'explicit ip (e.g. 192.168.132.12). No ips ending with '
-                               '0, 1, or 255 will be used in a given range')
+                               '0, 1, or 255 will be used in a given range, unless an [exclusions] '
+                               'section of the configuration file says otherwise. Without a range, '
+                               'the pool of the FQDN\'s zone is used, from the [pools] section of the '
+                               'configuration file or else inferred from its reverse zones')
+
+action_group.add_argument('--add_next', metavar=('PATTERN', 'RANGE'), nargs='+',
+                          help='like --add, for the first unused name in the pattern, where {n} is '
+                               'replaced by a number from 1 (e.g. web-{n:03d}.stable.tld for web-001, '
+                               'web-002, ...)')
+
+action_group.add_argument('--move', metavar=('FQDN', 'RANGE'), nargs='+',
+                          help='give the FQDN\'s A record a new address from the range (given as for '
+                               '--add), updating its PTR record in the same transaction')
+
+action_group.add_argument('--rename', metavar=('OLD_FQDN', 'NEW_FQDN'), nargs=2, default=None,
+                          help='rename a host or alias along with its TXT and PTR records and the CNAMEs '
+                               'pointing at it, in one transaction, and list the updated records')
+
+action_group.add_argument('--sync', metavar='INVENTORY_FILE', default=None,
+                          help='make the A, CNAME and TXT records of the zones in the inventory match it, '
+                               'adding, updating and removing records (and their PTR records) as needed, '
+                               'and list the changes as JSON lines. The inventory is CSV, with type,name,'
+                               'content[,ttl] rows, or YAML (.yaml or .yml) if PyYAML is installed')
+
+action_group.add_argument('--batch', metavar='BATCH_FILE', default=None,
+                          help='carry out the commands in the file (or stdin, given -), one per line '
+                               'as command line options (e.g. --add web.stable.tld 192.168.134.0/24) or '
+                               'a JSON list of them, with a single connection, and write a JSON line '
+                               'with the result of each')
+
+action_group.add_argument('--sweep', action='store_true', default=False,
+                          help='remove the reservations made with --expires that have expired (along with '
+                               'their PTR and TXT records), and list the removed records as JSON lines')
+
+action_group.add_argument('--lookup', metavar='IP', nargs='+', default=None,
+                          help='report the A and PTR records for each IP as JSON lines, flagging any where '
+                               'they disagree. Use - to read whitespace separated IPs from stdin')
+
+action_group.add_argument('--search', metavar='PATTERN', default=None,
+                          help='write the records whose names match the pattern (e.g. web-*.stable.tld, '
+                               'where * matches anything and ? any one character) as JSON lines, in name order')
+
+action_group.add_argument('--rebuild_ip_index', action='store_true', default=False,
+                          help='create (if needed) and repopulate the integer IP index table, which lets '
+                               'the database find free addresses directly. Only needed again if records '
+                               'are changed outside of Powerglove')
+
+action_group.add_argument('--rebuild_subnet_usage', action='store_true', default=False,
+                          help='create (if needed) and repopulate the table summarizing the A records in '
+                               'each /24 subnet, which lets allocation skip full subnets; the integer IP index '
+                               'is built first if needed')
+
+action_group.add_argument('--create_indexes', action='store_true', default=False,
+                          help='create the indexes Powerglove adds to the Power DNS tables, such as the '
+                               'records change date index used to follow changes')
+
+action_group.add_argument('--export_snapshot', metavar='SNAPSHOT_PATH', default=None,
+                          help='write a compact, memory-mappable snapshot of the reserved addresses and '
+                               'names, for use with --snapshot')
+
+action_group.add_argument('--export_columns', metavar='DIRECTORY', default=None,
+                          help='write every record to DIRECTORY as memory-mappable NumPy .npy columns: '
+                               'id, domain_id, type, ip (A record addresses as uint32), ttl, '
+                               'change_date, and the names as name_offsets and name_data; an existing '
+                               'DIRECTORY is only replaced if it holds a previous export')
+
+# options that only make sense for a whole invocation
+batch_disallowed_options = set(['--batch', '--set', '--snapshot', '--pdns_connect_string',
+                                '--pdns_read_connect_string', '--commit_every', '--keep_going'])
+
+
+def read_pairs(path):
+    """
+    @param path: the file to read, or - for stdin
+    @return: C{list} of the whitespace separated pairs on each line, skipping blank lines and
+        # comments
+    """
+
+    lines = sys.stdin if path == '-' else open(path)
+    pairs = []
+    try:
+        for line_number, line in enumerate(lines, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise PowergloveError('%s line %d: expected two names, got %r' % (path, line_number, line))
+            pairs.append(tuple(fields))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    return pairs
+
+
+def to_json(value):
+    """
+    @return: the provided command result with its records, addresses and tuples made
+        JSON serializable
+    """
+
+    if hasattr(value, '_asdict'):
+        return dict((key, to_json(item)) for key, item in value._asdict().items())
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, to_json(item)) for key, item in value.items())
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    return str(value)
+
+
+@contextlib.contextmanager
+def captured_stdout():
+    """
+    @return: context manager collecting what is written to stdout within it into the
+        C{StringIO} it yields
+    """
+
+    output = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, output
+    try:
+        yield output
+    finally:
+        sys.stdout = stdout
+
+
+def read_batch(lines):
+    """
+    generates the (line number, line, parsed arguments or the C{Exception} parsing them) of each
+    command in the batch, given either as a command line (e.g. C{--add web.stable.tld
+    192.168.134.0/24}) or a JSON list of arguments, skipping blank lines and # comments
+    """
+
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        try:
+            if line.startswith('['):
+                command = [unicode(arg) for arg in json.loads(line)]
+            else:
+                command = shlex.split(line, comments=True)
+            if not command:
+                continue
+
+            if set(command) & batch_disallowed_options:
+                raise PowergloveError('%s cannot be used within a batch' %
+                                      ', '.join(sorted(set(command) & batch_disallowed_options)))
+            try:
+                yield line_number, line, parser.parse_args(command)
+            except SystemExit:
+                raise PowergloveError('invalid command, see --help')
+        except (PowergloveError, ValueError) as exc:
+            yield line_number, line, exc
+
+
+def run_batch(args, assistant, logger=None):
+    """
+    Carry out each command of the batch in turn with the same L{PowergloveDns}, writing a JSON
+    line per command with its result (and any JSON lines it wrote) or error. Given
+    --commit_every, commands are carried out in transactions of that many, and an error rolls
+    back the rest of its transaction, whose commands all fail (those after the error without
+    being carried out).
+
+    @return: the C{int} number of failed commands
+    """
+
+    if args.commit_every and not hasattr(assistant, 'transaction'):
+        raise PowergloveError('--commit_every needs a single Power DNS connection')
+
+    def run_group(group, results):
+        for line_number, line, command_args in group:
+            result = dict(line=line_number, command=line)
+            results.append(result)
+            if isinstance(command_args, Exception):
+                raise command_args
+
+            with captured_stdout() as output:
+                result['result'] = to_json(run_command(command_args, assistant, logger))
+            result.update(ok=True, output=[json.loads(output_line)
+                                           for output_line in output.getvalue().splitlines()])
+
+    lines = sys.stdin if args.batch == '-' else open(args.batch)
+    failures = 0
+    try:
+        for group in chunked(read_batch(lines), args.commit_every or 1):
+            results = []
+            try:
+                if args.commit_every:
+                    with assistant.transaction():
+                        run_group(group, results)
+                else:
+                    run_group(group, results)
+            except Exception as exc:
+                if logger is not None:
+                    logger.debug('batch command failed', exc_info=True)
+                if not args.commit_every and hasattr(assistant, 'session'):
+                    assistant.session.rollback()
+                error = str(getattr(exc, 'output', exc))
+                for result in results:
+                    # the failed command is the one without a result; with none, the commit failed
+                    result.update(ok=False, error=error if result.get('ok') is None else 'rolled back: ' + error)
+                    result.pop('result', None)
+                    result.pop('output', None)
+                # the rest of the group is never carried out
+                results.extend(dict(line=line_number, command=line, ok=False, error='not run: rolled back: ' + error)
+                               for line_number, line, _ in group[len(results):])
+                failures += len(results)
+                if not args.keep_going:
+                    return failures
+            finally:
+                for result in results:
+                    sys.stdout.write(json.dumps(result) + '\n')
+                sys.stdout.flush()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    return failures
 
 
 def main(args=None, logger=None):
@@ -67,7 +342,44 @@ def main(args=None, logger=None):
         PowergloveDns.set_config(*args.set)
         return
 
-    assistant = PowergloveDns(pdns_sqla_url=args.pdns_connect_string, logger=logger)
+    if args.snapshot:
+        planner = PlanningPowergloveDns(args.snapshot, logger=logger)
+        if args.add:
+            return planner.plan_a_record(args.add[0], args.add[1:])
+        elif args.fqdn_to_test:
+            return planner.fqdn_is_present(args.fqdn_to_test)
+        elif args.fqdn_to_assert:
+            if not planner.fqdn_is_present(args.fqdn_to_assert):
+                raise PowergloveError('no A or CNAME record named %s is present' % args.fqdn_to_assert)
+            return 0
+        raise PowergloveError('only --is_present, --assert_is_present and --add can use a snapshot')
+
+    assistant = None
+    if not args.pdns_connect_string:
+        # a [backends] section in the config file federates several Power DNS databases
+        assistant = FederatedPowergloveDns.from_config(logger=logger)
+    if assistant is None:
+        assistant = PowergloveDns(pdns_sqla_url=args.pdns_connect_string, logger=logger,
+                                  pdns_read_sqla_url=args.pdns_read_connect_string)
+
+    try:
+        if args.batch:
+            return run_batch(args, assistant, logger)
+
+        return run_command(args, assistant, logger)
+    finally:
+        counters = assistant.contention_counters
+        if counters:
+            assistant.log.info('contention: %s', ', '.join('%s=%d' % (kind, counters[kind])
+                                                          for kind in sorted(counters)))
+        assistant.close()
+
+
+def run_command(args, assistant, logger=None):
+    """
+    carry out the action of the parsed command line with the provided L{PowergloveDns} (or
+    L{FederatedPowergloveDns})
+    """
 
     if args.fqdn_to_test:
         return assistant.fqdn_is_present(args.fqdn_to_test)
@@ -78,13 +390,98 @@ def main(args=None, logger=None):
         return 0
 
     elif args.remove:
+        if args.cascade:
+            removed = assistant.remove_fqdn(args.remove, cascade=True)
+            for row in removed:
+                sys.stdout.write(json.dumps(row._asdict()) + '\n')
+            return removed
         return assistant.remove_fqdn(args.remove)
 
     elif args.cname:
         return assistant.add_cname_record(*args.cname)
 
+    elif args.cname_batch:
+        return assistant.add_cname_records(read_pairs(args.cname_batch))
+
     elif args.add:
-        return assistant.add_a_record(args.add[0], args.add[1:], args.ttl, args.text_record_contents)
+        return assistant.add_a_record(args.add[0], args.add[1:], args.ttl, args.text_record_contents,
+                                      args.expires)
+
+    elif args.add_next:
+        return assistant.add_next_a_record(args.add_next[0], args.add_next[1:], args.ttl,
+                                           args.text_record_contents, expires=args.expires)
+
+    elif args.move:
+        return assistant.move_a_record(args.move[0], args.move[1:])
+
+    elif args.rename:
+        updated = assistant.rename_fqdn(*args.rename)
+        for row in updated:
+            sys.stdout.write(json.dumps(row._asdict()) + '\n')
+        return updated
+
+    elif args.sync:
+        if isinstance(assistant, FederatedPowergloveDns):
+            raise PowergloveError('--sync needs a single Power DNS connection')
+        synchronizer = InventorySync(assistant, load_inventory(args.sync), default_ttl=args.ttl,
+                                     logger=logger)
+        changes = synchronizer.plan()
+        for change in changes:
+            sys.stdout.write(json.dumps(dict(change._asdict(), old=change.old and change.old._asdict())) + '\n')
+        if not args.plan:
+            synchronizer.apply(changes)
+        return changes
+
+    elif args.sweep:
+        removed = assistant.sweep()
+        for row in removed:
+            sys.stdout.write(json.dumps(row._asdict()) + '\n')
+        return removed
+
+    elif args.lookup:
+        ip_addresses = args.lookup
+        if ip_addresses == ['-']:
+            ip_addresses = sys.stdin.read().split()
+        lookups = assistant.lookup_ips(ip_addresses)
+        for lookup in lookups:
+            sys.stdout.write(json.dumps(dict(lookup._asdict(), mismatched=lookup.mismatched)) + '\n')
+        return lookups
+
+    elif args.search:
+        count = 0
+        for row in assistant.search(args.search, types=args.search_types, zone=args.search_zone):
+            sys.stdout.write(json.dumps(row._asdict()) + '\n')
+            count += 1
+        # the exit status, not the number of matches
+        assistant.log.info('found %d records matching %s', count, args.search)
+        return 0
+
+    elif args.rebuild_ip_index:
+        # logs the number of indexed records, main's result being the exit status
+        assistant.rebuild_ip_index()
+        return 0
+
+    elif args.rebuild_subnet_usage:
+        # logs the number of summarized subnets
+        assistant.rebuild_subnet_usage()
+        return 0
+
+    elif args.create_indexes:
+        # logs each created index
+        assistant.create_indexes()
+        return 0
+
+    elif args.export_snapshot:
+        if not hasattr(assistant, 'scan_records'):
+            raise PowergloveError('--export_snapshot needs a single Power DNS connection')
+        OccupancySnapshot.export(assistant, args.export_snapshot).close()
+        return 0
+
+    elif args.export_columns:
+        if not hasattr(assistant, 'read_session'):
+            raise PowergloveError('--export_columns needs a single Power DNS connection')
+        ColumnExport(assistant).export(args.export_columns)
+        return 0
     else:
         raise RuntimeError('unknown command specified given args: %r' % args)
 
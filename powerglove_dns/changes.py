@@ -0,0 +1,90 @@
+import logging
+
+
+class ChangeFollower(object):
+    """
+    Keeps an in-process copy of the Power DNS records current with small periodic queries,
+    rather than reloading every record.
+
+    Each L{poll} asks L{PowergloveDns.changes_since} for the records dated at or after the last
+    poll. Removals (and records written without a change_date by other tools) can't be seen that
+    way, so the follower also compares the number, highest and sum of the record ids against its
+    own (see L{PowergloveDns.summarize_record_ids}); only when they differ are the record ids
+    read, to find the ids that have disappeared or appeared.
+
+    Listeners are called with C{(added, changed, removed)} lists of L{RecordRow} after every poll
+    that found something, e.g. to maintain another cache or a local snapshot.
+    """
+
+    def __init__(self, pdns, types=None, logger=None):
+        """
+        @param pdns: the L{PowergloveDns} to follow
+        @param types: if provided, only follow records of these types
+        @param logger: the logger instance to use, else, a new one is created
+        """
+
+        if logger is None:
+            self.log = logging.getLogger(self.__class__.__name__)
+        else:
+            self.log = logger
+
+        self.pdns = pdns
+        self.types = types
+        self.cursor = None
+        self.records = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """
+        @param listener: callable taking the C{(added, changed, removed)} lists of a poll
+        """
+        self.listeners.append(listener)
+
+    def poll(self):
+        """
+        Apply the changes made since the last poll (or load every record, the first time)
+
+        @return: C{tuple} consisting of (added, changed, removed) C{list}s of L{RecordRow}
+        """
+
+        # one read transaction per poll, not held (with a stale snapshot) between polls
+        with self.pdns.read_operation():
+            added, changed, removed = self._poll()
+
+        if added or changed or removed:
+            self.log.debug('applying %d added, %d changed and %d removed records',
+                           len(added), len(changed), len(removed))
+            for listener in self.listeners:
+                listener(added, changed, removed)
+
+        return added, changed, removed
+
+    def _summarize_ids(self):
+        """
+        @return: the L{PowergloveDns.summarize_record_ids} of the records followed so far
+        """
+
+        return len(self.records), max(self.records) if self.records else None, sum(self.records)
+
+    def _poll(self):
+
+        rows, self.cursor = self.pdns.changes_since(self.cursor, self.types)
+
+        added, changed, removed = [], [], []
+        for row in rows:
+            previous = self.records.get(row.id)
+            if previous is None:
+                added.append(row)
+            elif previous != row:
+                changed.append(row)
+            self.records[row.id] = row
+
+        if self.pdns.summarize_record_ids(self.types) != self._summarize_ids():
+            current_ids = self.pdns.get_record_ids(self.types)
+            removed = [self.records.pop(record_id) for record_id in set(self.records) - current_ids]
+            undated = self.pdns.get_record_rows_by_id(current_ids - set(self.records))
+            for row in undated:
+                self.records[row.id] = row
+            added.extend(undated)
+
+        return added, changed, removed
@@ -0,0 +1,193 @@
+import os
+import Queue
+import threading
+import time
+
+import configobj
+
+from powerglove import PowergloveError
+
+
+class PendingAllocation(object):
+    """
+    A request waiting in an L{AllocationCoalescer}, answered once its batch is committed
+    """
+
+    def __init__(self, request):
+        """
+        @param request: the C{(fqdn, ip_range, ttl, text_contents)} of the reservation
+        """
+
+        self.request = request
+        self.result = None
+        self._answered = threading.Event()
+
+    def answer(self, result):
+        """
+        @param result: the C{tuple} of (fqdn, selected_ip_address), or the exception the request
+            failed with
+        """
+
+        self.result = result
+        self._answered.set()
+
+    def wait(self):
+        """
+        @return: the C{tuple} of (fqdn, selected_ip_address)
+        @raise: the exception the request failed with
+        """
+
+        self._answered.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class AllocationCoalescer(object):
+    """
+    Group commit for a long-running process that reserves addresses for many clients at once,
+    such as the threads of a web service sharing one L{PowergloveDns}. Rather than each request
+    reading the range's occupancy and committing on its own, behind a lock, requests arriving
+    within C{window} seconds of each other (up to C{batch_size} of them) are made together by a
+    single worker thread with L{PowergloveDns.add_a_records}, and every waiting caller is then
+    answered::
+
+        with AllocationCoalescer(pdns) as coalescer:
+            # from any number of threads
+            fqdn, ip = coalescer.add_a_record('web-1.stable.tld', ('192.168.134.0/24',))
+
+    The worker is the only user of the L{PowergloveDns}, whose session isn't thread safe. A
+    C{[coalescing]} section in the config file changes the defaults, see L{from_config}.
+    """
+
+    config_section = 'coalescing'
+
+    def __init__(self, pdns, window=0.005, batch_size=100):
+        """
+        @param pdns: the L{PowergloveDns} to make the reservations with
+        @param window: the most seconds a batch waits for more requests after its first one
+        @param batch_size: the most requests made in one transaction
+        """
+
+        if window < 0 or batch_size < 1:
+            raise PowergloveError('invalid coalescing window {0!r} or batch_size {1!r}', window, batch_size)
+
+        self.pdns = pdns
+        self.window = window
+        self.batch_size = batch_size
+        self.batch_count = 0
+        self.request_count = 0
+
+        self._queue = Queue.Queue()
+        self._worker = None
+
+    @classmethod
+    def from_config(cls, pdns, config_file=None):
+        """
+        @param pdns: the L{PowergloveDns} to make the reservations with
+        @param config_file: the config file to read the C{[coalescing]} section from, which may
+            set C{window} (in seconds) and C{batch_size}; by default that of L{PowergloveDns}
+        @return: the configured L{AllocationCoalescer}, not yet started
+        """
+
+        if config_file is None:
+            config_file = pdns.def_config_file
+        section = {}
+        if os.path.exists(config_file):
+            section = configobj.ConfigObj(config_file).get(cls.config_section) or {}
+
+        kwargs = {}
+        for key, parse in (('window', float), ('batch_size', int)):
+            if section.get(key) not in (None, ''):
+                try:
+                    kwargs[key] = parse(section[key])
+                except ValueError:
+                    raise PowergloveError('invalid coalescing {0} {1!r} in {2}', key, section[key], config_file)
+        return cls(pdns, **kwargs)
+
+    def start(self):
+        """
+        start the worker thread, if it isn't running
+        """
+
+        if self._worker is None:
+            # the worker takes the sessions over, which mustn't hold on to this thread's connections
+            self._close_sessions()
+            self._worker = threading.Thread(target=self._run, name='AllocationCoalescer')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def close(self):
+        """
+        make the requests already waiting, then stop the worker thread
+        """
+
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_a_record(self, fqdn, ip_range=None, ttl=None, text_contents=None):
+        """
+        Make an IP reservation along with those of the other waiting callers, see
+        L{PowergloveDns.add_a_record}; safe to call from any thread
+
+        @return: C{tuple} consisting of (a_record.name, selected_ip_address)
+        """
+
+        if self._worker is None:
+            raise PowergloveError('the allocation coalescer is not started')
+
+        pending = PendingAllocation((fqdn, ip_range, ttl, text_contents))
+        self._queue.put(pending)
+        return pending.wait()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            pending = self._queue.get()
+            if pending is None:
+                break
+
+            batch = [pending]
+            deadline = time.time() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._make_batch(batch)
+        self._close_sessions()
+
+    def _close_sessions(self):
+        self.pdns.session.close()
+        if self.pdns.read_session is not self.pdns.session:
+            self.pdns.read_session.close()
+
+    def _make_batch(self, batch):
+        """
+        @param batch: the C{list} of L{PendingAllocation} to make and answer
+        """
+
+        try:
+            results = self.pdns.add_a_records([pending.request for pending in batch])
+        except Exception as error:
+            self.pdns.log.exception('failed to make a batch of %d reservations', len(batch))
+            results = [error] * len(batch)
+
+        self.batch_count += 1
+        self.request_count += len(batch)
+        self.pdns.log.debug('made a batch of %d reservations', len(batch))
+        for pending, result in zip(batch, results):
+            pending.answer(result)
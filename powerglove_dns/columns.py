@@ -0,0 +1,211 @@
+import os
+import shutil
+import socket
+import struct
+
+from sqlalchemy import select
+
+from model import Record
+from powerglove import PowergloveError
+
+
+class NpyColumnWriter(object):
+    """
+    Writes a one dimensional array to a NumPy C{.npy} file as it is produced, without needing
+    NumPy: the header is written up front with room for any length, and the length filled in
+    when the column is closed.
+    """
+
+    magic = '\x93NUMPY\x01\x00'
+    header_size = 128
+
+    def __init__(self, path, descr, item_format=None):
+        """
+        @param path: the path of the C{.npy} file to write
+        @param descr: the NumPy type of the items, e.g. C{<u4} or C{|S6}
+        @param item_format: the L{struct} format of an item, e.g. C{I}; if not given, the
+            items are written as raw bytes with L{write_bytes}
+        """
+
+        self.descr = descr
+        self.item_format = item_format
+        self.item_size = struct.calcsize('<' + item_format) if item_format else int(descr[2:])
+        self.count = 0
+
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (self.descr, self.count)
+        length = self.header_size - len(self.magic) - 2
+        self._file.write(self.magic + struct.pack('<H', length) + header.ljust(length - 1) + '\n')
+
+    def write(self, items):
+        """
+        @param items: the C{list} of items to append
+        """
+
+        self._file.write(struct.pack('<%d%s' % (len(items), self.item_format), *items))
+        self.count += len(items)
+
+    def write_bytes(self, data):
+        """
+        @param data: the C{str} of whole items to append
+        """
+
+        self._file.write(data)
+        self.count += len(data) // self.item_size
+
+    def close(self):
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+
+class ColumnExport(object):
+    """
+    Writes the records table as a directory of columns, one NumPy C{.npy} file each, in record
+    id order, for analysis with NumPy or pandas::
+
+        id.npy, domain_id.npy, ttl.npy, change_date.npy    <i4, with -1 for NULL
+        type.npy                                           |S6
+        ip.npy                                             <u4 address of A records, else 0
+        name_offsets.npy                                   <i8, one more than the records
+        name_data.npy                                      |u1 UTF-8 names, back to back
+
+    where the name of record C{i} is C{name_data[name_offsets[i]:name_offsets[i + 1]]}. Each
+    file can be memory-mapped (e.g. C{numpy.load(path, mmap_mode='r')}, see L{load_columns}),
+    which a zipped C{.npz} can't be.
+
+    The table is read in chunks of C{chunk_size} records by id, so exporting takes the same
+    memory however many records there are.
+    """
+
+    integer_columns = ('id', 'domain_id', 'ttl', 'change_date')
+    column_names = integer_columns + ('type', 'ip', 'name_offsets', 'name_data')
+    type_width = Record.__table__.c.type.type.length
+
+    def __init__(self, pdns, chunk_size=10000):
+        """
+        @param pdns: the L{PowergloveDns} to export the records of
+        @param chunk_size: the C{int} number of records to read at a time
+        """
+
+        self.pdns = pdns
+        self.chunk_size = chunk_size
+
+    def iter_chunks(self):
+        """
+        generates the records as C{list}s of at most chunk_size rows, in id order
+        """
+
+        columns = Record.__table__.c
+        query = select([columns.id, columns.domain_id, columns.name, columns.type, columns.content,
+                        columns.ttl, columns.change_date]).order_by(columns.id).limit(self.chunk_size)
+
+        session = self.pdns.read_session
+        last_id = None
+        while True:
+            chunk_query = query if last_id is None else query.where(columns.id > last_id)
+            rows = session.execute(chunk_query).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+    @staticmethod
+    def encode_ip(content):
+        try:
+            return struct.unpack('!I', socket.inet_aton(content))[0]
+        except (socket.error, TypeError):
+            return 0
+
+    def export(self, path):
+        """
+        @param path: the directory to write the columns to; the columns are written beside it
+            and renamed into place once complete, so an existing directory is only replaced if
+            it holds nothing but the columns of a previous export
+        @return: the C{int} number of records written
+        @raise PowergloveError: if the path is anything other than a previous export
+        """
+
+        if os.path.lexists(path):
+            column_files = set(name + '.npy' for name in self.column_names)
+            if os.path.islink(path) or not os.path.isdir(path) or not set(os.listdir(path)) <= column_files:
+                raise PowergloveError('refusing to replace {0}, which is not a previous column export', path)
+
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        previous_path = '%s.%d.old' % (path, os.getpid())
+        os.mkdir(temporary_path)
+        try:
+            count = self._write_columns(temporary_path)
+            # a directory can't be renamed over one that isn't empty, so the previous export is
+            # moved aside first, and back should the new one fail to take its place
+            if os.path.isdir(path):
+                os.rename(path, previous_path)
+                try:
+                    os.rename(temporary_path, path)
+                except OSError:
+                    os.rename(previous_path, path)
+                    raise
+                shutil.rmtree(previous_path)
+            else:
+                os.rename(temporary_path, path)
+        except:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise
+
+        self.pdns.log.info('wrote %d records as columns to %s', count, path)
+        return count
+
+    def _write_columns(self, directory):
+
+        def column(name, descr, item_format=None):
+            return NpyColumnWriter(os.path.join(directory, name + '.npy'), descr, item_format)
+
+        integers = [(name, column(name, '<i4', 'i')) for name in self.integer_columns]
+        types = column('type', '|S%d' % self.type_width)
+        ips = column('ip', '<u4', 'I')
+        name_offsets = column('name_offsets', '<i8', 'q')
+        name_data = column('name_data', '|u1', 'B')
+        writers = [writer for _, writer in integers] + [types, ips, name_offsets, name_data]
+
+        try:
+            name_offset = 0
+            name_offsets.write([name_offset])
+            for rows in self.iter_chunks():
+                for name, writer in integers:
+                    writer.write([-1 if row[name] is None else row[name] for row in rows])
+                types.write_bytes(''.join((row.type or '').encode('ascii').ljust(self.type_width, '\0')
+                                          for row in rows))
+                ips.write([self.encode_ip(row.content) if row.type == 'A' else 0 for row in rows])
+
+                names = [(row.name or u'').encode('utf-8') for row in rows]
+                offsets = []
+                for name in names:
+                    name_offset += len(name)
+                    offsets.append(name_offset)
+                name_offsets.write(offsets)
+                name_data.write_bytes(''.join(names))
+        finally:
+            for writer in writers:
+                writer.close()
+
+        return ips.count
+
+
+def load_columns(path):
+    """
+    Memory-map the columns written by L{ColumnExport}; needs NumPy
+
+    @param path: the directory the columns were exported to
+    @return: C{dict} mapping each column name to its read-only C{numpy.ndarray}
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        raise PowergloveError('loading exported columns needs NumPy, which is not installed')
+
+    return dict((file_name[:-len('.npy')], numpy.load(os.path.join(path, file_name), mmap_mode='r'))
+                for file_name in os.listdir(path) if file_name.endswith('.npy'))
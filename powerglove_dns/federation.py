@@ -0,0 +1,354 @@
+import collections
+import heapq
+import logging
+import os
+
+from multiprocessing.pool import ThreadPool
+
+import configobj
+
+from powerglove import IpOwnership, PowergloveDns, PowergloveError, PowergloveFqdnNotFoundError
+
+
+class FederatedPowergloveDns(object):
+    """
+    Class for interacting with several independent Power DNS databases (e.g. one per
+    datacenter) as one. Changes are routed to the backend that owns the zone (or record)
+    involved, while lookups are fanned out to every backend in parallel and merged, so that
+    they take as long as the slowest backend rather than the sum of them.
+
+    Backends are read from the C{[backends]} section of the config file, for example::
+
+        [backends]
+        east = postgresql://pdns@east/pdns
+        west = postgresql://pdns@west/pdns
+    """
+
+    backends_config_section = 'backends'
+
+    def __init__(self, backends, logger=None):
+        """
+        @param backends: C{dict} mapping each backend name to either its SQL Alchemy url or an
+            existing L{PowergloveDns}
+        @param logger: the logger instance to use, else, a new one is created
+        """
+
+        if logger is None:
+            self.log = logging.getLogger(self.__class__.__name__)
+        else:
+            self.log = logger
+
+        if not backends:
+            raise PowergloveError('no Power DNS backends specified')
+
+        self.backends = collections.OrderedDict()
+        for name in sorted(backends):
+            backend = backends[name]
+            if not isinstance(backend, PowergloveDns):
+                backend = PowergloveDns(backend, logger=self.log)
+            self.backends[name] = backend
+
+        self._pool = ThreadPool(len(self.backends))
+
+    @classmethod
+    def from_config(cls, config_file=None, logger=None):
+        """
+        @param config_file: the config file to read the C{[backends]} section from, defaults
+            to L{PowergloveDns.def_config_file}
+        @return: the L{FederatedPowergloveDns}, or C{None} if no backends are configured
+        """
+
+        if config_file is None:
+            config_file = PowergloveDns.def_config_file
+
+        if not os.path.exists(config_file):
+            return None
+
+        backends = configobj.ConfigObj(config_file).get(cls.backends_config_section)
+        if not backends:
+            return None
+
+        return cls(dict(backends), logger=logger)
+
+    def close(self):
+        """
+        stop the thread pool, then L{PowergloveDns.close} every backend
+        """
+
+        self._pool.close()
+        self._pool.join()
+        for backend in self.backends.values():
+            backend.close()
+
+    @property
+    def contention_counters(self):
+        """
+        @return: the L{PowergloveDns.contention_counters} of every backend, added up
+        """
+
+        counters = collections.Counter()
+        for backend in self.backends.values():
+            counters.update(backend.contention_counters)
+        return dict(counters)
+
+    def _fan_out(self, method_name, *args, **kwargs):
+        """
+        call the named method on every backend in parallel
+
+        @return: C{OrderedDict} mapping each backend name to its result
+        """
+
+        return self._fan_out_function(lambda backend: getattr(backend, method_name)(*args, **kwargs))
+
+    def _fan_out_function(self, function):
+        """
+        call the provided function with every backend in parallel
+
+        @return: C{OrderedDict} mapping each backend name to its result
+        """
+
+        def call(name):
+            backend = self.backends[name]
+            try:
+                return function(backend)
+            finally:
+                backend.session.close()
+                backend.read_session.close()
+
+        # connections can't follow their sessions between threads, so each backend's sessions
+        # are released before and after being used from the pool
+        for backend in self.backends.values():
+            backend.session.close()
+            backend.read_session.close()
+
+        names = list(self.backends)
+        return collections.OrderedDict(zip(names, self._pool.map(call, names)))
+
+    def get_backend_for_fqdn(self, fqdn):
+        """
+        @param fqdn: the fully-qualified domain name to find the owner of
+        @return: the C{(name, PowergloveDns)} of the backend with the most specific zone
+            for the FQDN
+        @raise PowergloveError: if no backend has a zone for the FQDN
+        """
+
+        def zone_name(backend):
+            try:
+                return backend.get_a_domain_from_fqdn(fqdn).name
+            except PowergloveError:
+                return None
+
+        zones = self._fan_out_function(zone_name)
+        owners = [(len(zone.split('.')), name) for name, zone in zones.items() if zone]
+        if not owners:
+            raise PowergloveError('no backend has a domain for {0}', fqdn)
+
+        _, owner = max(owners)
+        self.log.debug('routing %s to backend %s', fqdn, owner)
+        return owner, self.backends[owner]
+
+    def _get_backends_with_fqdn(self, fqdn):
+        return [self.backends[name] for name, present
+                in self._fan_out('fqdn_is_present', fqdn).items() if present]
+
+    def fqdn_is_present(self, fqdn):
+        """
+        @return: True if the provided FQDN is present in any backend, false otherwise
+        """
+
+        return any(self._fan_out('fqdn_is_present', fqdn).values())
+
+    def get_a_records_for_ip(self, ip_address):
+        """
+        @return: C{list} of C{(backend name, A record)} for every backend's A records holding
+            the provided address
+        """
+
+        return [(name, record) for name, records in self._fan_out('get_a_records_for_ip', ip_address).items()
+                for record in records]
+
+    def lookup_ips(self, ip_addresses, chunk_size=500):
+        """
+        L{PowergloveDns.lookup_ips} merged across every backend
+        """
+
+        ip_addresses = list(ip_addresses)
+        results = self._fan_out('lookup_ips', ip_addresses, chunk_size).values()
+        return [IpOwnership(lookups[0].ip,
+                            sorted(set().union(*[lookup.a_names for lookup in lookups])),
+                            sorted(set().union(*[lookup.ptr_names for lookup in lookups])))
+                for lookups in zip(*results)]
+
+    def search(self, pattern, types=None, zone=None, page_size=1000):
+        """
+        L{PowergloveDns.search} on every backend (or, given a zone, on those having it), merged
+        in name order as each backend's pages are read
+
+        @return: generator of L{RecordRow}
+        """
+
+        backends = [backend for backend in self.backends.values() if zone is None or zone in backend.domains]
+        if not backends:
+            raise PowergloveError('unknown zone {0}', zone)
+
+        def keyed(number, rows):
+            for row in rows:
+                yield row.name, number, row
+
+        searches = [keyed(number, backend.search(pattern, types, zone, page_size))
+                    for number, backend in enumerate(backends)]
+        for _, _, row in heapq.merge(*searches):
+            yield row
+
+    def get_ip_utilization(self, ip_range):
+        """
+        @return: C{tuple} consisting of (the number of A record addresses in use within the
+            range across all backends, the size of the range)
+        """
+
+        used = sum(used for used, _ in self._fan_out('get_ip_utilization', ip_range).values())
+        return used, ip_range.size
+
+    def get_ip_range(self, ip_range, fqdn=None):
+        if not ip_range and fqdn is not None:
+            return self.get_backend_for_fqdn(fqdn)[1].get_ip_range(ip_range, fqdn)
+        return self.backends.values()[0].get_ip_range(ip_range)
+
+    def sweep(self, now=None):
+        """
+        @return: C{list} of the records every backend's L{PowergloveDns.sweep} removed
+        """
+
+        return [row for rows in self._fan_out('sweep', now).values() for row in rows]
+
+    def rebuild_ip_index(self):
+        return sum(self._fan_out('rebuild_ip_index').values())
+
+    def rebuild_subnet_usage(self):
+        return sum(self._fan_out('rebuild_subnet_usage').values())
+
+    def create_indexes(self):
+        """
+        @return: C{list} of the names of the indexes L{PowergloveDns.create_indexes} created,
+            across every backend
+        """
+
+        return [name for names in self._fan_out('create_indexes').values() for name in names]
+
+    def add_a_record(self, fqdn, ip_range=None, ttl=None, text_contents=None, expires=None):
+        """
+        L{PowergloveDns.add_a_record} on the backend owning the FQDN's zone, after checking
+        that no backend already has the FQDN
+        """
+
+        if self.fqdn_is_present(fqdn):
+            raise PowergloveError('fully-qualified domain name {0} exists.', fqdn)
+
+        _, backend = self.get_backend_for_fqdn(fqdn)
+        return backend.add_a_record(fqdn, ip_range, ttl, text_contents, expires)
+
+    def add_next_a_record(self, pattern, ip_range=None, ttl=None, text_contents=None, start=1,
+                          expires=None):
+        """
+        L{PowergloveDns.add_next_a_record} on the backend owning the pattern's zone
+        """
+
+        _, backend = self.get_backend_for_fqdn(pattern.format(n=start))
+        return backend.add_next_a_record(pattern, ip_range, ttl, text_contents, start, expires)
+
+    def add_cname_record(self, cname_fqdn, a_fqdn):
+        """
+        L{PowergloveDns.add_cname_record} on the backend holding the aliased FQDN
+        """
+
+        backends = self._get_backends_with_fqdn(a_fqdn)
+        if not backends:
+            raise PowergloveError('attempting to create an alias for a '
+                                  'non-existant FQDN: {0}', a_fqdn)
+
+        return backends[0].add_cname_record(cname_fqdn, a_fqdn)
+
+    def add_cname_records(self, pairs):
+        """
+        L{PowergloveDns.add_cname_records} on the backends holding the aliased FQDNs, after
+        checking every alias and target across all backends; each backend's aliases are created
+        in a transaction of its own
+
+        @return: C{list} of the created C{(CNAME FQDN, A FQDN)}
+        """
+
+        pairs = [tuple(pair) for pair in pairs]
+        cname_fqdns = [cname_fqdn for cname_fqdn, _ in pairs]
+        a_fqdns = set(a_fqdn for _, a_fqdn in pairs)
+
+        targets = self._fan_out_function(
+            lambda backend: set(backend._get_names_present(a_fqdns, backend.session, types=('A',))))
+        owners = {}
+        for name, present in targets.items():
+            for a_fqdn in present:
+                owners.setdefault(a_fqdn, name)
+        missing = sorted(a_fqdns - set(owners))
+        if missing:
+            raise PowergloveError('attempting to create aliases for non-existant FQDNs: {0}',
+                                  ' '.join(missing))
+
+        conflicts = set().union(*self._fan_out_function(
+            lambda backend: set(backend._get_names_present(cname_fqdns, backend.session))).values())
+        conflicts.update(cname_fqdn for cname_fqdn, count in collections.Counter(cname_fqdns).items()
+                         if count > 1)
+        if conflicts:
+            raise PowergloveError('aliases already exist (or are repeated): {0}', ' '.join(sorted(conflicts)))
+
+        for name, backend in self.backends.items():
+            backend_pairs = [pair for pair in pairs if owners[pair[1]] == name]
+            if backend_pairs:
+                backend.add_cname_records(backend_pairs)
+        return pairs
+
+    def _get_backend_with_fqdn(self, fqdn):
+
+        backends = self._get_backends_with_fqdn(fqdn)
+        if not backends:
+            raise PowergloveFqdnNotFoundError('No records associated with '
+                                              'fully-qualified-domain-name:'
+                                              '{0}', fqdn)
+        return backends[0]
+
+    def move_a_record(self, fqdn, ip_range=None):
+        """
+        L{PowergloveDns.move_a_record} on the backend holding the FQDN
+        """
+
+        return self._get_backend_with_fqdn(fqdn).move_a_record(fqdn, ip_range)
+
+    def rename_fqdn(self, old_fqdn, new_fqdn):
+        """
+        L{PowergloveDns.rename_fqdn} on the backend holding the FQDN, after checking that no
+        backend already has the new name
+        """
+
+        if self.fqdn_is_present(new_fqdn):
+            raise PowergloveError('fully-qualified domain name {0} exists.', new_fqdn)
+
+        return self._get_backend_with_fqdn(old_fqdn).rename_fqdn(old_fqdn, new_fqdn)
+
+    def remove_fqdn(self, fqdn, cascade=False):
+        """
+        L{PowergloveDns.remove_fqdn} on every backend holding the FQDN
+
+        @return: if cascading, the C{list} of L{RecordRow} removed from all of them
+        """
+
+        backends = self._get_backends_with_fqdn(fqdn)
+        if not backends:
+            raise PowergloveFqdnNotFoundError('No records associated with '
+                                              'fully-qualified-domain-name:'
+                                              '{0}', fqdn)
+
+        removed = []
+        for backend in backends:
+            rows = backend.remove_fqdn(fqdn, cascade=cascade)
+            if cascade:
+                removed.extend(rows)
+        if cascade:
+            return removed
@@ -1,13 +1,19 @@
+import collections
+
 from datetime import datetime
 
 from copy import deepcopy
 
-from sqlalchemy import Column, VARCHAR, TEXT, INT, SMALLINT
+from sqlalchemy import Column, Index, VARCHAR, TEXT, INT, SMALLINT, BIGINT
 from sqlalchemy.ext.declarative import declarative_base
 
 
 Base = declarative_base()
 
+# tables that belong to Powerglove itself rather than to the Power DNS schema; these are
+# kept on their own metadata so they are only ever created on request
+PowergloveBase = declarative_base()
+
 class ReprMixin(object):
     key_order = None
     def __repr__(self):
@@ -46,6 +52,19 @@ class Record(Base, ReprMixin):
         return '<%s(%s: Name: %s <=> Content: %s)>' % (self.__class__.__name__, self.type, self.name, self.content)
 
 
+# a plain, read-only copy of a record's columns, for when the ORM object isn't needed
+RecordRow = collections.namedtuple('RecordRow', Record.key_order)
+
+# indexes Powerglove adds to the Power DNS tables (see PowergloveDns.create_indexes); those with
+# 'dialects' in their info are only needed for those databases
+powerglove_indexes = (
+    Index('powerglove_records_change_date', Record.change_date),
+    # PostgreSQL only uses an index for LIKE 'prefix%' searches with the pattern operators
+    Index('powerglove_records_name_pattern', Record.name, Record.id,
+          postgresql_ops={'name': 'text_pattern_ops'}, info={'dialects': ('postgresql',)}),
+)
+
+
 class Domain(Base, ReprMixin):
     __tablename__ = 'domains'
     
@@ -68,24 +87,13 @@ class Domain(Base, ReprMixin):
 
     def touch_serial(self):
 
-        today = "{0:%Y}{0:%m}{0:%d}".format(datetime.utcnow())
-
-        if not self.notified_serial:
-            increment = 0
-        else:
-            # https://github.com/appliedsec/Powerglove-DNS/issues/3
-            last_day, increment = str(self.notified_serial)[:-2], str(self.notified_serial)[-2:]
-            if today == last_day:
-                # same day update, increment the serial
-                increment = int(increment)
-            else:
-                increment = 0
-
-        new_serial = "{0}{1:02d}".format(today, increment + 1)
-        assert len(new_serial) == 10
-
-        self.notified_serial = int(new_serial)
+        first_of_today = int("{0:%Y}{0:%m}{0:%d}00".format(datetime.utcnow()))
 
+        # https://github.com/appliedsec/Powerglove-DNS/issues/3
+        # serials are YYYYMMDDnn, but a serial must never go backwards: once a day's 99 changes
+        # are used up, keep counting upwards into the following day's range, which the date
+        # based serial catches back up with once that day arrives
+        self.notified_serial = max(first_of_today + 1, (self.notified_serial or 0) + 1)
 
     def __repr__(self):
         return '<%s(%s)>' % (self.__class__.__name__, self.name )
@@ -210,3 +218,61 @@ class PermTemplateItem(Base, ReprMixin):
         self.id = id
         self.templ_id = templ_id
         self.perm_id = perm_id
+
+
+class RecordIpIndex(PowergloveBase, ReprMixin):
+    """
+    Side index mapping an A record id to its address encoded as an integer, so that range
+    and gap queries can be answered by the database
+    """
+    __tablename__ = 'powerglove_ip_index'
+
+    record_id = Column('record_id', INT, primary_key=True, autoincrement=False)
+    ip = Column('ip', BIGINT, nullable=False, index=True)
+
+    def __init__(self, record_id, ip):
+        self.record_id = record_id
+        self.ip = ip
+
+    def __repr__(self):
+        return '<%s(%s: %s)>' % (self.__class__.__name__, self.record_id, self.ip)
+
+
+class RecordExpiry(PowergloveBase, ReprMixin):
+    """
+    Side table holding when an A record reserved with an expiry should be removed, indexed by
+    that time so that expired reservations are found without scanning the records. The record's
+    name is kept too, as its id may be reused (e.g. by SQLite) once the record is removed by
+    other means, and only an A record that still has the name is removed
+    """
+    __tablename__ = 'powerglove_expiries'
+
+    record_id = Column('record_id', INT, primary_key=True, autoincrement=False)
+    name = Column('name', VARCHAR(255), nullable=False)
+    expires = Column('expires', INT, nullable=False, index=True)
+
+    def __init__(self, record_id, name, expires):
+        self.record_id = record_id
+        self.name = name
+        self.expires = expires
+
+    def __repr__(self):
+        return '<%s(%s %s: %s)>' % (self.__class__.__name__, self.record_id, self.name, self.expires)
+
+
+class SubnetUsage(PowergloveBase, ReprMixin):
+    """
+    Summary of the side index holding the number of A records within each /24 subnet, keyed by
+    the subnet's address shifted right by 8 bits, so that allocation can skip full subnets
+    """
+    __tablename__ = 'powerglove_subnet_usage'
+
+    subnet = Column('subnet', BIGINT, primary_key=True, autoincrement=False)
+    used = Column('used', INT, nullable=False)
+
+    def __init__(self, subnet, used):
+        self.subnet = subnet
+        self.used = used
+
+    def __repr__(self):
+        return '<%s(%s: %s)>' % (self.__class__.__name__, self.subnet, self.used)
@@ -1,19 +1,80 @@
+import bisect
+import collections
+import contextlib
+import functools
 import itertools
 import os
 import logging
 import logging.config
+import math
+import random
+import string
 import time
 
 import configobj
 import netaddr
 import sqlalchemy
 
+from sqlalchemy import and_, bindparam, event, func, or_, select
+from sqlalchemy.ext import baked
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
 from netaddr import IPAddress
 
-from model import Record, Domain
+from model import (Record, RecordRow, Domain, RecordExpiry, RecordIpIndex, SubnetUsage,
+                   powerglove_indexes)
+
+
+# the record types Powerglove looks up
+record_types = frozenset(('A', 'PTR', 'SOA', 'CNAME', 'TXT'))
+
+# caches the hot lookups' queries, compiled SQL included, by their shape; the values looked up
+# are bound as parameters
+bakery = baked.bakery()
+
+
+def _column_equals(column):
+    """
+    @return: a baked query step filtering on the provided L{Record} column, whose value is bound
+        as the parameter of the same name
+    """
+    return lambda query: query.filter(getattr(Record, column) == bindparam(column))
+
+
+def chunked(items, chunk_size):
+    """
+    split the provided items into lists of at most chunk_size, e.g. to keep IN queries within
+    the database's limit on bound parameters
+
+    @param items: the iterable of items to split
+    @param chunk_size: the maximum C{int} length of each chunk
+    @return: generator of C{list}s
+    """
+
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_duration(duration):
+    """
+    @param duration: a number of seconds, optionally followed by a unit of s, m, h, d or w
+        (e.g. C{90}, C{30m}, C{4h}, C{2w})
+    @return: the C{int} number of seconds
+    """
+
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+    duration = str(duration).strip().lower()
+    multiplier = units.get(duration[-1:], None)
+    number = duration[:-1] if multiplier else duration
+    if not number.isdigit():
+        raise PowergloveError('unable to parse the duration {0!r}, expected e.g. 90, 30m, 4h or 2d',
+                              duration)
+    return int(number) * (multiplier or 1)
 
 
 class PowergloveError(Exception):
@@ -40,6 +101,604 @@ class PowergloveFqdnNotFoundError(PowergloveError):
     """
 
 
+class IpOwnership(collections.namedtuple('IpOwnership', 'ip a_names ptr_names')):
+    """
+    The result of looking up who owns an address: the names of the A records holding it, and
+    the names its PTR records point to
+    """
+
+    @property
+    def mismatched(self):
+        """
+        @return: C{True} if the A and PTR records for the address don't agree
+        """
+        return set(self.a_names) != set(self.ptr_names)
+
+
+class SerialUpdateScheduler(object):
+    """
+    Collects the domains touched by record changes so that each domain's serial is bumped (and
+    its zone transferred) once per flush rather than once per change.
+
+    By default every change is due for a flush as soon as it is committed; given a window (in
+    seconds) and/or a batch size (in changes), touched domains accumulate until either is
+    reached, or until L{PowergloveDns.flush_serials} is called. Updates still pending are lost
+    unless L{PowergloveDns.close} (or C{flush_serials}) is called before exiting.
+    """
+
+    def __init__(self, window=None, batch_size=None, clock=time.time):
+        """
+        @param window: the minimum number of seconds between serial flushes
+        @type window: C{float}
+        @param batch_size: the number of changes after which serials are flushed
+        @type batch_size: C{int}
+        @param clock: the callable providing the current time
+        """
+        self.window = window
+        self.batch_size = batch_size
+        self.clock = clock
+
+        self.pending_domain_ids = set()
+        self.changes = 0
+        self.last_flush = clock()
+
+    @property
+    def deferred(self):
+        return self.window is not None or self.batch_size is not None
+
+    def touch(self, domain_id):
+        self.pending_domain_ids.add(domain_id)
+
+    def change_done(self):
+        self.changes += 1
+
+    def is_due(self):
+        """
+        @return: C{True} if the pending serial updates should be applied now
+        """
+        if not self.pending_domain_ids:
+            return False
+        if not self.deferred:
+            return True
+        if self.batch_size is not None and self.changes >= self.batch_size:
+            return True
+        if self.window is not None and self.clock() - self.last_flush >= self.window:
+            return True
+        return False
+
+    def drain(self):
+        """
+        @return: the C{set} of pending domain ids, which are no longer pending
+        """
+        domain_ids, self.pending_domain_ids = self.pending_domain_ids, set()
+        self.changes = 0
+        self.last_flush = self.clock()
+        return domain_ids
+
+    def save_state(self):
+        """
+        @return: an opaque state that L{restore_state} can return the scheduler to
+        """
+        return set(self.pending_domain_ids), self.changes, self.last_flush
+
+    def restore_state(self, state):
+        pending_domain_ids, self.changes, self.last_flush = state
+        self.pending_domain_ids = set(pending_domain_ids)
+
+
+def parse_ip_span(spec):
+    """
+    @param spec: an address, CIDR (e.g. 192.168.132.0/28), IP glob (e.g. 192.168.132.1-9) or
+        start-stop range (e.g. 192.168.132.2-192.168.132.9)
+    @return: C{tuple} consisting of the (first, last) integer addresses of the span
+    """
+
+    try:
+        if '/' in spec:
+            network = netaddr.IPNetwork(spec)
+            return network.first, network.last
+        lower, _, upper = spec.partition('-')
+        if '.' in upper:
+            ip_range = netaddr.IPRange(lower, upper)
+            return ip_range.first, ip_range.last
+        if '*' in spec or '-' in spec:
+            ip_range = netaddr.ip.glob.glob_to_iprange(spec)
+            return ip_range.first, ip_range.last
+        ip = int(IPAddress(spec))
+        return ip, ip
+    except (netaddr.AddrFormatError, ValueError, TypeError):
+        raise PowergloveError('unable to parse {0!r} as an address or range', spec)
+
+
+class ExclusionPolicy(object):
+    """
+    The addresses that are never handed out, compiled once into integers so that the allocator
+    can skip them with integer arithmetic alone.
+
+    By default, addresses whose last octet is 0, 1 or 255 are excluded. An C{[exclusions]}
+    section in the config file changes the excluded last octets and adds a subsection per
+    subnet, for example::
+
+        [exclusions]
+        last_octets = 0, 255
+        [[192.168.134.0/23]]
+        network_broadcast = True
+        gateway_offsets = 1, 2
+        reserved = 192.168.134.10-192.168.134.50, 192.168.135.5
+
+    excludes the subnet's network and broadcast addresses (the default for a listed subnet), the
+    addresses at the given offsets from its network address, and the reserved addresses and
+    ranges (e.g. a DHCP pool).
+    """
+
+    config_section = 'exclusions'
+    default_last_octets = (0, 1, 255)
+
+    def __init__(self, last_octets=default_last_octets, excluded_spans=()):
+        """
+        @param last_octets: the C{int} last octets of the addresses to exclude
+        @param excluded_spans: the (first, last) integer address spans to exclude
+        """
+
+        self.last_octet_mask = 0
+        for octet in last_octets:
+            self.last_octet_mask |= 1 << int(octet)
+        self.allowed_octets = tuple(octet for octet in xrange(256)
+                                    if not self.last_octet_mask >> octet & 1)
+
+        # merged into sorted, disjoint spans so that bisection finds the one to skip
+        self.span_firsts = []
+        self.span_lasts = []
+        for first, last in sorted(excluded_spans):
+            if self.span_lasts and first <= self.span_lasts[-1] + 1:
+                self.span_lasts[-1] = max(self.span_lasts[-1], last)
+            else:
+                self.span_firsts.append(first)
+                self.span_lasts.append(last)
+
+    @classmethod
+    def from_config(cls, config_file):
+        """
+        @param config_file: the config file to read the C{[exclusions]} section from
+        @return: the configured L{ExclusionPolicy}, or the default one if the file or section
+            doesn't exist
+        """
+
+        if config_file is None or not os.path.exists(config_file):
+            return cls()
+
+        section = configobj.ConfigObj(config_file).get(cls.config_section)
+        if not section:
+            return cls()
+
+        def as_list(value):
+            return [value] if isinstance(value, basestring) else list(value)
+
+        last_octets = cls.default_last_octets
+        if 'last_octets' in section:
+            last_octets = [int(octet) for octet in as_list(section['last_octets']) if octet != '']
+
+        excluded_spans = []
+        for subnet in section.sections:
+            subnet_config = section[subnet]
+            try:
+                network = netaddr.IPNetwork(subnet)
+            except (netaddr.AddrFormatError, ValueError):
+                raise PowergloveError('unable to parse exclusions subnet {0!r}', subnet)
+
+            network_broadcast = True
+            if 'network_broadcast' in subnet_config:
+                network_broadcast = subnet_config.as_bool('network_broadcast')
+            if network_broadcast:
+                excluded_spans.extend([(network.first, network.first), (network.last, network.last)])
+
+            for offset in as_list(subnet_config.get('gateway_offsets', [])):
+                if offset != '':
+                    gateway = network.first + int(offset)
+                    excluded_spans.append((gateway, gateway))
+
+            for spec in as_list(subnet_config.get('reserved', [])):
+                if spec != '':
+                    excluded_spans.append(parse_ip_span(spec))
+
+        return cls(last_octets, excluded_spans)
+
+    def is_excluded(self, ip_int):
+        """
+        @param ip_int: the integer address to check
+        @return: C{True} if the address must not be handed out
+        """
+
+        if self.last_octet_mask >> (ip_int & 0xff) & 1:
+            return True
+
+        index = bisect.bisect_right(self.span_firsts, ip_int) - 1
+        return index >= 0 and ip_int <= self.span_lasts[index]
+
+    def iter_allowed(self, first, last):
+        """
+        generates the integer addresses between the provided bounds (inclusive) that aren't
+        excluded, in ascending order
+
+        @param first: the C{int} lowest address to consider
+        @param last: the C{int} highest address to consider
+        """
+
+        span_firsts, span_lasts = self.span_firsts, self.span_lasts
+        index = bisect.bisect_right(span_firsts, first) - 1
+        if index >= 0 and first <= span_lasts[index]:
+            first = span_lasts[index] + 1
+        index += 1
+
+        while first <= last:
+            # the allowed stretch ends where the next excluded span starts
+            stretch_last = last
+            if index < len(span_firsts) and span_firsts[index] <= last:
+                stretch_last = span_firsts[index] - 1
+
+            for ip_int in self._iter_allowed_octets(first, stretch_last):
+                yield ip_int
+
+            if stretch_last == last:
+                return
+            first = span_lasts[index] + 1
+            index += 1
+
+    def count_allowed(self, first, last):
+        """
+        @return: the C{int} number of addresses between the provided bounds (inclusive) that
+            aren't excluded
+        """
+
+        index = bisect.bisect_left(self.span_lasts, first)
+        spanned = index < len(self.span_firsts) and self.span_firsts[index] <= last
+        if not spanned and first & 0xff == 0 and last == first | 0xff:
+            return len(self.allowed_octets)
+        return sum(1 for _ in self.iter_allowed(first, last))
+
+    def _iter_allowed_octets(self, first, last):
+
+        allowed_octets = self.allowed_octets
+        block = first & ~0xff
+        while block <= last:
+            for octet in allowed_octets:
+                ip_int = block | octet
+                if ip_int > last:
+                    return
+                if ip_int >= first:
+                    yield ip_int
+            block += 0x100
+
+
+# the errors that mean a statement lost out to a concurrent one, keyed by PostgreSQL SQLSTATE,
+# MySQL error number or SQLite message
+contention_errors = {
+    '40P01': 'deadlock',
+    '40001': 'serialization',
+    '55P03': 'lock_timeout',
+    '57014': 'statement_timeout',
+    1213: 'deadlock',
+    1205: 'lock_timeout',
+    3024: 'statement_timeout',
+    'database is locked': 'lock_timeout',
+    'database table is locked': 'lock_timeout',
+}
+
+
+def classify_database_error(error):
+    """
+    @param error: the exception raised by the database, either a L{sqlalchemy.exc.DBAPIError} or
+        the DB-API exception it wraps
+    @return: one of C{'deadlock'}, C{'serialization'}, C{'lock_timeout'} or
+        C{'statement_timeout'} if the error was caused by contention, else C{None}
+    """
+
+    original = getattr(error, 'orig', error)
+
+    code = getattr(original, 'pgcode', None)
+    if code is None and original.args and isinstance(original.args[0], (int, long)):
+        code = original.args[0]
+    if code in contention_errors:
+        return contention_errors[code]
+
+    return contention_errors.get(str(original).strip().lower())
+
+
+class RetryPolicy(object):
+    """
+    How long statements may run or wait for locks, and how operations that lose out to a
+    concurrent writer are retried. The top level C{statement_timeout} and C{lock_timeout} (in
+    seconds) and C{retry_attempts} config file settings override the defaults, which don't time
+    out and try each operation up to 5 times.
+
+    Retries back off exponentially from C{base_delay}, up to C{max_delay}, with full jitter so
+    that writers which collided don't collide again. C{counters} keeps count of the retries and
+    of each kind of contention error seen.
+    """
+
+    retried_errors = ('deadlock', 'serialization', 'lock_timeout')
+
+    def __init__(self, statement_timeout=None, lock_timeout=None, attempts=5, base_delay=0.05,
+                 max_delay=2.0, sleep=time.sleep, random=random.random):
+        """
+        @param statement_timeout: the seconds after which a statement is cancelled
+        @param lock_timeout: the seconds after which waiting for a lock is given up
+        @param attempts: the number of times an operation is tried
+        @param base_delay: the seconds to wait, on average, before the first retry
+        @param max_delay: the most seconds to wait before any retry
+        @param sleep: the callable used to wait
+        @param random: the callable returning the random number used for jitter
+        """
+        self.statement_timeout = statement_timeout
+        self.lock_timeout = lock_timeout
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.random = random
+
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_config(cls, config_file):
+        """
+        @param config_file: the config file to read the settings from
+        @return: the configured L{RetryPolicy}
+        """
+
+        if config_file is None or not os.path.exists(config_file):
+            return cls()
+
+        config = configobj.ConfigObj(config_file)
+        kwargs = {}
+        for key, setting, parse in (('statement_timeout', 'statement_timeout', float),
+                                    ('lock_timeout', 'lock_timeout', float),
+                                    ('attempts', 'retry_attempts', int)):
+            if config.get(setting) not in (None, ''):
+                try:
+                    kwargs[key] = parse(config[setting])
+                except ValueError:
+                    raise PowergloveError('invalid {0} {1!r} in {2}', setting, config[setting],
+                                          config_file)
+        return cls(**kwargs)
+
+    def timeout_statements(self, dialect_name):
+        """
+        @param dialect_name: the name of the SQLAlchemy dialect, e.g. C{postgresql}
+        @return: C{list} of the statements that apply the timeouts to a new connection
+        """
+
+        statements = []
+        if dialect_name == 'postgresql':
+            if self.statement_timeout is not None:
+                statements.append('SET statement_timeout = %d' % (self.statement_timeout * 1000))
+            if self.lock_timeout is not None:
+                statements.append('SET lock_timeout = %d' % (self.lock_timeout * 1000))
+        elif dialect_name == 'mysql':
+            if self.statement_timeout is not None:
+                statements.append('SET SESSION max_execution_time = %d' % (self.statement_timeout * 1000))
+            if self.lock_timeout is not None:
+                statements.append('SET SESSION innodb_lock_wait_timeout = %d' %
+                                  max(1, int(math.ceil(self.lock_timeout))))
+        elif dialect_name == 'sqlite':
+            # SQLite has no statement timeout; waiting for the database lock is its only wait
+            if self.lock_timeout is not None:
+                statements.append('PRAGMA busy_timeout = %d' % (self.lock_timeout * 1000))
+        return statements
+
+    def configure_engine(self, engine):
+        """
+        apply the timeouts to every connection the provided engine makes
+        """
+
+        statements = self.timeout_statements(engine.dialect.name)
+        if not statements:
+            return
+
+        def apply_timeouts(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
+            # otherwise the settings go with the implicit transaction when the pool resets it
+            dbapi_connection.commit()
+
+        event.listen(engine, 'connect', apply_timeouts)
+
+    def get_delay(self, attempt):
+        """
+        @param attempt: the number of attempts that have failed so far, from 1
+        @return: the seconds to wait before the next attempt
+        """
+        return self.random() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+    def should_retry(self, error, attempt):
+        """
+        count the provided error and decide whether the operation it broke is tried again
+
+        @param error: the database error that the operation raised
+        @param attempt: the number of attempts that have failed so far, including this one
+        @return: the seconds to wait before trying again, or C{None} to give up
+        """
+
+        kind = classify_database_error(error)
+        if kind is None:
+            return None
+
+        self.counters[kind] += 1
+        # a statement that timed out is as likely to time out again
+        if kind not in self.retried_errors or attempt >= self.attempts:
+            self.counters['gave_up'] += 1
+            return None
+
+        self.counters['retries'] += 1
+        return self.get_delay(attempt)
+
+
+class SqliteSettings(object):
+    """
+    How SQLite databases (Power DNS' gsqlite3 backend) are set up: by default in WAL mode, so
+    that lookups don't block on a writer and commits only need syncing at checkpoints, with
+    C{synchronous=NORMAL} (safe with WAL), a 16MiB page cache and a 5 second busy timeout rather
+    than failing at once with "database is locked". A C{[sqlite]} section in the config file
+    changes them, for example::
+
+        [sqlite]
+        journal_mode = delete
+        synchronous = full
+        cache_size = -64000
+        busy_timeout = 30
+
+    where C{cache_size} is given as SQLite takes it (pages, or KiB if negative), C{busy_timeout}
+    is in seconds and C{default} leaves SQLite's own setting. The top level C{lock_timeout}
+    setting, see L{RetryPolicy}, takes precedence over C{busy_timeout}.
+    """
+
+    config_section = 'sqlite'
+    journal_modes = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+    synchronous_settings = ('off', 'normal', 'full', 'extra')
+
+    def __init__(self, journal_mode='wal', synchronous='normal', cache_size=-16000, busy_timeout=5.0):
+        """
+        @param journal_mode: the C{PRAGMA journal_mode}, or C{None} to leave SQLite's default
+        @param synchronous: the C{PRAGMA synchronous}, or C{None} to leave SQLite's default
+        @param cache_size: the C{PRAGMA cache_size}, or C{None} to leave SQLite's default
+        @param busy_timeout: the seconds to wait for another connection's lock, or C{None} to
+            leave the driver's default
+        """
+
+        if journal_mode is not None and journal_mode.lower() not in self.journal_modes:
+            raise PowergloveError('unknown SQLite journal_mode {0!r}', journal_mode)
+        if synchronous is not None and synchronous.lower() not in self.synchronous_settings:
+            raise PowergloveError('unknown SQLite synchronous setting {0!r}', synchronous)
+
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+
+    @classmethod
+    def from_config(cls, config_file):
+        """
+        @param config_file: the config file to read the C{[sqlite]} section from
+        @return: the configured L{SqliteSettings}, or the default ones if the file or section
+            doesn't exist
+        """
+
+        if config_file is None or not os.path.exists(config_file):
+            return cls()
+
+        section = configobj.ConfigObj(config_file).get(cls.config_section)
+        if not section:
+            return cls()
+
+        kwargs = {}
+        for key, parse in (('journal_mode', str), ('synchronous', str), ('cache_size', int),
+                           ('busy_timeout', float)):
+            if key not in section:
+                continue
+            if section[key].lower() in ('', 'default'):
+                kwargs[key] = None
+                continue
+            try:
+                kwargs[key] = parse(section[key])
+            except ValueError:
+                raise PowergloveError('invalid SQLite {0} {1!r} in {2}', key, section[key], config_file)
+        return cls(**kwargs)
+
+    def pragmas(self):
+        """
+        @return: C{list} of the statements that set up a new SQLite connection
+        """
+
+        pragmas = []
+        # first, so that switching the journal mode waits out other connections
+        if self.busy_timeout is not None:
+            pragmas.append('PRAGMA busy_timeout = %d' % (self.busy_timeout * 1000))
+        if self.journal_mode is not None:
+            pragmas.append('PRAGMA journal_mode = %s' % self.journal_mode.upper())
+        if self.synchronous is not None:
+            pragmas.append('PRAGMA synchronous = %s' % self.synchronous.upper())
+        if self.cache_size is not None:
+            pragmas.append('PRAGMA cache_size = %d' % self.cache_size)
+        return pragmas
+
+    def configure_engine(self, engine):
+        """
+        apply the settings to every connection the provided engine makes, if it's a SQLite one
+        """
+
+        if engine.dialect.name != 'sqlite':
+            return
+
+        pragmas = self.pragmas()
+        if not pragmas:
+            return
+
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+        event.listen(engine, 'connect', apply_pragmas)
+
+
+def retried_on_contention(method):
+    """
+    decorate a L{PowergloveDns} operation so that, if it loses out to a concurrent writer, it is
+    rolled back and tried again from the start, as its L{RetryPolicy} allows. The operation has
+    to be safe to repeat, and is only retried when it isn't part of a larger L{transaction} or
+    retried operation, which is left to retry it as a whole.
+    """
+
+    @functools.wraps(method)
+    def retry(self, *args, **kwargs):
+
+        if self.in_transaction or self._retrying:
+            return method(self, *args, **kwargs)
+
+        attempt = 0
+        self._retrying = True
+        try:
+            while True:
+                scheduler_state = self.serial_scheduler.save_state()
+                try:
+                    return method(self, *args, **kwargs)
+                except sqlalchemy.exc.DBAPIError as error:
+                    attempt += 1
+                    self.session.rollback()
+                    self._domain_cache = None
+                    self.serial_scheduler.restore_state(scheduler_state)
+
+                    delay = self.retry_policy.should_retry(error, attempt)
+                    if delay is None:
+                        raise
+                    self.log.warning('%s lost out to a concurrent change (%s), retrying in %.3fs',
+                                     method.__name__, classify_database_error(error), delay)
+                    self.retry_policy.sleep(delay)
+        finally:
+            self._retrying = False
+            if not self._reading:
+                self.end_read()
+
+    return retry
+
+
+def read_only(method):
+    """
+    decorate a L{PowergloveDns} lookup so that the read replica session's transaction is ended
+    once it's done, see L{PowergloveDns.read_operation}
+    """
+
+    @functools.wraps(method)
+    def read(self, *args, **kwargs):
+        with self.read_operation():
+            return method(self, *args, **kwargs)
+
+    return read
+
+
 class PowergloveDns(object):
     """
     Class for interacting with a Power DNS Database
@@ -48,9 +707,19 @@ class PowergloveDns(object):
     @type def_config_file: C{str}
     """
     def_config_file = os.path.join(os.path.expanduser('~'), '.powergloverc')
-    allowed_configuration_keys = ('pdns_connect_string',)
-
-    def __init__(self, pdns_sqla_url=None, logger=None):
+    allowed_configuration_keys = ('pdns_connect_string', 'pdns_read_connect_string',
+                                  'statement_timeout', 'lock_timeout', 'retry_attempts')
+
+    # set while a L{retried_on_contention} operation runs, so that the operations it calls
+    # leave retrying to it
+    _retrying = False
+    # set within a L{bulk_load} block
+    _bulk_commit_every = None
+    # set within a L{read_operation}, so that the lookups it makes leave ending it to it
+    _reading = False
+
+    def __init__(self, pdns_sqla_url=None, logger=None, serial_window=None, serial_batch=None,
+                 pdns_read_sqla_url=None, retry_policy=None, sqlite_settings=None):
         """
         Initialize the Powerglove DNS object, if session is provided it will be
         used as the instance session. Otherwise, if pdns_sqla_url is
@@ -62,6 +731,17 @@ class PowergloveDns(object):
         @param session: the existing SQL Alchemy Session
         @param self.log: the self.log instance to use, else, a new one
             is created
+        @param serial_window: if provided, domain serials are bumped at most once per this
+            many seconds, see L{SerialUpdateScheduler}
+        @param serial_batch: if provided, domain serials are bumped at most once per this
+            many changes, see L{SerialUpdateScheduler}
+        @param pdns_read_sqla_url: the url for a read replica of the Power DNS installation, used
+            for lookups. If not provided, it is taken from the config file when the main url is
+        @type pdns_read_sqla_url: C{str}
+        @param retry_policy: the timeouts and retries to use, see L{RetryPolicy}; if not
+            provided, they're taken from the config file
+        @param sqlite_settings: how SQLite databases are set up, see L{SqliteSettings}; if not
+            provided, it's taken from the config file
         """
 
         if logger is None:
@@ -69,7 +749,17 @@ class PowergloveDns(object):
         else:
             self.log = logger
 
-        self._setup_sqlalchemy_session(pdns_sqla_url, self.def_config_file)
+        self.serial_scheduler = SerialUpdateScheduler(serial_window, serial_batch)
+        self._transaction_depth = 0
+        if retry_policy is None:
+            retry_policy = RetryPolicy.from_config(self.def_config_file)
+        self.retry_policy = retry_policy
+        if sqlite_settings is None:
+            sqlite_settings = SqliteSettings.from_config(self.def_config_file)
+        self.sqlite_settings = sqlite_settings
+
+        self._setup_sqlalchemy_session(pdns_sqla_url, self.def_config_file, pdns_read_sqla_url)
+        self.exclusions = ExclusionPolicy.from_config(self.def_config_file)
 
     @classmethod
     def set_config(cls, key, value, config_file=None):
@@ -85,7 +775,10 @@ class PowergloveDns(object):
         config[key] = value
         config.write()
 
-    def _setup_sqlalchemy_session(self, pdns_sqla_url, config_file):
+    def _setup_sqlalchemy_session(self, pdns_sqla_url, config_file, pdns_read_sqla_url=None):
+
+        if pdns_read_sqla_url:
+            self.sqla_read_session_obj = pdns_read_sqla_url
 
         if pdns_sqla_url:
             self.sqla_session_obj = pdns_sqla_url
@@ -107,6 +800,10 @@ class PowergloveDns(object):
             self.log.error('unknown error getting a SQL-Alchemy session with %r', pdns_sqla_url)
             raise
 
+        # a replica in the config file only goes with the config file's main connection
+        if not pdns_read_sqla_url and config.get('pdns_read_connect_string'):
+            self.sqla_read_session_obj = config['pdns_read_connect_string']
+
     @property
     def sqla_session_obj(self):
         """
@@ -125,8 +822,32 @@ class PowergloveDns(object):
         @type url: C{str}
         """
         self._sqla_engine = sqlalchemy.create_engine(url)
+        self.sqlite_settings.configure_engine(self._sqla_engine)
+        self.retry_policy.configure_engine(self._sqla_engine)
         self._session_obj = sessionmaker(bind=self._sqla_engine)
 
+    @property
+    def sqla_read_session_obj(self):
+        """
+        get the session object for the read replica, if one was set up
+        @return: L{sqlalchemy.Session} or C{None}
+        """
+
+        return getattr(self, '_read_session_obj', None)
+
+    @sqla_read_session_obj.setter
+    def sqla_read_session_obj(self, url):
+        """
+        set the read replica session object using the provided URL
+
+        @param url: the SQLAlchemy url that the replica engine will be created with
+        @type url: C{str}
+        """
+        self._sqla_read_engine = sqlalchemy.create_engine(url)
+        self.sqlite_settings.configure_engine(self._sqla_read_engine)
+        self.retry_policy.configure_engine(self._sqla_read_engine)
+        self._read_session_obj = sessionmaker(bind=self._sqla_read_engine)
+
     @property
     def session(self):
         """
@@ -139,14 +860,190 @@ class PowergloveDns(object):
 
         return self._session
 
+    @property
+    def read_session(self):
+        """
+        Return the session to use for lookups: the read replica session if a replica is set up,
+        otherwise (or while a L{transaction} is open, so that it sees its own changes) the
+        main session
+
+        @return: the session instance
+        """
+        if self.sqla_read_session_obj is None or self.in_transaction:
+            return self.session
+
+        if not hasattr(self, '_read_session'):
+            self._read_session = self.sqla_read_session_obj()
+
+        return self._read_session
+
+    def end_read(self):
+        """
+        end the read replica session's transaction and release its connection, so that later
+        lookups see the replica as it is then, rather than an old snapshot of it or the objects
+        earlier lookups left in the session; objects already looked up stay usable, detached.
+        Nothing is done without a replica, or while a L{transaction} is open
+        """
+
+        if self.in_transaction or getattr(self, '_read_session', None) is None:
+            return
+        self._read_session.close()
+
+    @contextlib.contextmanager
+    def read_operation(self):
+        """
+        Group lookups so that they share one read replica transaction, which is ended once the
+        outermost group (or retried operation, see L{retried_on_contention}) is done, see
+        L{end_read}::
+
+            with pdns.read_operation():
+                rows, cursor = pdns.changes_since(cursor)
+                count = pdns.count_records()
+
+        @return: a context manager yielding this instance
+        """
+
+        if self._reading or self._retrying:
+            yield self
+            return
+
+        self._reading = True
+        try:
+            yield self
+        finally:
+            self._reading = False
+            self.end_read()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group changes into a single unit of work. Within the block, changes are flushed rather
+        than committed (so later operations in the block see them), domains are only loaded
+        once, and each changed domain's serial is bumped once; the whole block is then committed
+        on exit, or rolled back if it raises. Nested blocks join the outermost one::
+
+            with pdns.transaction():
+                pdns.add_a_record('one.stable.tld', ('192.168.134.0/24',))
+                pdns.add_cname_record('alias.stable.tld', 'one.stable.tld')
+
+        @return: a context manager yielding this instance
+        """
+
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield self
+            finally:
+                self._transaction_depth -= 1
+            self._bulk_checkpoint()
+            return
+
+        scheduler_state = self.serial_scheduler.save_state()
+        self._transaction_depth = 1
+        try:
+            yield self
+        except:
+            self._transaction_depth = 0
+            self._domain_cache = None
+            self.session.rollback()
+            self.serial_scheduler.restore_state(scheduler_state)
+            raise
+        else:
+            self._transaction_depth = 0
+            self._domain_cache = None
+            self._commit()
+
+    @contextlib.contextmanager
+    def bulk_load(self, commit_every=1000):
+        """
+        Like L{transaction}, but for imports too big to hold in one: the changes made in the
+        block are committed every C{commit_every} operations, each commit bumping the serial of
+        the domains changed since the last one, rather than one at a time::
+
+            with pdns.bulk_load():
+                for fqdn in fqdns:
+                    pdns.add_a_record(fqdn, ('192.168.134.0/24',))
+
+        If the block raises, only the changes since the last commit are rolled back.
+
+        @param commit_every: the C{int} number of operations to commit at a time
+        @return: a context manager yielding this instance
+        @raise PowergloveError: if a transaction is already open
+        """
+
+        if self.in_transaction:
+            raise PowergloveError('a bulk load can\'t be part of a transaction')
+
+        self._bulk_commit_every = commit_every
+        self._bulk_operations = 0
+        self._bulk_scheduler_state = self.serial_scheduler.save_state()
+        self._transaction_depth = 1
+        try:
+            yield self
+        except:
+            self._transaction_depth = 0
+            self._domain_cache = None
+            self.session.rollback()
+            self.serial_scheduler.restore_state(self._bulk_scheduler_state)
+            raise
+        else:
+            self._transaction_depth = 0
+            self._domain_cache = None
+            self._commit()
+        finally:
+            self._bulk_commit_every = None
+
+    def _bulk_checkpoint(self):
+        """
+        count an operation done directly within a L{bulk_load} block, committing once there
+        have been enough of them
+        """
+
+        if self._bulk_commit_every is None or self._transaction_depth != 1:
+            return
+
+        self._bulk_operations += 1
+        if self._bulk_operations < self._bulk_commit_every:
+            return
+
+        self._transaction_depth = 0
+        try:
+            self._commit()
+        finally:
+            self._transaction_depth = 1
+        self._domain_cache = None
+        self._bulk_scheduler_state = self.serial_scheduler.save_state()
+        self.log.debug('bulk load committed %d operations', self._bulk_operations)
+        self._bulk_operations = 0
+
+    @property
+    def in_transaction(self):
+        return bool(self._transaction_depth)
+
+    @property
+    def contention_counters(self):
+        """
+        @return: C{dict} counting the retries and each kind of contention error (deadlocks,
+            serialization failures, lock and statement timeouts) seen so far, see L{RetryPolicy}
+        """
+        return dict(self.retry_policy.counters)
+
     @property
     def domains(self):
         """
         @return: a C{dict} mapping the domain name
         """
 
+        if self.in_transaction:
+            if not getattr(self, '_domain_cache', None):
+                self._domain_cache = self._load_domains(self.session)
+            return self._domain_cache
+
+        return self._load_domains(self.read_session)
+
+    def _load_domains(self, session):
         return dict([(record.name, record)
-                     for record in self.session.query(Domain).all()])
+                     for record in bakery(lambda session: session.query(Domain))(session).all()])
 
     @property
     def a_domains(self):
@@ -154,199 +1051,1013 @@ class PowergloveDns(object):
         @return: a C{dict} mapping the A domain name to the domain
         """
 
-        return dict([(dom_name, dom) for dom_name, dom in self.domains.items()
-                     if not dom_name.endswith('.in-addr.arpa')])
+        return dict([(dom_name, dom) for dom_name, dom in self.domains.items()
+                     if not dom_name.endswith('.in-addr.arpa')])
+
+    @property
+    def ptr_domains(self):
+        """
+        @return: a C{dict} mapping the PTR domain name to the domain
+        """
+
+        return dict([(dom_name, dom) for dom_name, dom in self.domains.items()
+                     if dom_name.endswith('.in-addr.arpa')])
+
+    def _query_records(self, rec_type, criteria, session=None):
+        """
+        @param rec_type: the type of the records to query
+        @param criteria: C{dict} of the column values the records must have
+        @param session: the session to query with, defaults to the main session
+        @return: the baked query of the matching L{Record}s, see L{bakery}
+        """
+
+        if rec_type not in record_types:
+            raise PowergloveError('invalid record type {0} specified',
+                                    rec_type)
+
+        query = bakery(lambda session: session.query(Record).filter(Record.type == bindparam('type')))
+        for column in sorted(criteria):
+            query.add_criteria(_column_equals(column), column)
+
+        if session is None:
+            session = self.session
+        return query(session).params(type=rec_type, **criteria)
+
+    def get_existing_records(self, rec_type='A', **criteria):
+        try:
+            return self._query_records(rec_type, criteria).all()
+        except NoResultFound:
+            return []
+
+    def get_record(self, rec_type='A', **criteria):
+        try:
+            return self._query_records(rec_type, criteria).one()
+        except NoResultFound:
+            return None
+
+    def get_records(self, rec_type='A', **criteria):
+        return self._query_records(rec_type, criteria).all()
+
+    def scan_records(self, columns=('content',), rec_type='A', session=None, **criteria):
+        """
+        Read-only fast path for scanning many records: only the requested columns are selected,
+        through SQLAlchemy Core, so no ORM objects (or their identity map and instance state) are
+        built. Used by all of the internal scans.
+
+        @param columns: the names of the L{Record} columns to select
+        @param rec_type: the record type, or a C{tuple} of them, to scan
+        @param session: the session to scan with, defaults to the L{read_session}
+        @param criteria: further column values that the records must have
+        @return: iterator of row tuples, in the order of the requested columns
+        """
+
+        rec_types = (rec_type,) if isinstance(rec_type, basestring) else tuple(rec_type)
+        for scanned_type in rec_types:
+            if scanned_type not in record_types:
+                raise PowergloveError('invalid record type {0} specified',
+                                      scanned_type)
+
+        table_columns = Record.__table__.c
+        query = select([table_columns[column] for column in columns])
+        if len(rec_types) == 1:
+            query = query.where(table_columns.type == rec_types[0])
+        else:
+            query = query.where(table_columns.type.in_(rec_types))
+        for column, value in criteria.items():
+            query = query.where(table_columns[column] == value)
+
+        if session is None:
+            session = self.read_session
+        return iter(session.execute(query))
+
+    def _get_closest_domain_match_from_string(self, record_string, domains):
+        """
+        convenience function for finding the closest matching domain for a string record (a more specific domain wins
+        if more than one domain matches
+
+        @param record_string:
+        @param domains:
+        @return:
+        """
+
+        def _split_reverse(dot_delimited_string):
+            return tuple(reversed(dot_delimited_string.split('.')))
+
+        record_string_parts = _split_reverse(record_string)
+
+        inferred_domain = None
+        max_matches = 0
+        for name, domain in domains.iteritems():
+            matches = 0
+            complete_match = True
+            domain_parts = _split_reverse(name)
+            for domain_part, record_name_part in zip(domain_parts, record_string_parts):
+                if domain_part == record_name_part:
+                    matches += 1
+                else:
+                    complete_match = False
+            if matches > max_matches and complete_match:
+                max_matches = matches
+                inferred_domain = domain
+
+        if inferred_domain:
+            return inferred_domain
+        else:
+            raise PowergloveError('unable to get a domain from associated string: %r' % record_string)
+
+    def get_ptr_domain_from_ptr_record_name(self, ptr_name):
+        """
+
+        @param ptr_name: the PTR record name to get a domain from
+        @return: the associated Domain as a C{Domain} as determined based on the PTR record name
+        """
+
+        return self._get_closest_domain_match_from_string(ptr_name, self.ptr_domains)
+
+
+    def get_a_domain_from_fqdn(self, fqdn):
+        """
+
+        @param fqdn: the C{str} fully-qualified domain name
+        @return: the associated Domain as a C{Domain} as determined based on the FQDN
+        """
+
+        return self._get_closest_domain_match_from_string(fqdn, self.a_domains)
+
+    def update_domain_serial(self, domain_id):
+        """
+        mark the provided domain as changed; its serial is bumped when the change is committed,
+        or later if the serial scheduler is deferring updates
+
+        @param domain_id: the id of the changed domain
+        """
+
+        self.serial_scheduler.touch(domain_id)
+
+    def _bump_serials(self, domain_ids):
+        """
+        touch the serial of each of the provided domains, in id order to keep lock ordering
+        consistent between concurrent writers
+
+        @param domain_ids: the ids of the domains to update
+        """
+
+        if not domain_ids:
+            return
+
+        query = bakery(lambda session: session.query(Domain).filter(
+            Domain.id.in_(bindparam('domain_ids', expanding=True))).order_by(Domain.id))
+        for domain in query(self.session).params(domain_ids=sorted(domain_ids)):
+            domain.touch_serial()
+            self.log.debug('updated serial for %r', domain)
+
+    def _commit(self):
+        """
+        commit the session along with any serial updates that are due, unless a
+        L{transaction} is open, in which case the session is only flushed
+        """
+
+        if self.in_transaction:
+            self.session.flush()
+            self._bulk_checkpoint()
+            return
+
+        if self.serial_scheduler.is_due():
+            self._bump_serials(self.serial_scheduler.drain())
+        self.session.commit()
+
+    def _commit_change(self):
+        """
+        commit a change to the records, see L{_commit}
+        """
+
+        self.serial_scheduler.change_done()
+        self._commit()
+
+    def flush_serials(self):
+        """
+        bump the serials of every domain changed since the last serial update; needed before
+        exiting when the serial scheduler is deferring updates
+        """
+
+        self._bump_serials(self.serial_scheduler.drain())
+        self._commit()
+
+    def close(self):
+        """
+        bump the serials still pending, if the serial scheduler is deferring updates, and release
+        the sessions' connections; call before exiting
+        """
+
+        try:
+            if self.serial_scheduler.pending_domain_ids:
+                # nothing uncommitted goes along with the serials
+                self.session.rollback()
+                self.flush_serials()
+        finally:
+            self.session.close()
+            if self.read_session is not self.session:
+                self.read_session.close()
+
+    def reverse_ip_to_ptr_record(self, ip_address):
+        if isinstance(ip_address, IPAddress):
+            ip = ip_address
+        else:
+            ip = IPAddress(ip_address)
+
+        return str(ip.reverse_dns).rstrip('.') #the trailing period is not included in the power DNS PTR records
+
+    @retried_on_contention
+    def remove_fqdn(self, fqdn, cascade=False):
+        """
+        Remove the records associated with the provided hostname:
+        - if the record is a CNAME, remove the CNAME and TXT records
+        - if the record is an A, remove the TXT, PTR, and A records
+
+        @param fqdn: the fully-qualified-domain for the records to remove
+        @param cascade: if True, also remove every CNAME pointing at the
+            hostname (or at those CNAMEs, and so on), see L{_remove_cascade}
+        @return: if cascading, the C{list} of removed L{RecordRow}
+        @raise PowergloveFqdnNotFoundError: if the FQDN does not match up
+            either an A or CNAME record
+        """
+
+        if cascade:
+            return self._remove_cascade(fqdn)
+
+        a_record = self.get_record(name=fqdn)
+        cname_record = self.get_record('CNAME', name=fqdn)
+
+        if a_record:
+            return self._remove_a_record(a_record)
+        elif cname_record:
+            return self._remove_cname_record(cname_record)
+        else:
+            raise PowergloveFqdnNotFoundError('No records associated with '
+                                              'fully-qualified-domain-name:'
+                                              '{0}', fqdn)
+
+    def _remove_cascade(self, fqdn, chunk_size=500):
+        """
+        Remove the hostname along with the chain of CNAMEs pointing at it, to any depth, and
+        the TXT and PTR records of all of them. The chain is found with one set-based query per
+        level, and everything is deleted with bulk statements in a single transaction, bumping
+        each affected domain's serial once.
+
+        @param fqdn: the fully-qualified-domain for the records to remove
+        @param chunk_size: the number of names or ids per statement
+        @return: the C{list} of removed L{RecordRow}
+        """
+
+        if not self.fqdn_is_present(fqdn, self.session):
+            raise PowergloveFqdnNotFoundError('No records associated with '
+                                              'fully-qualified-domain-name:'
+                                              '{0}', fqdn)
+
+        columns = Record.__table__.c
+        names = set([fqdn])
+        level = set([fqdn])
+        while level:
+            aliases = set()
+            for chunk in chunked(level, chunk_size):
+                aliases.update(name for name, in self.session.query(Record.name).filter(
+                    Record.type == 'CNAME', Record.content.in_(chunk)))
+            level = aliases - names
+            names.update(level)
+
+        with self.transaction():
+            removed = []
+            for chunk in chunked(names, chunk_size):
+                query = self._select_record_rows().where(or_(
+                    and_(columns.name.in_(chunk), columns.type.in_(('A', 'CNAME', 'TXT'))),
+                    and_(columns.content.in_(chunk), columns.type == 'PTR')))
+                removed.extend(RecordRow(*row) for row in self.session.execute(query))
+
+            removed_ids = [row.id for row in removed]
+            for chunk in chunked(removed_ids, chunk_size):
+                self.session.execute(Record.__table__.delete().where(columns.id.in_(chunk)))
+                if self.expiries_enabled:
+                    self.session.execute(RecordExpiry.__table__.delete().where(
+                        RecordExpiry.__table__.c.record_id.in_(chunk)))
+            self._unindex_record_ids(removed_ids, chunk_size)
+
+            for row in removed:
+                self.log.debug('removing %s %s => %s', row.type, row.name, row.content)
+                self.update_domain_serial(row.domain_id)
+            self.serial_scheduler.change_done()
+
+        self.log.info('removed %d records for %s and the %d aliases of it',
+                      len(removed), fqdn, len(names) - 1)
+        return removed
+
+    def _remove_cname_record(self, cname_record):
+        """
+        @param cname_record: the CNAME record to remove
+        """
+
+        self.log.info('removing CNAME alias: %s', cname_record)
+        self.update_domain_serial(cname_record.domain_id)
+        self.session.delete(cname_record)
+        self._commit_change()
+
+    def _remove_a_record(self, a_record):
+        """
+        @param a_record: the A record to remove (along with associated records)
+        @raise PowergloveError: If the CNAMES exist for the provided A record
+        """
+
+        cnames = self.get_existing_records(rec_type='CNAME',
+                                           content=a_record.name)
+
+        if cnames:
+            raise PowergloveError('CNAMES exist for the specified FQDN {0}:\n{1}',
+                                  a_record.name,
+                                  ' '.join(cname.name for cname in cnames))
+
+
+        ptr_records = self.get_existing_records(rec_type='PTR',
+                                                content=a_record.name)
+        txt_records = self.get_existing_records(rec_type='TXT',
+                                                name=a_record.name)
+
+
+        self.log.info('removing associated A/PTR/TXT records for FQDN: %s',
+                      a_record.name)
+
+        domain_ids = set([a_record.domain_id])
+        for record in itertools.chain(ptr_records, txt_records):
+            self.log.debug('removing %s', record)
+            domain_ids.add(record.domain_id)
+            self.session.delete(record)
+        for domain_id in domain_ids:
+            self.update_domain_serial(domain_id)
+
+        self._unindex_a_record(a_record)
+        if self.expiries_enabled:
+            self.session.query(RecordExpiry).filter_by(record_id=a_record.id).delete()
+        self.session.delete(a_record)
+        self._commit_change()
+
+    @property
+    def expiries_enabled(self):
+        """
+        whether the expiry side table (see L{RecordExpiry}) exists in the Power DNS database;
+        it is created by the first reservation made with an expiry
+
+        @return: C{bool}
+        """
+        if not hasattr(self, '_expiries_enabled'):
+            self._expiries_enabled = self._sqla_engine.has_table(RecordExpiry.__tablename__)
+
+        return self._expiries_enabled
+
+    def _enable_expiries(self):
+        if not self.expiries_enabled:
+            # on the session's connection, which may already hold SQLite's write lock within a
+            # transaction. SQLite (through the sqlite3 module) and MySQL commit the transaction's
+            # changes so far before a schema change; where the change is transactional instead,
+            # rolling back takes the table with it
+            if self.in_transaction:
+                self.log.warning('creating the expiry table, which may commit the changes made so '
+                                 'far in this transaction')
+            RecordExpiry.__table__.create(bind=self.session.connection(), checkfirst=True)
+            self._expiries_enabled = True
+            event.listen(self.session, 'after_rollback', self._forget_expiries_enabled, once=True)
+
+    def _forget_expiries_enabled(self, session):
+        self.__dict__.pop('_expiries_enabled', None)
+
+    @retried_on_contention
+    def sweep(self, now=None, batch_size=500):
+        """
+        Remove the A records (along with their PTR and TXT records) whose reservations have
+        expired. Expired reservations are read from the expiry index a batch at a time, each
+        batch is removed with bulk statements in its own transaction, and each affected
+        domain's serial is bumped once for the whole sweep. Hosts that CNAMEs point at are left
+        in place, to be retried by the next sweep.
+
+        @param now: the time to sweep as of, defaults to the current time
+        @param batch_size: the number of reservations removed per transaction
+        @return: the C{list} of removed L{RecordRow}
+        """
+
+        if not self.expiries_enabled:
+            return []
+
+        if now is None:
+            now = int(time.time())
+
+        records = Record.__table__
+        expiries = RecordExpiry.__table__
+        removed = []
+        changed_domain_ids = set()
+        last = None
+        try:
+            while True:
+                query = select([expiries.c.expires, expiries.c.record_id, expiries.c.name]).where(
+                    expiries.c.expires <= now)
+                if last is not None:
+                    query = query.where(or_(expiries.c.expires > last[0],
+                                            and_(expiries.c.expires == last[0],
+                                                 expiries.c.record_id > last[1])))
+                batch = self.session.execute(
+                    query.order_by(expiries.c.expires, expiries.c.record_id).limit(batch_size)).fetchall()
+                if not batch:
+                    break
+                last = tuple(batch[-1])[:2]
+
+                with self.transaction():
+                    batch_removed = self._sweep_batch(dict((record_id, name) for _, record_id, name in batch))
+                removed.extend(batch_removed)
+                changed_domain_ids.update(row.domain_id for row in batch_removed)
+
+                if len(batch) < batch_size:
+                    break
+        finally:
+            for domain_id in changed_domain_ids:
+                self.update_domain_serial(domain_id)
+            if changed_domain_ids:
+                self.serial_scheduler.change_done()
+                self.flush_serials()
+
+        self.log.info('swept %d expired records', len(removed))
+        return removed
+
+    def _sweep_batch(self, expired_names):
+        """
+        @param expired_names: C{dict} mapping the ids of the expired A records to their names
+        @return: the C{list} of removed L{RecordRow}
+        """
+
+        columns = Record.__table__.c
+        expiries = RecordExpiry.__table__
+        record_ids = list(expired_names)
+
+        # a record whose name doesn't match has taken the id of one removed some other way
+        a_rows = [row for row in (RecordRow(*row) for row in self.session.execute(
+            self._select_record_rows(('A',)).where(columns.id.in_(record_ids))))
+            if row.name == expired_names[row.id]]
+        names = set(row.name for row in a_rows)
+
+        aliased = set(name for name, in self.session.execute(select([columns.content]).where(
+            and_(columns.type == 'CNAME', columns.content.in_(names)))))
+        kept_ids = set()
+        for row in a_rows:
+            if row.name in aliased:
+                self.log.warning('not removing expired %s, CNAMEs point at it', row.name)
+                kept_ids.add(row.id)
+
+        a_rows = [row for row in a_rows if row.id not in kept_ids]
+        names -= aliased
+        ptr_names = set(self.reverse_ip_to_ptr_record(row.content) for row in a_rows)
+
+        removed = list(a_rows)
+        if names:
+            removed.extend(RecordRow(*row) for row in self.session.execute(
+                self._select_record_rows(('PTR', 'TXT')).where(or_(
+                    and_(columns.type == 'TXT', columns.name.in_(names)),
+                    and_(columns.type == 'PTR', columns.name.in_(ptr_names), columns.content.in_(names))))))
+
+        removed_ids = [row.id for row in removed]
+        if removed_ids:
+            self.session.execute(Record.__table__.delete().where(columns.id.in_(removed_ids)))
+            self._unindex_record_ids(removed_ids)
+
+        # also forgets the expiries of records that have been removed some other way
+        swept_ids = set(record_ids) - kept_ids
+        if swept_ids:
+            self.session.execute(expiries.delete().where(expiries.c.record_id.in_(swept_ids)))
+
+        for row in removed:
+            self.log.debug('sweeping %s %s => %s', row.type, row.name, row.content)
+        return removed
+
+    @property
+    def ip_index_enabled(self):
+        """
+        whether the integer IP side index (see L{RecordIpIndex}) exists in the Power DNS
+        database; it is only used once it has been created with L{rebuild_ip_index}
+
+        @return: C{bool}
+        """
+        if not hasattr(self, '_ip_index_enabled'):
+            self._ip_index_enabled = self._sqla_engine.has_table(RecordIpIndex.__tablename__)
+
+        return self._ip_index_enabled
+
+    def rebuild_ip_index(self):
+        """
+        Create (if needed) and repopulate the integer IP side index from the existing A records.
+        Powerglove keeps the index current for its own writes, so this only needs re-running
+        after records have been changed by other tools
+
+        @return: the number of A records indexed
+        """
+
+        RecordIpIndex.__table__.create(bind=self._sqla_engine, checkfirst=True)
+        self._ip_index_enabled = True
+
+        rows = []
+        for record_id, content in self.scan_records(('id', 'content'), session=self.session):
+            try:
+                rows.append(dict(record_id=record_id, ip=int(IPAddress(content))))
+            except (netaddr.AddrFormatError, ValueError):
+                self.log.warning('not indexing A record %s with unparseable content %r', record_id, content)
+
+        self.session.execute(RecordIpIndex.__table__.delete())
+        if rows:
+            self.session.execute(RecordIpIndex.__table__.insert(), rows)
+        if self.subnet_usage_enabled:
+            self._fill_subnet_usage(row['ip'] for row in rows)
+        self._commit()
+
+        self.log.info('indexed %d A records', len(rows))
+        return len(rows)
+
+    def _index_a_record(self, a_record):
+        """
+        add the provided A record to the IP side index, if it's in use
+
+        @param a_record: the A record that has been added to the session
+        """
+        if self.ip_index_enabled:
+            # the record's id is needed for the index row
+            self.session.flush()
+            ip = int(IPAddress(a_record.content))
+            self.session.add(RecordIpIndex(a_record.id, ip))
+            self._adjust_subnet_usage([(ip, 1)])
+
+    def _unindex_a_record(self, a_record):
+        """
+        remove the provided A record from the IP side index, if it's in use
+
+        @param a_record: the A record that is being removed
+        """
+        self._unindex_record_ids([a_record.id])
+
+    def _unindex_record_ids(self, record_ids, chunk_size=500):
+        """
+        remove the provided records from the IP side index, if it's in use, taking the addresses
+        they were indexed by off the per-/24 summary; records that were never indexed (such as
+        those added by other tools since the index was built) were never counted either
+
+        @param record_ids: the ids of the removed or changed records, of any type
+        @param chunk_size: the number of ids removed per statement
+        """
+
+        if not self.ip_index_enabled:
+            return
+
+        ip_index = RecordIpIndex.__table__
+        ip_changes = []
+        for chunk in chunked(record_ids, chunk_size):
+            indexed = ip_index.c.record_id.in_(chunk)
+            if self.subnet_usage_enabled:
+                ip_changes.extend((ip, -1) for ip, in self.session.execute(select([ip_index.c.ip]).where(indexed)))
+            self.session.execute(ip_index.delete().where(indexed))
+        self._adjust_subnet_usage(ip_changes)
+
+    @property
+    def subnet_usage_enabled(self):
+        """
+        whether the per-/24 summary of the IP side index (see L{SubnetUsage}) exists in the
+        Power DNS database; it is only used once it has been created with
+        L{rebuild_subnet_usage}
+
+        @return: C{bool}
+        """
+        if not hasattr(self, '_subnet_usage_enabled'):
+            self._subnet_usage_enabled = self._sqla_engine.has_table(SubnetUsage.__tablename__)
+
+        return self._subnet_usage_enabled
+
+    def rebuild_subnet_usage(self):
+        """
+        Create (if needed) and repopulate the per-/24 summary from the IP side index, which is
+        built first if it doesn't exist. Like the index, Powerglove keeps the summary current for
+        its own writes
+
+        @return: the number of /24 subnets holding A records
+        """
+
+        if not self.ip_index_enabled:
+            self.rebuild_ip_index()
+
+        SubnetUsage.__table__.create(bind=self._sqla_engine, checkfirst=True)
+        self._subnet_usage_enabled = True
+
+        subnet_count = self._fill_subnet_usage(
+            ip for ip, in self.session.execute(select([RecordIpIndex.__table__.c.ip])))
+        self._commit()
+
+        self.log.info('summarized the A records of %d subnets', subnet_count)
+        return subnet_count
+
+    def _fill_subnet_usage(self, ips):
+        """
+        replace the per-/24 summary with the counts of the provided addresses
+
+        @param ips: the C{int} addresses of every indexed A record
+        @return: the number of /24 subnets holding them
+        """
+
+        counts = collections.Counter(ip >> 8 for ip in ips)
+        self.session.execute(SubnetUsage.__table__.delete())
+        for chunk in chunked(sorted(counts.items()), 500):
+            self.session.execute(SubnetUsage.__table__.insert(),
+                                 [dict(subnet=subnet, used=used) for subnet, used in chunk])
+        return len(counts)
 
-    @property
-    def ptr_domains(self):
-        """
-        @return: a C{dict} mapping the PTR domain name to the domain
+    def _adjust_subnet_usage(self, ip_changes):
         """
+        update the per-/24 summary, if it's in use, within the current transaction
 
-        return dict([(dom_name, dom) for dom_name, dom in self.domains.items()
-                     if dom_name.endswith('.in-addr.arpa')])
+        @param ip_changes: the (C{int} address, C{1} or C{-1}) of each A record added to or
+            removed from the IP side index
+        """
 
-    def get_existing_records(self, rec_type='A', **criteria):
-        if rec_type not in ('A', 'PTR', 'SOA', 'CNAME', 'TXT'):
-            raise PowergloveError('invalid record type {0} specified',
-                                    rec_type)
-        try:
-            return self.session.query(Record).filter_by(type=rec_type,
-                                                        **criteria).all()
-        except NoResultFound:
-            return []
+        if not self.subnet_usage_enabled:
+            return
 
-    def get_record(self, rec_type='A', **criteria):
-        if rec_type not in ('A', 'PTR', 'SOA', 'CNAME', 'TXT'):
-            raise PowergloveError('invalid record type {0} specified',
-                                    rec_type)
+        deltas = collections.Counter()
+        for ip, delta in ip_changes:
+            deltas[ip >> 8] += delta
+
+        usage = SubnetUsage.__table__
+        # in subnet order, to keep lock ordering consistent between concurrent writers
+        for subnet, delta in sorted(deltas.items()):
+            if not delta:
+                continue
+            result = self.session.execute(usage.update().where(usage.c.subnet == subnet).values(
+                used=usage.c.used + delta))
+            if not result.rowcount:
+                self.session.execute(usage.insert(), dict(subnet=subnet, used=delta))
+
+    def create_indexes(self):
+        """
+        Create those of the indexes Powerglove adds to the Power DNS tables (see
+        L{model.powerglove_indexes}) that don't exist yet
 
-        try:
-            return self.session.query(Record).filter_by(type=rec_type,
-                                                        **criteria).one()
-        except NoResultFound:
-            return None
+        @return: C{list} of the names of the created indexes
+        """
 
-    def get_records(self, rec_type='A', **criteria):
-        if rec_type not in ('A', 'PTR', 'SOA', 'CNAME', 'TXT'):
-            raise PowergloveError('invalid record type {0} specified',
-                                    rec_type)
+        inspector = sqlalchemy.inspect(self._sqla_engine)
+        created = []
+        for index in powerglove_indexes:
+            if self._sqla_engine.dialect.name not in index.info.get('dialects', (self._sqla_engine.dialect.name,)):
+                continue
+            existing = set(existing_index['name'] for existing_index in inspector.get_indexes(index.table.name))
+            if index.name not in existing:
+                index.create(bind=self._sqla_engine)
+                self.log.info('created index %s on %s', index.name, index.table.name)
+                created.append(index.name)
 
-        return self.session.query(Record).filter_by(type=rec_type,
-                                                    **criteria).all()
+        return created
 
-    def _get_closest_domain_match_from_string(self, record_string, domains):
+    def _select_record_rows(self, types=None):
+        """
+        @param types: if provided, only select records of these types
+        @return: a select of the columns of L{RecordRow}
         """
-        convenience function for finding the closest matching domain for a string record (a more specific domain wins
-        if more than one domain matches
 
-        @param record_string:
-        @param domains:
-        @return:
+        columns = Record.__table__.c
+        query = select([columns[key] for key in RecordRow._fields])
+        if types:
+            query = query.where(columns.type.in_(types))
+        return query
+
+    def _name_matches(self, pattern):
+        """
+        @param pattern: a glob-style name pattern, where C{*} matches any characters and C{?}
+            any single one
+        @return: the SQL clause matching record names against the pattern, bounded by its
+            literal prefix (if any) so that the name index can be used
         """
 
-        def _split_reverse(dot_delimited_string):
-            return tuple(reversed(dot_delimited_string.split('.')))
+        name = Record.__table__.c.name
 
-        record_string_parts = _split_reverse(record_string)
+        like = ''.join({'*': '%', '?': '_', '%': '\\%', '_': '\\_', '\\': '\\\\'}.get(char, char)
+                       for char in pattern)
+        clause = name.like(like, escape='\\')
 
-        inferred_domain = None
-        max_matches = 0
-        for name, domain in domains.iteritems():
-            matches = 0
-            complete_match = True
-            domain_parts = _split_reverse(name)
-            for domain_part, record_name_part in zip(domain_parts, record_string_parts):
-                if domain_part == record_name_part:
-                    matches += 1
-                else:
-                    complete_match = False
-            if matches > max_matches and complete_match:
-                max_matches = matches
-                inferred_domain = domain
+        prefix = pattern
+        for wildcard in '*?':
+            prefix = prefix.split(wildcard)[0]
+        if prefix and self._sqla_engine.dialect.name == 'sqlite':
+            # SQLite's LIKE is case insensitive, so can't use the (case sensitive) name index
+            # without an explicit range; other databases already use an index for a LIKE prefix
+            clause = and_(clause, name >= prefix, name < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
 
-        if inferred_domain:
-            return inferred_domain
-        else:
-            raise PowergloveError('unable to get a domain from associated string: %r' % record_string)
+        return clause
 
-    def get_ptr_domain_from_ptr_record_name(self, ptr_name):
+    def search(self, pattern, types=None, zone=None, page_size=1000):
+        """
+        Generate the records whose names match the provided glob-style pattern (e.g.
+        C{web-*.stable.tld}), ordered by name. Records are read a page at a time, each page
+        continuing from the (name, id) of the last record of the one before, so that memory is
+        bounded and later pages cost the same as the first. The literal prefix of the pattern,
+        if any, bounds the search so that the name index can be used.
+
+        @param pattern: the pattern, where C{*} matches any characters and C{?} any single one
+        @param types: if provided, only records of these types are returned
+        @param zone: if provided, only records in the domain of this name are returned
+        @param page_size: the number of records read per query
+        @return: generator of L{RecordRow}
         """
 
-        @param ptr_name: the PTR record name to get a domain from
-        @return: the associated Domain as a C{Domain} as determined based on the PTR record name
+        columns = Record.__table__.c
+        query = self._select_record_rows(types).where(self._name_matches(pattern))
+
+        if zone is not None:
+            if zone not in self.domains:
+                raise PowergloveError('unknown zone {0}', zone)
+            query = query.where(columns.domain_id == self.domains[zone].id)
+
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.where(or_(columns.name > last.name,
+                                      and_(columns.name == last.name, columns.id > last.id)))
+            page = page.order_by(columns.name, columns.id).limit(page_size)
+
+            count = 0
+            for row in self.read_session.execute(page.execution_options(stream_results=True)):
+                last = RecordRow(*row)
+                count += 1
+                yield last
+
+            if count < page_size:
+                if not (self._reading or self._retrying):
+                    self.end_read()
+                return
+
+    @read_only
+    def changes_since(self, cursor=None, types=None):
+        """
+        Get the records added or changed since the provided cursor, by their change_date. Change
+        dates only have a resolution of a second, so records changed within the cursor's own
+        second are returned again, and should be applied idempotently. Removals can't be seen
+        this way; see L{changes.ChangeFollower} for keeping a copy of the records current.
+
+        @param cursor: the cursor returned by the previous call, or C{None} for every record
+        @param types: if provided, only records of these types are returned
+        @return: C{tuple} consisting of (C{list} of L{RecordRow} in change order, the cursor
+            for the next call)
         """
 
-        return self._get_closest_domain_match_from_string(ptr_name, self.ptr_domains)
+        columns = Record.__table__.c
+        query = self._select_record_rows(types).order_by(columns.change_date, columns.id)
+        if cursor is not None:
+            query = query.where(columns.change_date >= cursor)
 
+        rows = [RecordRow(*row) for row in self.read_session.execute(query)]
+        dated = [row.change_date for row in rows if row.change_date is not None]
+        if dated:
+            cursor = max([cursor or 0] + dated)
+        elif cursor is None:
+            cursor = 0
 
-    def get_a_domain_from_fqdn(self, fqdn):
+        return rows, cursor
+
+    @read_only
+    def count_records(self, types=None):
+        """
+        @param types: if provided, only count records of these types
+        @return: the C{int} number of records
         """
 
-        @param fqdn: the C{str} fully-qualified domain name
-        @return: the associated Domain as a C{Domain} as determined based on the FQDN
+        query = self.read_session.query(func.count(Record.id))
+        if types:
+            query = query.filter(Record.type.in_(types))
+        return query.scalar()
+
+    @read_only
+    def summarize_record_ids(self, types=None):
+        """
+        @param types: if provided, only summarize records of these types
+        @return: C{tuple} consisting of (the number of records, the highest id, the sum of the
+            ids), which changes whenever a record is removed or added, even if both happen
+            between two looks
         """
 
-        return self._get_closest_domain_match_from_string(fqdn, self.a_domains)
+        query = self.read_session.query(func.count(Record.id), func.max(Record.id), func.sum(Record.id))
+        if types:
+            query = query.filter(Record.type.in_(types))
+        count, max_id, id_sum = query.one()
+        return count, max_id, id_sum or 0
 
-    def update_domain_serial(self, domain_id):
+    @read_only
+    def get_record_ids(self, types=None):
+        """
+        @param types: if provided, only get the ids of records of these types
+        @return: C{set} of the record ids
+        """
 
-        domain_to_update = [dom for dom in self.domains.itervalues() if dom.id == domain_id][0]
-        domain_to_update.touch_serial()
-        self.log.debug('updated serial for %r', domain_to_update)
-        self.session.add(domain_to_update)
-        self.session.commit()
+        query = self.read_session.query(Record.id)
+        if types:
+            query = query.filter(Record.type.in_(types))
+        return set(record_id for record_id, in query)
 
-    def reverse_ip_to_ptr_record(self, ip_address):
-        if isinstance(ip_address, IPAddress):
-            ip = ip_address
-        else:
-            ip = IPAddress(ip_address)
+    @read_only
+    def get_record_rows_by_id(self, record_ids, chunk_size=500):
+        """
+        @param record_ids: the ids of the records to get
+        @param chunk_size: the number of ids looked up per query
+        @return: C{list} of L{RecordRow} for the ids that exist
+        """
 
-        return str(ip.reverse_dns).rstrip('.') #the trailing period is not included in the power DNS PTR records
+        rows = []
+        for chunk in chunked(record_ids, chunk_size):
+            query = self._select_record_rows().where(Record.__table__.c.id.in_(chunk))
+            rows.extend(RecordRow(*row) for row in self.read_session.execute(query))
+        return rows
 
-    def remove_fqdn(self, fqdn):
+    @property
+    def zone_pools(self):
         """
-        Remove the records associated with the provided hostname:
-        - if the record is a CNAME, remove the CNAME and TXT records
-        - if the record is an A, remove the TXT, PTR, and A records
+        The default range of each zone, loaded once and kept for the life of this object (see
+        L{refresh_zone_pools}). Pools are read from the C{[pools]} section of the config file,
+        given like the command line's RANGE, for example::
 
-        @param fqdn: the fully-qualified-domain for the records to remove
-        @raise PowergloveFqdnNotFoundError: if the FQDN does not match up
-            either an A or CNAME record
+            [pools]
+            stable.tld = 192.168.134.0/23
+            test.tld = 192.168.132.2, 192.168.133.254
+
+        and zones without a configured pool get one inferred from the C{in-addr.arpa} zones
+        whose PTR records point into them. Allocating only infers the pools it needs, see
+        L{get_zone_pool}.
+
+        @return: C{dict} mapping each zone name to its L{netaddr.IPRange}
         """
 
-        a_record = self.get_record(name=fqdn)
-        cname_record = self.get_record('CNAME', name=fqdn)
+        if not getattr(self, '_zone_pools_inferred', False):
+            self._inferred_zone_pools = self._infer_zone_pools()
+            self._zone_pools_inferred = True
+            self.log.debug('inferred the pools of %d zones', len(self._inferred_zone_pools))
 
-        if a_record:
-            return self._remove_a_record(a_record)
-        elif cname_record:
-            return self._remove_cname_record(cname_record)
-        else:
-            raise PowergloveFqdnNotFoundError('No records associated with '
-                                              'fully-qualified-domain-name:'
-                                              '{0}', fqdn)
+        zone_pools = dict((zone, pool) for zone, pool in self._inferred_zone_pools.items() if pool)
+        zone_pools.update(self.configured_zone_pools)
+        return zone_pools
 
-    def _remove_cname_record(self, cname_record):
+    @property
+    def configured_zone_pools(self):
         """
-        @param cname_record: the CNAME record to remove
+        @return: C{dict} mapping each zone name in the C{[pools]} section of the config file to
+            its L{netaddr.IPRange}, loaded once (see L{refresh_zone_pools})
         """
 
-        self.log.info('removing CNAME alias: %s', cname_record)
-        self.update_domain_serial(cname_record.domain_id)
-        self.session.delete(cname_record)
-        self.session.commit()
+        if getattr(self, '_configured_zone_pools', None) is None:
+            self._configured_zone_pools = self._get_configured_zone_pools()
+        return self._configured_zone_pools
 
-    def _remove_a_record(self, a_record):
+    def refresh_zone_pools(self):
         """
-        @param a_record: the A record to remove (along with associated records)
-        @raise PowergloveError: If the CNAMES exist for the provided A record
+        forget the loaded L{zone_pools}, e.g. after zones or the config file change, so that
+        they are loaded again when next needed
         """
+        self._configured_zone_pools = None
+        self._inferred_zone_pools = {}
+        self._zone_pools_inferred = False
 
-        cnames = self.get_existing_records(rec_type='CNAME',
-                                           content=a_record.name)
+    def get_zone_pool(self, fqdn):
+        """
+        Get the pool of the FQDN's zone, or of the closest enclosing zone that has one (see
+        L{zone_pools}). A configured pool is used without looking at any PTR records; pools are
+        only inferred, once each and most specific first, for those of the FQDN's zones that
+        are more specific than the closest one with a configured pool.
 
-        if cnames:
-            raise PowergloveError('CNAMES exist for the specified FQDN {0}:\n{1}',
-                                  a_record.name,
-                                  ' '.join(cname.name for cname in cnames))
+        @param fqdn: the C{str} fully-qualified domain name
+        @return: the L{netaddr.IPRange} of the pool
+        @raise PowergloveError: if none of the FQDN's zones has a pool
+        """
 
+        def labels(name):
+            return name.split('.')
 
-        ptr_records = self.get_existing_records(rec_type='PTR',
-                                                content=a_record.name)
-        txt_records = self.get_existing_records(rec_type='TXT',
-                                                name=a_record.name)
+        configured = self.configured_zone_pools
+        try:
+            configured_zone = self._get_closest_domain_match_from_string(
+                fqdn, dict((zone, zone) for zone in configured))
+        except PowergloveError:
+            configured_zone = None
+        configured_labels = len(labels(configured_zone)) if configured_zone else 0
+
+        fqdn_labels = labels(fqdn)
+        zones = sorted((zone for zone in self.a_domains
+                        if len(labels(zone)) > configured_labels
+                        and fqdn_labels[-len(labels(zone)):] == labels(zone)),
+                       key=lambda zone: len(labels(zone)), reverse=True)
+
+        if not hasattr(self, '_inferred_zone_pools'):
+            self.refresh_zone_pools()
+        for zone in zones:
+            if zone not in self._inferred_zone_pools:
+                self._inferred_zone_pools[zone] = self._infer_zone_pools([zone]).get(zone)
+            if self._inferred_zone_pools[zone]:
+                return self._inferred_zone_pools[zone]
+        if configured_zone is not None:
+            return configured[configured_zone]
+        raise PowergloveError('unable to find a suitable range for {0}, no pool '
+                              'is known for its zone', fqdn)
+
+    def _get_configured_zone_pools(self):
+
+        if self.def_config_file is None or not os.path.exists(self.def_config_file):
+            return {}
+
+        pools = configobj.ConfigObj(self.def_config_file).get('pools') or {}
+        return dict((zone, self.get_ip_range((pool,) if isinstance(pool, basestring) else tuple(pool)))
+                    for zone, pool in pools.items())
+
+    def _infer_zone_pools(self, zones=None):
+        """
+        infer a pool for each zone from the reverse zones holding PTR records for its names: a
+        reverse zone (e.g. 134.168.192.in-addr.arpa) is credited to the zone most of its PTR
+        records point into, and a zone gets a pool if its reverse zones form one contiguous range
+
+        @param zones: if provided, only infer the pools of these zones, reading only the PTR
+            records of the reverse zones that have any pointing into them
+        @return: C{dict} mapping zone names to their inferred L{netaddr.IPRange}
+        """
 
+        ptr_domains = dict((domain.id, name) for name, domain in self.ptr_domains.items())
+        a_domains = self.a_domains
 
-        self.log.info('removing associated A/PTR/TXT records for FQDN: %s',
-                      a_record.name)
+        if zones is None:
+            rows = self.scan_records(('domain_id', 'content'), 'PTR')
+        else:
+            rows = self._scan_ptr_records_pointing_into(zones)
 
-        domain_ids = set([a_record.domain_id])
-        for record in itertools.chain(ptr_records, txt_records):
-            self.log.debug('removing %s', record)
-            domain_ids.add(record.domain_id)
-            self.session.delete(record)
-        for domain_id in domain_ids:
-            self.update_domain_serial(domain_id)
+        ptr_domain_zones = collections.defaultdict(collections.Counter)
+        for domain_id, content in rows:
+            try:
+                zone = self._get_closest_domain_match_from_string(content, a_domains).name
+            except PowergloveError:
+                continue
+            ptr_domain_zones[domain_id][zone] += 1
+
+        zone_networks = collections.defaultdict(netaddr.IPSet)
+        for domain_id, zones_pointed_into in ptr_domain_zones.items():
+            if domain_id not in ptr_domains:
+                continue
+            octets = ptr_domains[domain_id][:-len('.in-addr.arpa')].split('.')[::-1]
+            if not 1 <= len(octets) <= 4:
+                continue
+            try:
+                network = netaddr.IPNetwork('%s/%d' % ('.'.join(octets + ['0'] * (4 - len(octets))),
+                                                        8 * len(octets)))
+            except (netaddr.AddrFormatError, ValueError):
+                continue
+            zone_networks[zones_pointed_into.most_common(1)[0][0]].add(network)
+
+        zone_pools = {}
+        for zone, networks in zone_networks.items():
+            if zones is not None and zone not in zones:
+                continue
+            ranges = list(networks.iter_ipranges())
+            if len(ranges) == 1:
+                zone_pools[zone] = ranges[0]
+            else:
+                self.log.debug('not inferring a pool for %s, its reverse zones are not contiguous', zone)
+        return zone_pools
 
-        self.session.delete(a_record)
-        self.session.commit()
+    def _scan_ptr_records_pointing_into(self, zones):
+        """
+        @param zones: the names of the zones
+        @return: iterator of the C{(domain_id, content)} of every PTR record in the reverse zones
+            that have any pointing at a name in (or below) the zones
+        """
+
+        columns = Record.__table__.c
+        pointing = select([columns.domain_id]).distinct().where(columns.type == 'PTR').where(
+            or_(*[or_(columns.content == zone, columns.content.like('%.' + zone)) for zone in zones]))
+        domain_ids = [domain_id for domain_id, in self.read_session.execute(pointing)]
+        if not domain_ids:
+            return iter([])
+
+        query = select([columns.domain_id, columns.content]).where(columns.type == 'PTR').where(
+            columns.domain_id.in_(domain_ids))
+        return iter(self.read_session.execute(query))
 
-    def get_ip_range(self, ip_range):
+    @read_only
+    def get_ip_range(self, ip_range, fqdn=None):
         """
         Get an L{netaddr.IPRange} corresponding with the provided range
 
         @param ip_range:
         @type ip_range: C{tuple} of length 0 through 2, all elements must be
             C{str} and will be parsed as IP address, CIDRs, or IPRanges
-        @param domain: If range is length 0, the domain will be used to provide
-            a default range for the given domain (e.g. 'test.tld')
-        @type domain: C{str}
+        @param fqdn: If range is length 0, the pool of the FQDN's zone (see L{get_zone_pool})
+            is used as the range
+        @type fqdn: C{str}
         @return: the L{netaddr.IPRange} associated with the provided range or
             domain
         """
 
+        if ip_range is None:
+            ip_range = ()
+
         if not len(ip_range) <= 2:
             raise PowergloveError('unknown range specified: %r' % ip_range)
 
@@ -365,18 +2076,86 @@ class PowergloveDns(object):
                 raise TypeError('unable to convert %r to IPRange' % _ip)
             else:
                 return netaddr.ip.glob.glob_to_iprange(_ip)
+        elif fqdn is not None:
+            return self.get_zone_pool(fqdn)
         else:
             raise PowergloveError('unable to find a suitable range '
                                     'using {0}', ip_range)
 
     def is_valid_address(self, ip):
-        invalid_last_octet = ('0', '1', '255')
-
-        return not str(ip).split('.')[-1] in invalid_last_octet
+        """
+        @param ip: the address, as a L{netaddr.IPAddress} or a C{str}
+        @return: C{True} if the L{ExclusionPolicy} allows the address to be handed out
+        """
+        return not self.exclusions.is_excluded(int(IPAddress(ip)))
 
     def get_FQDN(self, hostname_prefix, domain):
         return '%s.%s' % (hostname_prefix, domain)
 
+    def _get_names_present(self, names, session, types=None, chunk_size=500):
+        """
+        @param names: the names to look for
+        @param session: the session to look with
+        @param types: if provided, only look for records of these types
+        @return: C{dict} mapping each name that has records to the C{set} of their
+            C{(type, domain_id)}
+        """
+
+        present = collections.defaultdict(set)
+        for chunk in chunked(set(names), chunk_size):
+            query = session.query(Record.name, Record.type, Record.domain_id).filter(Record.name.in_(chunk))
+            if types:
+                query = query.filter(Record.type.in_(types))
+            for name, record_type, domain_id in query:
+                present[name].add((record_type, domain_id))
+        return present
+
+    @retried_on_contention
+    def add_cname_records(self, pairs):
+        """
+        Reserve many aliases at once: every alias and target is checked with a few set-based
+        queries up front, then all of the CNAME records are inserted in one transaction, with
+        each affected domain's serial bumped once
+
+        @param pairs: the C{(CNAME FQDN, A FQDN)} pairs to create
+        @return: C{list} of the created C{(CNAME FQDN, A FQDN)}
+        @raise PowergloveError: if any alias already exists (or is repeated) or any target isn't
+            an existing A record, in which case nothing is created
+        """
+
+        pairs = [tuple(pair) for pair in pairs]
+        cname_fqdns = [cname_fqdn for cname_fqdn, _ in pairs]
+
+        targets = self._get_names_present([a_fqdn for _, a_fqdn in pairs], self.session, types=('A',))
+        missing = sorted(set(a_fqdn for _, a_fqdn in pairs if a_fqdn not in targets))
+        if missing:
+            raise PowergloveError('attempting to create aliases for non-existant FQDNs: {0}',
+                                  ' '.join(missing))
+
+        conflicts = set(self._get_names_present(cname_fqdns, self.session))
+        conflicts.update(cname_fqdn for cname_fqdn, count in collections.Counter(cname_fqdns).items()
+                         if count > 1)
+        if conflicts:
+            raise PowergloveError('aliases already exist (or are repeated): {0}', ' '.join(sorted(conflicts)))
+
+        change_date = int(time.time())
+        rows = []
+        for cname_fqdn, a_fqdn in pairs:
+            _, domain_id = min(targets[a_fqdn])
+            rows.append(dict(name=cname_fqdn, domain_id=domain_id, type='CNAME', content=a_fqdn,
+                             ttl=3600, prio=0, change_date=change_date))
+
+        with self.transaction():
+            for chunk in chunked(rows, 500):
+                self.session.execute(Record.__table__.insert(), chunk)
+            for row in rows:
+                self.update_domain_serial(row['domain_id'])
+            self.serial_scheduler.change_done()
+
+        self.log.info('created %d CNAME aliases', len(rows))
+        return pairs
+
+    @retried_on_contention
     def add_cname_record(self, cname_fqdn, a_fqdn):
         """
         Reserve an alias at the provided FQDN for an existing FQDN
@@ -389,7 +2168,7 @@ class PowergloveDns(object):
 
         """
 
-        if not self.fqdn_is_present(a_fqdn):
+        if not self.fqdn_is_present(a_fqdn, self.session):
             raise PowergloveError('attempting to create an alias for a '
                                     'non-existant FQDN: {0}', a_fqdn)
 
@@ -399,17 +2178,19 @@ class PowergloveDns(object):
                               domain_id=a_record.domain_id,
                               type='CNAME',
                               content=a_fqdn,
+                              change_date=int(time.time()),
                               id=None)
 
         self.session.add(cname_record)
         self.update_domain_serial(a_record.domain_id)
-        self.session.commit()
+        self._commit_change()
 
         self.log.info('created CNAME alias %r', cname_record)
         return cname_record.name, cname_record.content
 
+    @retried_on_contention
     def add_a_record(self, fqdn, ip_range=None,
-                     ttl=None, text_contents=None):
+                     ttl=None, text_contents=None, expires=None):
         """
         Make an IP reservation for a given hostname
 
@@ -420,19 +2201,24 @@ class PowergloveDns(object):
             from, will be parsed by get_ip_range, so if present, should be in
             form of L{netaddr.IPRange},L{netaddr.IPGlob}, CIDR, or include both
             start and end IP Addresses
-        @type ip_range: None, C{tuple} of max two C{str}
+        @type ip_range: None, C{tuple} of max two C{str}; if empty, the pool of the
+            FQDN's zone is used
         @param ttl: the TTL to use for the given records
         @type ttl: C{int}
         @param text_contents: the contents for a TXT record associated with the
             A record
         @type text_contents: C{str}
+        @param expires: if provided, the reservation is removed by L{sweep} once this many
+            seconds (or a duration such as C{4h}, see L{parse_duration}) have passed
         @return: C{tuple} consisting of (a_record.name, selected_ip_address)
         """
 
+        ip_range = self.get_ip_range(ip_range, fqdn)
+        if expires is not None:
+            expires = parse_duration(expires)
+            self._enable_expiries()
 
-        ip_range = self.get_ip_range(ip_range)
-
-        if self.fqdn_is_present(fqdn):
+        if self.fqdn_is_present(fqdn, self.session):
             raise PowergloveError('fully-qualified domain name {0} exists.', fqdn)
 
         self.log.debug('attempting to add a record for FQDN '
@@ -459,21 +2245,322 @@ class PowergloveDns(object):
         self.log.debug('adding records to Power DNS')
         self.session.add(a_record)
         self.session.add_all(created_records.values())
-        self.session.commit()
+        self._index_a_record(a_record)
+        if expires is not None:
+            self.session.flush()
+            self.session.add(RecordExpiry(a_record.id, a_record.name, int(time.time()) + expires))
+            self.log.debug('%s expires in %d seconds', fqdn, expires)
+        self._commit_change()
         self.log.info('Created A Record: %r', a_record)
         return a_record.name, selected_ip_address
 
-    def fqdn_is_present(self, fqdn):
+    @retried_on_contention
+    def add_a_records(self, requests):
+        """
+        Make many IP reservations as a single unit of work: the names are checked with one
+        query, the occupancy of each distinct range is read once and its free addresses handed
+        out in turn, and every record is written in one transaction, bumping each changed
+        domain's serial once. A request that can't be met doesn't stop the others. Used by
+        L{AllocationCoalescer} to group commit the requests of concurrent clients.
+
+        @param requests: the C{(fqdn, ip_range)} or C{(fqdn, ip_range, ttl, text_contents)} of
+            each reservation, as given to L{add_a_record}
+        @return: C{list} holding, for each request in turn, either the C{tuple} consisting of
+            (a_record.name, selected_ip_address) or the L{PowergloveError} it failed with
+        """
+
+        requests = [(tuple(request) + (None, None))[:4] for request in requests]
+        results = [None] * len(requests)
+
+        with self.transaction():
+            present = self._get_names_present([fqdn for fqdn, _, _, _ in requests], self.session,
+                                              types=('A', 'CNAME'))
+            # the free addresses of each range, read once and used up by the requests for it
+            candidates = {}
+            selected = set()
+            a_records = []
+            for index, (fqdn, ip_range, ttl, text_contents) in enumerate(requests):
+                try:
+                    if fqdn in present:
+                        raise PowergloveError('fully-qualified domain name {0} exists.', fqdn)
+                    ip_range = self.get_ip_range(ip_range, fqdn)
+                    a_domain = self.get_a_domain_from_fqdn(fqdn)
+
+                    key = (ip_range.first, ip_range.last)
+                    if key not in candidates:
+                        candidates[key] = self._get_candidate_ip_addresses(ip_range)
+                    selected_ip_address = self._next_candidate_ip_address(candidates[key], selected,
+                                                                          ip_range)
+
+                    a_record = Record(name=fqdn,
+                                      domain_id=a_domain.id,
+                                      type='A',
+                                      ttl=ttl,
+                                      content=str(selected_ip_address),
+                                      change_date=int(time.time()),
+                                      id=None)
+                    try:
+                        created_records = self.create_associated_records(a_record, text_contents)
+                    except PowergloveError:
+                        # leave the address for the next request in the range
+                        candidates[key] = itertools.chain([selected_ip_address], candidates[key])
+                        raise
+                except PowergloveError as error:
+                    self.log.info('not adding %s: %s', fqdn, error)
+                    results[index] = error
+                    continue
+
+                present[fqdn].add(('A', a_domain.id))
+                selected.add(selected_ip_address)
+                self.session.add(a_record)
+                self.session.add_all(created_records.values())
+                a_records.append(a_record)
+                results[index] = (a_record.name, selected_ip_address)
+
+            if a_records and self.ip_index_enabled:
+                # the records' ids are needed for the index rows
+                self.session.flush()
+                ips = [int(IPAddress(a_record.content)) for a_record in a_records]
+                self.session.add_all(RecordIpIndex(a_record.id, ip) for a_record, ip in zip(a_records, ips))
+                self._adjust_subnet_usage([(ip, 1) for ip in ips])
+            self._commit_change()
+
+        self.log.info('Created %d A Records: %s', len(a_records),
+                      ', '.join('%s %s' % result for result in results if isinstance(result, tuple)))
+        return results
+
+    def _next_candidate_ip_address(self, candidates, selected, ip_range):
+        """
+        @param candidates: the iterator of the range's free addresses, see
+            L{_get_candidate_ip_addresses}
+        @param selected: the C{set} of addresses already handed out, which are skipped
+        @param ip_range: the range, for the error message
+        @return: the next of the addresses that is still free
+        """
+
+        for ip in candidates:
+            if ip in selected:
+                continue
+            if self.read_session is self.session or not self._ip_is_reserved(ip, self.session):
+                return ip
+            self.log.info('%s was free on the read replica but is reserved on the primary', ip)
+
+        raise PowergloveError('unable to find suitable ipaddress given '
+                              'range {0}', ip_range)
+
+    @staticmethod
+    def _split_name_pattern(pattern):
+        """
+        @param pattern: a name pattern with a single C{{n}} field, e.g. C{web-{n:03d}.stable.tld}
+        @return: C{tuple} consisting of the (literal prefix, literal suffix) around the field
+        """
+
+        parts = list(string.Formatter().parse(pattern))
+        fields = [field for _, field, _, _ in parts if field is not None]
+        if fields != ['n']:
+            raise PowergloveError('name pattern {0!r} must have exactly one {{n}} field', pattern)
+
+        prefix = parts[0][0]
+        suffix = ''.join(literal for literal, _, _, _ in parts[1:])
+        return prefix, suffix
+
+    def get_next_name_number(self, pattern, start=1, session=None):
+        """
+        Find the lowest number, from start, whose name in the pattern is unused. Only the A and
+        CNAME names between the pattern's prefix and suffix are read, with the name index, and
+        only names that the pattern formats exactly (so C{web-7} doesn't take C{web-{n:03d}}'s 7)
+        count as used.
+
+        @param pattern: a name pattern with a single C{{n}} field, e.g. C{web-{n:03d}.stable.tld}
+        @param start: the lowest number to use
+        @param session: the session to check with, defaults to the L{read_session}
+        @return: the C{int} number
+        """
+
+        prefix, suffix = self._split_name_pattern(pattern)
+
+        if session is None:
+            session = self.read_session
+
+        columns = Record.__table__.c
+        query = select([columns.name]).where(and_(columns.type.in_(('A', 'CNAME')),
+                                                  self._name_matches(prefix + '*' + suffix)))
+
+        used = set()
+        for name, in session.execute(query):
+            number = name[len(prefix):len(name) - len(suffix)]
+            if number.isdigit() and pattern.format(n=int(number)) == name:
+                used.add(int(number))
+
+        number = start
+        while number in used:
+            number += 1
+        return number
+
+    def _lock_domain(self, domain):
+        """
+        serialize concurrent changes to the provided domain for the rest of the transaction, by
+        updating its row without changing it: that holds the row's lock (or SQLite's write lock)
+        until the transaction ends
+        """
+
+        domains = Domain.__table__
+        self.session.execute(domains.update().where(domains.c.id == domain.id).values(id=domains.c.id))
+
+    @retried_on_contention
+    def add_next_a_record(self, pattern, ip_range=None, ttl=None, text_contents=None, start=1,
+                          expires=None):
+        """
+        Make an IP reservation for the first unused name in a pattern, e.g. C{web-017.stable.tld}
+        for C{web-{n:03d}.stable.tld} when 1 through 16 are taken. The zone is locked while the
+        name and address are chosen and reserved, so concurrent callers get different names.
+
+        @param pattern: a name pattern with a single C{{n}} field
+        @param start: the lowest number to use
+        @return: C{tuple} consisting of (a_record.name, selected_ip_address)
+
+        see L{add_a_record} for the other parameters
+        """
+
+        self._split_name_pattern(pattern)
+        if expires is not None:
+            # before the zone is locked, as creating the expiry table ends the transaction on
+            # databases (such as MySQL) that commit around schema changes
+            self._enable_expiries()
+        with self.transaction():
+            self._lock_domain(self.get_a_domain_from_fqdn(pattern.format(n=start)))
+            fqdn = pattern.format(n=self.get_next_name_number(pattern, start, self.session))
+            return self.add_a_record(fqdn, ip_range, ttl, text_contents, expires)
+
+    @retried_on_contention
+    def move_a_record(self, fqdn, ip_range=None):
+        """
+        Give a host a new address, updating its A record and the PTR record for its old address
+        in place, in a single transaction, so that the name never disappears and CNAMEs pointing
+        at it are unaffected
+
+        @param fqdn: the fully-qualified domain name of the A record to move
+        @param ip_range: the range to select the new address from (an explicit address is a
+            range of one), parsed by L{get_ip_range}; if empty, the pool of the FQDN's zone
+        @return: C{tuple} consisting of (a_record.name, selected_ip_address)
+        @raise PowergloveFqdnNotFoundError: if there is no A record for the FQDN
+        """
+
+        ip_range = self.get_ip_range(ip_range, fqdn)
+
+        with self.transaction():
+            a_record = self.get_record(name=fqdn)
+            if a_record is None:
+                raise PowergloveFqdnNotFoundError('No A record associated with '
+                                                  'fully-qualified-domain-name:'
+                                                  '{0}', fqdn)
+
+            selected_ip_address = self.get_available_ip_address(ip_range)
+            old_ptr_name = self.reverse_ip_to_ptr_record(a_record.content)
+            new_ptr_name = self.reverse_ip_to_ptr_record(str(selected_ip_address))
+            new_ptr_domain = self.get_ptr_domain_from_ptr_record_name(new_ptr_name)
+
+            for ptr_record in self.get_records('PTR', name=old_ptr_name, content=fqdn):
+                self.log.debug('moving %r to %s', ptr_record, new_ptr_name)
+                self.update_domain_serial(ptr_record.domain_id)
+                ptr_record.name = new_ptr_name
+                ptr_record.domain_id = new_ptr_domain.id
+                ptr_record.change_date = int(time.time())
+                self.update_domain_serial(new_ptr_domain.id)
+
+            self.log.info('moving %s from %s to %s', fqdn, a_record.content, selected_ip_address)
+            self._unindex_a_record(a_record)
+            a_record.content = str(selected_ip_address)
+            a_record.change_date = int(time.time())
+            self._index_a_record(a_record)
+            self.update_domain_serial(a_record.domain_id)
+            self.serial_scheduler.change_done()
+
+        return a_record.name, selected_ip_address
+
+    @retried_on_contention
+    def rename_fqdn(self, old_fqdn, new_fqdn, chunk_size=500):
+        """
+        Rename a host (or a CNAME alias), updating its A or CNAME record, its TXT records, the
+        PTR records pointing at it and the CNAMEs aliasing it in place, with bulk statements in
+        a single transaction that bumps each affected domain's serial once. A and TXT records
+        move to the domain of the new name.
+
+        @param old_fqdn: the current fully-qualified domain name
+        @param new_fqdn: the new fully-qualified domain name, which must not be in use
+        @param chunk_size: the number of ids per statement
+        @return: the C{list} of updated L{RecordRow}, as they now are
+        @raise PowergloveFqdnNotFoundError: if there is no A or CNAME record for old_fqdn
+        """
+
+        columns = Record.__table__.c
+
+        with self.transaction():
+            if not self.fqdn_is_present(old_fqdn, self.session):
+                raise PowergloveFqdnNotFoundError('No records associated with '
+                                                  'fully-qualified-domain-name:'
+                                                  '{0}', old_fqdn)
+            if self.fqdn_is_present(new_fqdn, self.session):
+                raise PowergloveError('fully-qualified domain name {0} exists.', new_fqdn)
+
+            new_domain = self.get_a_domain_from_fqdn(new_fqdn)
+            now = int(time.time())
+
+            renamed = [RecordRow(*row) for row in self.session.execute(self._select_record_rows().where(
+                and_(columns.name == old_fqdn, columns.type.in_(('A', 'CNAME', 'TXT')))))]
+            aliasing = [RecordRow(*row) for row in self.session.execute(self._select_record_rows().where(
+                and_(columns.content == old_fqdn, columns.type.in_(('PTR', 'CNAME')))))]
+
+            # CNAMEs keep the domain they were created in (their target's), A and TXT records
+            # belong to the domain of their name
+            moved_ids = [row.id for row in renamed if row.type != 'CNAME']
+            for chunk in chunked(moved_ids, chunk_size):
+                self.session.execute(Record.__table__.update().where(columns.id.in_(chunk)).values(
+                    name=new_fqdn, domain_id=new_domain.id, change_date=now))
+            if self.expiries_enabled:
+                expiries = RecordExpiry.__table__
+                for chunk in chunked(moved_ids, chunk_size):
+                    self.session.execute(expiries.update().where(expiries.c.record_id.in_(chunk)).values(
+                        name=new_fqdn))
+            for chunk in chunked([row.id for row in renamed if row.type == 'CNAME'], chunk_size):
+                self.session.execute(Record.__table__.update().where(columns.id.in_(chunk)).values(
+                    name=new_fqdn, change_date=now))
+            for chunk in chunked([row.id for row in aliasing], chunk_size):
+                self.session.execute(Record.__table__.update().where(columns.id.in_(chunk)).values(
+                    content=new_fqdn, change_date=now))
+
+            for row in renamed + aliasing:
+                self.log.debug('renaming %s %s => %s', row.type, row.name, row.content)
+                self.update_domain_serial(row.domain_id)
+            if moved_ids:
+                self.update_domain_serial(new_domain.id)
+            self.serial_scheduler.change_done()
+
+            # the bulk updates bypass the session's objects, which may be stale now
+            self.session.expire_all()
+            updated = self.get_record_rows_by_id(row.id for row in renamed + aliasing)
+
+        self.log.info('renamed %s to %s, updating %d records', old_fqdn, new_fqdn, len(updated))
+        return updated
+
+    @read_only
+    def fqdn_is_present(self, fqdn, session=None):
         """
         returns True if the provided FQDN is present in PDNS, false otherwise.
         Checks both A records and CNAME records
 
         @param fqdn: the Fully-Qualified-Domain-Name to test
         @type fqdn: C{str}
+        @param session: the session to check with, defaults to the L{read_session}; changes
+            check against the main session so that replication lag can't affect them
         """
 
-        return any([self.get_record(name=fqdn),
-                    self.get_record(rec_type='CNAME', name=fqdn)])
+        if session is None:
+            session = self.read_session
+
+        query = bakery(lambda session: session.query(Record.id).filter(
+            Record.name == bindparam('name'), Record.type.in_(('A', 'CNAME'))))
+        return query(session).params(name=fqdn).first() is not None
 
     def get_available_ip_address(self, ip_range):
         """
@@ -485,25 +2572,220 @@ class PowergloveDns(object):
         @rtype: L{netaddr.IPAdress}
         """
 
-        a_rec_gen = (IPAddress(a_record.content)
-                     for a_record in self.get_existing_records())
-        reserved_ip_addresses = netaddr.ip.sets.IPSet(a_rec_gen)
-        self.log.debug('found reserved IP addresses: %r',
-                       reserved_ip_addresses)
+        for ip in self._get_candidate_ip_addresses(ip_range):
+            if self.read_session is self.session or not self._ip_is_reserved(ip, self.session):
+                return ip
+            self.log.info('%s was free on the read replica but is reserved on the primary', ip)
+
+        raise PowergloveError('unable to find suitable ipaddress given '
+                              'range {0}', ip_range)
+
+    def _get_candidate_ip_addresses(self, ip_range):
+        """
+        generates the valid addresses within the range that are unreserved according to the
+        read session, in ascending order
+
+        @param ip_range: the IP range to select from
+        @type ip_range: L{netaddr.IPRange}
+        """
+
+        if self.ip_index_enabled:
+            for ip in self._get_candidate_ip_addresses_from_index(ip_range):
+                yield ip
+            return
+
+        reserved_ip_addresses = set(int(IPAddress(content)) for content, in self.scan_records(('content',)))
+        self.log.debug('found %d reserved IP addresses', len(reserved_ip_addresses))
+
+        for ip_int in self.exclusions.iter_allowed(ip_range.first, ip_range.last):
+            if ip_int not in reserved_ip_addresses:
+                yield IPAddress(ip_int)
+
+    def _ip_is_reserved(self, ip, session):
+        """
+        @param ip: the L{netaddr.IPAddress} to check
+        @param session: the session to check with
+        @return: C{True} if an A record holds the provided address
+        """
+
+        if self.ip_index_enabled:
+            query = session.query(RecordIpIndex.record_id).filter_by(ip=int(ip))
+        else:
+            query = session.query(Record.id).filter_by(type='A', content=str(ip))
+
+        return query.first() is not None
+
+    def _get_free_ip_gaps(self, first, last):
+        """
+        generates the free (first, last) integer address spans within the provided bounds,
+        in ascending order, as found by the database from the IP side index
+
+        @param first: the C{int} lowest address to consider
+        @param last: the C{int} highest address to consider
+        """
+
+        ip_column = RecordIpIndex.__table__.c.ip
+        used = select([ip_column.label('ip'),
+                       func.lag(ip_column).over(order_by=ip_column).label('prev_ip'),
+                       func.lead(ip_column).over(order_by=ip_column).label('next_ip')]
+                      ).where(ip_column.between(first, last)).alias('used')
+
+        gap_edges = select([used.c.ip, used.c.prev_ip, used.c.next_ip]).where(
+            or_(used.c.prev_ip == None,
+                used.c.next_ip == None,
+                used.c.next_ip > used.c.ip + 1)).order_by(used.c.ip)
+
+        found_used = False
+        for ip, prev_ip, next_ip in self.read_session.execute(gap_edges):
+            found_used = True
+            if prev_ip is None and ip > first:
+                yield first, ip - 1
+            if next_ip is None:
+                if ip < last:
+                    yield ip + 1, last
+            elif next_ip > ip + 1:
+                yield ip + 1, next_ip - 1
+
+        if not found_used:
+            yield first, last
+
+    def _get_candidate_ip_addresses_from_index(self, ip_range):
+        """
+        L{_get_candidate_ip_addresses} using the IP side index, so that only the edges of the
+        free spans within the range are read from the database
+
+        @param ip_range: the IP range to select from
+        @type ip_range: L{netaddr.IPRange}
+        """
+
+        spans = [(ip_range.first, ip_range.last)]
+        if self.subnet_usage_enabled:
+            spans = self._get_spans_by_subnet_usage(ip_range.first, ip_range.last)
+
+        for span_first, span_last in spans:
+            for gap_first, gap_last in self._get_free_ip_gaps(span_first, span_last):
+                for ip_int in self.exclusions.iter_allowed(gap_first, gap_last):
+                    yield IPAddress(ip_int)
+
+    def _get_spans_by_subnet_usage(self, first, last):
+        """
+        split the provided bounds by the per-/24 summary, so that the subnets it shows to be full
+        are skipped at once; they're still tried last, as addresses that are excluded but in use
+        count towards a subnet being full
+
+        @param first: the C{int} lowest address to consider
+        @param last: the C{int} highest address to consider
+        @return: C{list} of (first, last) integer address spans covering the bounds: those of
+            the subnets with room, in ascending order, then those of the full ones
+        """
+
+        usage = SubnetUsage.__table__
+        query = select([usage.c.subnet, usage.c.used]).where(and_(
+            usage.c.subnet.between(first >> 8, last >> 8), usage.c.used > 0)).order_by(usage.c.subnet)
+
+        full_spans = []
+        for subnet, used in self.read_session.execute(query):
+            block_first = max(first, subnet << 8)
+            block_last = min(last, subnet << 8 | 0xff)
+            if used < self.exclusions.count_allowed(block_first, block_last):
+                continue
+            if full_spans and full_spans[-1][1] + 1 == block_first:
+                full_spans[-1] = (full_spans[-1][0], block_last)
+            else:
+                full_spans.append((block_first, block_last))
+
+        open_spans = []
+        for span_first, span_last in full_spans:
+            if first < span_first:
+                open_spans.append((first, span_first - 1))
+            first = span_last + 1
+        if first <= last:
+            open_spans.append((first, last))
+
+        return open_spans + full_spans
+
+    @read_only
+    def get_ip_utilization(self, ip_range):
+        """
+        @param ip_range: the IP range to report on
+        @type ip_range: L{netaddr.IPRange}
+        @return: C{tuple} consisting of (the number of distinct A record addresses in use within
+            the range, the size of the range). The per-/24 summary (see L{rebuild_subnet_usage})
+            counts A records, not addresses, so it isn't used here
+        """
+
+        if self.ip_index_enabled:
+            used = self.read_session.query(func.count(func.distinct(RecordIpIndex.ip))).filter(
+                RecordIpIndex.ip.between(ip_range.first, ip_range.last)).scalar()
+        else:
+            used = len(set(IPAddress(content) for content, in self.scan_records(('content',))
+                           if IPAddress(content) in ip_range))
+
+        return used, ip_range.size
+
+    @read_only
+    def get_a_records_for_ip(self, ip_address):
+        """
+        @param ip_address: the address to find the owners of
+        @return: C{list} of the A records whose content is the provided address
+        """
+
+        ip = IPAddress(ip_address)
+        if self.ip_index_enabled:
+            return self.read_session.query(Record).join(
+                RecordIpIndex, RecordIpIndex.record_id == Record.id).filter(
+                RecordIpIndex.ip == int(ip)).all()
 
-        selected_ip_address = None
+        return self.read_session.query(Record).filter_by(type='A', content=str(ip)).all()
 
-        for ip in ip_range:
-            if self.is_valid_address(ip) and ip not in reserved_ip_addresses:
-                selected_ip_address = ip
-                break
+    @read_only
+    def lookup_ips(self, ip_addresses, chunk_size=500):
+        """
+        Find who owns each of the provided addresses, by both their A and PTR records, in a
+        handful of queries however many addresses there are
 
-        if selected_ip_address is None:
-            raise PowergloveError('unable to find suitable ipaddress given'
-                                    'range {0} and existing address {1}',
-                                    ip_range, reserved_ip_addresses)
+        @param ip_addresses: the addresses to look up
+        @param chunk_size: the number of addresses looked up per query
+        @return: C{list} of L{IpOwnership}, in the order of the provided addresses
+        """
 
-        return selected_ip_address
+        try:
+            ips = [IPAddress(ip_address) for ip_address in ip_addresses]
+        except (netaddr.AddrFormatError, ValueError), exc:
+            raise PowergloveError('unable to look up {0}', exc)
+
+        a_names = collections.defaultdict(set)
+        ptr_names = collections.defaultdict(set)
+        unique_ips = sorted(set(ips))
+
+        if not self.ip_index_enabled and len(unique_ips) > chunk_size:
+            # A record content isn't indexed, so one pass over the A records beats a scan per chunk
+            wanted = set(str(ip) for ip in unique_ips)
+            for content, name in self.scan_records(('content', 'name')):
+                if content in wanted:
+                    a_names[IPAddress(content)].add(name)
+
+        for chunk in chunked(unique_ips, chunk_size):
+
+            if self.ip_index_enabled:
+                query = self.read_session.query(RecordIpIndex.ip, Record.name).join(
+                    Record, Record.id == RecordIpIndex.record_id).filter(
+                    RecordIpIndex.ip.in_([int(ip) for ip in chunk]))
+                for ip_int, name in query:
+                    a_names[IPAddress(ip_int)].add(name)
+            elif len(unique_ips) <= chunk_size:
+                query = self.read_session.query(Record.content, Record.name).filter(
+                    Record.type == 'A', Record.content.in_([str(ip) for ip in chunk]))
+                for content, name in query:
+                    a_names[IPAddress(content)].add(name)
+
+            ips_by_ptr_name = dict((self.reverse_ip_to_ptr_record(ip), ip) for ip in chunk)
+            query = self.read_session.query(Record.name, Record.content).filter(
+                Record.type == 'PTR', Record.name.in_(list(ips_by_ptr_name)))
+            for name, content in query:
+                ptr_names[ips_by_ptr_name[name]].add(content)
+
+        return [IpOwnership(str(ip), sorted(a_names[ip]), sorted(ptr_names[ip])) for ip in ips]
 
     def create_associated_records(self, record,
                                   text_contents=None):
@@ -540,6 +2822,7 @@ class PowergloveDns(object):
                                 type='TXT',
                                 content=text_contents,
                                 ttl=record.ttl,
+                                change_date=int(time.time()),
                                 id=None)
             created_records['TXT'] = txt_record
             self.log.debug('setting up "TXT" record: %r', txt_record)
@@ -0,0 +1,274 @@
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+from netaddr import IPAddress
+
+from powerglove import (ExclusionPolicy, PowergloveDns, PowergloveError, RetryPolicy,
+                        SerialUpdateScheduler)
+
+
+class OccupancySnapshot(object):
+    """
+    A read-only, memory-mapped copy of which addresses and names are taken in Power DNS, for
+    answering "is this IP free / who owns it / is this name taken" without the database.
+
+    The file is laid out, little-endian, as::
+
+        header       magic, address count, name count, name blob size, creation time
+        addresses    sorted uint32 A record addresses
+        owners       uint32 offset into the name blob of each address' A record name
+        name hashes  sorted uint32 crc32 of each A and CNAME record name
+        names        uint32 offset into the name blob of each hashed name
+        name blob    NUL terminated names
+
+    so that lookups are binary searches directly on the mapped file and loading it costs
+    nothing beyond opening it, however many records it holds.
+    """
+
+    magic = 'PGSNAP01'
+    header = struct.Struct('<8sIIII')
+    item = struct.Struct('<I')
+
+    def __init__(self, path):
+        """
+        @param path: the path of a snapshot written by L{export}
+        """
+
+        self.path = path
+        if os.path.getsize(path) < self.header.size:
+            raise PowergloveError('{0} is not a Powerglove snapshot', path)
+
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.address_count, self.name_count, blob_size, self.created = \
+            self.header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            raise PowergloveError('{0} is not a Powerglove snapshot', path)
+
+        item_size = self.item.size
+        self._addresses = self.header.size
+        self._owners = self._addresses + self.address_count * item_size
+        self._hashes = self._owners + self.address_count * item_size
+        self._names = self._hashes + self.name_count * item_size
+        self._blob = self._names + self.name_count * item_size
+
+    def close(self):
+        self._map.close()
+
+    @staticmethod
+    def _hash(name):
+        return zlib.crc32(name) & 0xffffffff
+
+    @staticmethod
+    def _encode(name):
+        if isinstance(name, unicode):
+            return name.encode('utf-8')
+        return name
+
+    @classmethod
+    def export(cls, pdns, path):
+        """
+        Write a snapshot of the A and CNAME records of the provided L{PowergloveDns}
+
+        @param pdns: the L{PowergloveDns} to take the snapshot from
+        @param path: where to write the snapshot, which is replaced atomically
+        @return: the loaded L{OccupancySnapshot}
+        """
+
+        blob = []
+        blob_offsets = {}
+        blob_size = [0]
+
+        def blob_offset(name):
+            name = cls._encode(name)
+            if name not in blob_offsets:
+                blob_offsets[name] = blob_size[0]
+                blob.append(name + '\0')
+                blob_size[0] += len(name) + 1
+            return blob_offsets[name]
+
+        owned_addresses = []
+        hashed_names = []
+        for record_type, name, content in pdns.scan_records(('type', 'name', 'content'), ('A', 'CNAME')):
+            offset = blob_offset(name)
+            hashed_names.append((cls._hash(cls._encode(name)), offset))
+            if record_type == 'A':
+                owned_addresses.append((int(IPAddress(content)), offset))
+
+        owned_addresses.sort()
+        hashed_names.sort()
+
+        sections = [array.array('I', (address for address, _ in owned_addresses)),
+                    array.array('I', (offset for _, offset in owned_addresses)),
+                    array.array('I', (name_hash for name_hash, _ in hashed_names)),
+                    array.array('I', (offset for _, offset in hashed_names))]
+
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(cls.header.pack(cls.magic, len(owned_addresses), len(hashed_names),
+                                                blob_size[0], int(time.time())))
+            for section in sections:
+                if sys.byteorder != 'little':
+                    section.byteswap()
+                section.tofile(snapshot_file)
+            snapshot_file.write(''.join(blob))
+        os.rename(temporary_path, path)
+
+        pdns.log.info('wrote a snapshot of %d addresses and %d names to %s',
+                      len(owned_addresses), len(hashed_names), path)
+        return cls(path)
+
+    def _get(self, section, index):
+        return self.item.unpack_from(self._map, section + index * self.item.size)[0]
+
+    def _bisect_left(self, section, count, value):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get(section, middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _name_at(self, blob_offset):
+        start = self._blob + blob_offset
+        return self._map[start:self._map.find('\0', start)]
+
+    def get_owners(self, ip_address):
+        """
+        @param ip_address: the address to find the owners of
+        @return: C{list} of the names of the A records holding the address
+        """
+
+        ip = int(IPAddress(ip_address))
+        index = self._bisect_left(self._addresses, self.address_count, ip)
+        owners = []
+        while index < self.address_count and self._get(self._addresses, index) == ip:
+            owners.append(self._name_at(self._get(self._owners, index)).decode('utf-8'))
+            index += 1
+        return owners
+
+    def ip_is_reserved(self, ip_address):
+        ip = int(IPAddress(ip_address))
+        index = self._bisect_left(self._addresses, self.address_count, ip)
+        return index < self.address_count and self._get(self._addresses, index) == ip
+
+    def iter_reserved(self, first, last):
+        """
+        generates the reserved integer addresses between the provided bounds, in ascending order
+        """
+
+        index = self._bisect_left(self._addresses, self.address_count, first)
+        while index < self.address_count:
+            ip = self._get(self._addresses, index)
+            if ip > last:
+                return
+            yield ip
+            index += 1
+
+    def fqdn_is_present(self, fqdn):
+        """
+        @return: True if the snapshot has an A or CNAME record named fqdn
+        """
+
+        fqdn = self._encode(fqdn)
+        name_hash = self._hash(fqdn)
+        index = self._bisect_left(self._hashes, self.name_count, name_hash)
+        while index < self.name_count and self._get(self._hashes, index) == name_hash:
+            if self._name_at(self._get(self._names, index)) == fqdn:
+                return True
+            index += 1
+        return False
+
+
+class PlanningPowergloveDns(PowergloveDns):
+    """
+    A read-only L{PowergloveDns} answering from an L{OccupancySnapshot} instead of the
+    database, for dry runs and planning. Planned additions are remembered, so that a series
+    of them doesn't hand out the same name or address twice; anything needing the database
+    raises L{PowergloveError}.
+    """
+
+    def __init__(self, snapshot, logger=None):
+        """
+        @param snapshot: the L{OccupancySnapshot}, or the path of one
+        @param logger: the logger instance to use, else, a new one is created
+        """
+
+        # deliberately not calling PowergloveDns.__init__, which connects to the database
+        if logger is None:
+            self.log = logging.getLogger(self.__class__.__name__)
+        else:
+            self.log = logger
+        self._transaction_depth = 0
+        self.serial_scheduler = SerialUpdateScheduler()
+        self.retry_policy = RetryPolicy()
+        self.exclusions = ExclusionPolicy.from_config(self.def_config_file)
+
+        if not isinstance(snapshot, OccupancySnapshot):
+            snapshot = OccupancySnapshot(snapshot)
+
+        self.snapshot = snapshot
+        self.planned_names = set()
+        self.planned_addresses = set()
+
+    @property
+    def session(self):
+        raise PowergloveError('planning from snapshot {0} is read-only', self.snapshot.path)
+
+    read_session = session
+
+    # the snapshot holds no zones or PTR records, so only configured pools can be used
+    @property
+    def zone_pools(self):
+        return self.configured_zone_pools
+
+    def get_zone_pool(self, fqdn):
+        try:
+            return self._get_closest_domain_match_from_string(fqdn, self.configured_zone_pools)
+        except PowergloveError:
+            raise PowergloveError('unable to find a suitable range for {0}, no pool '
+                                  'is configured for its zone', fqdn)
+
+    def fqdn_is_present(self, fqdn, session=None):
+        return fqdn in self.planned_names or self.snapshot.fqdn_is_present(fqdn)
+
+    def get_a_records_for_ip(self, ip_address):
+        return self.snapshot.get_owners(ip_address)
+
+    def get_available_ip_address(self, ip_range):
+
+        reserved = self.snapshot.iter_reserved(ip_range.first, ip_range.last)
+        next_reserved = next(reserved, None)
+        for ip_int in self.exclusions.iter_allowed(ip_range.first, ip_range.last):
+            while next_reserved is not None and next_reserved < ip_int:
+                next_reserved = next(reserved, None)
+            if ip_int != next_reserved and ip_int not in self.planned_addresses:
+                return IPAddress(ip_int)
+
+        raise PowergloveError('unable to find suitable ipaddress given '
+                              'range {0}', ip_range)
+
+    def plan_a_record(self, fqdn, ip_range=None):
+        """
+        The dry run of L{PowergloveDns.add_a_record}
+
+        @return: C{tuple} consisting of (fqdn, the address it would get)
+        """
+
+        ip_range = self.get_ip_range(ip_range, fqdn)
+        if self.fqdn_is_present(fqdn):
+            raise PowergloveError('fully-qualified domain name {0} exists.', fqdn)
+
+        ip = self.get_available_ip_address(ip_range)
+        self.planned_names.add(fqdn)
+        self.planned_addresses.add(int(ip))
+        return fqdn, ip
@@ -0,0 +1,387 @@
+import collections
+import csv
+import logging
+import time
+
+from sqlalchemy import bindparam, or_, select
+
+from netaddr import INET_PTON, IPAddress, AddrFormatError
+
+from model import Record, RecordExpiry, RecordIpIndex, RecordRow
+from powerglove import PowergloveError, chunked
+
+# a record the inventory says should exist; a ttl of None accepts whatever the record has
+DesiredRecord = collections.namedtuple('DesiredRecord', 'type name content ttl')
+
+# one step of a sync: action is 'add', 'update' or 'remove', old is the current L{RecordRow}
+# being updated or removed (None for an add)
+SyncChange = collections.namedtuple('SyncChange', 'action type name content ttl old')
+
+synced_types = ('A', 'CNAME', 'TXT')
+
+
+def load_inventory(path):
+    """
+    Read the desired records from an inventory file: CSV (the default) with a
+    C{type,name,content[,ttl]} row per record, or, for C{.yaml} and C{.yml} files (which need
+    PyYAML), a list of mappings with those keys. Blank CSV lines, lines starting with C{#}, and
+    a header row are skipped.
+
+    @param path: the inventory file
+    @return: C{list} of L{DesiredRecord}
+    """
+
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise PowergloveError('reading the YAML inventory {0} needs PyYAML installed', path)
+        with open(path) as inventory_file:
+            entries = yaml.safe_load(inventory_file) or []
+        rows = [(entry.get('type'), entry.get('name'), entry.get('content'), entry.get('ttl'))
+                for entry in entries]
+    else:
+        with open(path, 'rb') as inventory_file:
+            rows = [row for row in csv.reader(inventory_file)
+                    if row and any(row) and not row[0].lstrip().startswith('#')]
+        if rows and [field.strip().lower() for field in rows[0][:3]] == ['type', 'name', 'content']:
+            rows = rows[1:]
+
+    desired = []
+    for number, row in enumerate(rows, 1):
+        row = [field.strip() if isinstance(field, basestring) else field for field in row]
+        if len(row) not in (3, 4) or not all(row[:3]):
+            raise PowergloveError('{0} record {1}: expected type, name, content and an optional '
+                                  'ttl, got {2!r}', path, number, row)
+        rec_type, name, content = row[:3]
+        ttl = row[3] if len(row) == 4 and row[3] not in ('', None) else None
+        try:
+            ttl = None if ttl is None else int(ttl)
+        except ValueError:
+            raise PowergloveError('{0} record {1}: invalid ttl {2!r}', path, number, ttl)
+        desired.append(DesiredRecord(rec_type.upper(), name, content, ttl))
+
+    return desired
+
+
+class InventorySync(object):
+    """
+    Makes the A, CNAME and TXT records of the zones an inventory has names in match it (the
+    zones its CNAMEs point into aren't synced, their targets only have to exist). The current
+    records of those zones are read with streamed queries, and the plan is the
+    difference between the two sets: records only in the inventory are added, records only in
+    Power DNS are removed, and where a name has a record of a type on both sides with a
+    different content (or ttl) the record is updated in place. A records bring their PTR
+    records along.
+
+    Plans are applied with bulk statements in transactions of a bounded number of changes, and
+    each changed zone's serial is bumped once, at the end.
+    """
+
+    def __init__(self, pdns, desired, default_ttl=300, logger=None):
+        """
+        @param pdns: the L{PowergloveDns} to synchronize
+        @param desired: the iterable of L{DesiredRecord} that should exist
+        @param default_ttl: the ttl for added records that the inventory gives none for
+        @param logger: the logger instance to use, else, a new one is created
+        """
+
+        if logger is None:
+            self.log = logging.getLogger(self.__class__.__name__)
+        else:
+            self.log = logger
+
+        self.pdns = pdns
+        self.default_ttl = default_ttl
+        self.a_domains = pdns.a_domains
+        self.ptr_domains = pdns.ptr_domains
+        self._zone_cache = {}
+        self.desired = self._index_desired(desired)
+
+    def _get_zone(self, name, domains):
+        """
+        the domain of the name, memoized by the name's parent, which (unless the name is a
+        domain itself) decides it
+        """
+
+        if name in domains:
+            return domains[name]
+
+        key = (id(domains), name.split('.', 1)[-1])
+        if key not in self._zone_cache:
+            self._zone_cache[key] = self.pdns._get_closest_domain_match_from_string(name, domains)
+        return self._zone_cache[key]
+
+    def _index_desired(self, desired):
+        """
+        @return: C{dict} mapping each desired (type, name) to a C{dict} of its contents' ttls
+        """
+
+        desired_by_key = collections.defaultdict(dict)
+        types_by_name = collections.defaultdict(set)
+        for record in desired:
+            if record.type not in synced_types:
+                raise PowergloveError('cannot sync {0} record {1}, only {2} records are synced',
+                                      record.type, record.name, ', '.join(synced_types))
+            if record.type == 'A':
+                try:
+                    IPAddress(record.content, 4, flags=INET_PTON)
+                except (AddrFormatError, ValueError):
+                    raise PowergloveError('A record {0} has an invalid address {1!r}',
+                                          record.name, record.content)
+            self._get_zone(record.name, self.a_domains)
+            desired_by_key[record.type, record.name][record.content] = record.ttl
+            types_by_name[record.name].add(record.type)
+
+        for name, types in types_by_name.iteritems():
+            if 'CNAME' in types and len(types) > 1:
+                raise PowergloveError('{0} cannot have a CNAME record along with other records', name)
+
+        return desired_by_key
+
+    @property
+    def covered_domain_ids(self):
+        """
+        the ids of the domains that the inventory has names in; a CNAME's target doesn't cover
+        the domain it's in
+        """
+
+        return set(self._get_zone(name, self.a_domains).id for _, name in self.desired)
+
+    def _covers(self, name, covered_domain_ids):
+        try:
+            return self._get_zone(name, self.a_domains).id in covered_domain_ids
+        except PowergloveError:
+            return False
+
+    def _get_current(self, covered_domain_ids):
+        """
+        @return: C{dict} mapping each (type, name) of the covered domains to its current
+            L{RecordRow}s, including the aliases that are kept in other domains
+        """
+
+        columns = Record.__table__.c
+        queries = [self.pdns._select_record_rows(synced_types).where(columns.domain_id.in_(chunk))
+                   for chunk in chunked(sorted(covered_domain_ids), 500)]
+        # aliases are kept in their target's domain, as add_cname_record does, which may not be
+        # covered; and those of other domains' names may be kept in the covered ones
+        zones = sorted(name for name, domain in self.a_domains.iteritems() if domain.id in covered_domain_ids)
+        queries.extend(self.pdns._select_record_rows(('CNAME',)).where(or_(
+            *[or_(columns.name == zone, columns.name.like('%.' + zone)) for zone in chunk]))
+            for chunk in chunked(zones, 100))
+
+        rows = {}
+        for query in queries:
+            for row in self.pdns.session.execute(query.execution_options(stream_results=True)):
+                row = RecordRow(*row)
+                if self._covers(row.name, covered_domain_ids):
+                    rows[row.id] = row
+
+        current = collections.defaultdict(list)
+        for row in rows.itervalues():
+            current[row.type, row.name].append(row)
+        return current
+
+    def _check_cname_targets(self, covered_domain_ids):
+        """
+        @raise PowergloveError: if a CNAME points at a name that has no A or CNAME record in the
+            inventory, nor (outside the covered domains, which the plan removes it from) in
+            Power DNS
+        """
+
+        names = set(name for rec_type, name in self.desired if rec_type in ('A', 'CNAME'))
+        targets = set(content for (rec_type, _), contents in self.desired.iteritems() if rec_type == 'CNAME'
+                      for content in contents) - names
+        missing = set(target for target in targets if self._covers(target, covered_domain_ids))
+
+        columns = Record.__table__.c
+        present = set()
+        for chunk in chunked(sorted(targets - missing), 500):
+            present.update(name for name, in self.pdns.session.execute(select([columns.name]).where(
+                columns.type.in_(('A', 'CNAME'))).where(columns.name.in_(chunk))))
+        missing.update(targets - present)
+
+        if missing:
+            raise PowergloveError('attempting to create an alias for a non-existant FQDN: {0}',
+                                  ', '.join(sorted(missing)))
+
+    def plan(self):
+        """
+        @return: C{list} of the L{SyncChange}s that would make Power DNS match the inventory,
+            ordered by name
+        @raise PowergloveError: if a CNAME's target wouldn't exist
+        """
+
+        covered_domain_ids = self.covered_domain_ids
+        self._check_cname_targets(covered_domain_ids)
+        current = self._get_current(covered_domain_ids)
+
+        changes = []
+        for rec_type, name in sorted(set(self.desired) | set(current), key=lambda key: (key[1], key[0])):
+            wanted = dict(self.desired.get((rec_type, name), {}))
+            unmatched = []
+            for row in sorted(current.get((rec_type, name), []), key=lambda row: row.id):
+                if row.content in wanted:
+                    ttl = wanted.pop(row.content)
+                    if ttl is not None and ttl != row.ttl:
+                        changes.append(SyncChange('update', rec_type, name, row.content, ttl, row))
+                else:
+                    unmatched.append(row)
+
+            missing = sorted(wanted.items())
+            for row, (content, ttl) in zip(unmatched, missing):
+                changes.append(SyncChange('update', rec_type, name, content,
+                                          row.ttl if ttl is None else ttl, row))
+            for row in unmatched[len(missing):]:
+                changes.append(SyncChange('remove', rec_type, name, row.content, row.ttl, row))
+            for content, ttl in missing[len(unmatched):]:
+                changes.append(SyncChange('add', rec_type, name, content,
+                                          self.default_ttl if ttl is None else ttl, None))
+
+        self.log.info('planned %d changes to sync %d desired records', len(changes),
+                      sum(len(contents) for contents in self.desired.itervalues()))
+        return changes
+
+    def apply(self, changes=None, chunk_size=1000):
+        """
+        @param changes: the plan to apply, defaults to a new L{plan}
+        @param chunk_size: the number of changes applied per transaction
+        @return: C{list} of the applied L{SyncChange}s
+        """
+
+        if changes is None:
+            changes = self.plan()
+
+        changed_domain_ids = set()
+        try:
+            for chunk in chunked(changes, chunk_size):
+                with self.pdns.transaction():
+                    changed_domain_ids.update(self._apply_chunk(chunk))
+        finally:
+            # one serial bump per changed zone, for everything applied
+            for domain_id in changed_domain_ids:
+                self.pdns.update_domain_serial(domain_id)
+            if changed_domain_ids:
+                self.pdns.serial_scheduler.change_done()
+                self.pdns.flush_serials()
+
+        self.log.info('applied %d changes to %d zones', len(changes), len(changed_domain_ids))
+        return changes
+
+    def _ptr_row(self, ip_address, name, ttl, now):
+        ptr_name = self.pdns.reverse_ip_to_ptr_record(ip_address)
+        return dict(domain_id=self._get_zone(ptr_name, self.ptr_domains).id, name=ptr_name,
+                    type='PTR', content=name, ttl=ttl, prio=0, change_date=now)
+
+    def _apply_chunk(self, changes):
+        """
+        @return: the C{set} of the ids of the changed domains
+        """
+
+        session = self.pdns.session
+        records = Record.__table__
+        ip_index = RecordIpIndex.__table__
+        expiries = RecordExpiry.__table__
+        now = int(time.time())
+        index_ips = self.pdns.ip_index_enabled
+
+        changed_domain_ids = set()
+        removed_ids = []
+        updates = []
+        inserts = []
+        # (PTR name, A name) of the PTR records to remove, or to move to a new address
+        ptr_removals = set()
+        ptr_moves = {}
+        added_a_records = set()
+
+        for change in changes:
+            if change.action == 'remove':
+                removed_ids.append(change.old.id)
+                changed_domain_ids.add(change.old.domain_id)
+                if change.type == 'A':
+                    ptr_removals.add((self.pdns.reverse_ip_to_ptr_record(change.old.content), change.name))
+            elif change.action == 'update':
+                updates.append(dict(record_id=change.old.id, content=change.content, ttl=change.ttl,
+                                    change_date=now))
+                changed_domain_ids.add(change.old.domain_id)
+                if change.type == 'A' and change.content != change.old.content:
+                    ptr_moves[self.pdns.reverse_ip_to_ptr_record(change.old.content), change.name] = change
+            else:
+                domain = self._get_zone(change.name, self.a_domains)
+                if change.type == 'CNAME':
+                    # aliases are kept in their target's domain, as add_cname_record does
+                    try:
+                        domain = self._get_zone(change.content, self.a_domains)
+                    except PowergloveError:
+                        pass
+                inserts.append(dict(domain_id=domain.id, name=change.name, type=change.type,
+                                    content=change.content, ttl=change.ttl, prio=0, change_date=now))
+                changed_domain_ids.add(domain.id)
+                if change.type == 'A':
+                    ptr_row = self._ptr_row(change.content, change.name, change.ttl, now)
+                    inserts.append(ptr_row)
+                    changed_domain_ids.add(ptr_row['domain_id'])
+                    added_a_records.add((change.name, change.content))
+
+        # the PTR records of removed and moved A records, found with one query per chunk
+        ptr_ids = collections.defaultdict(list)
+        ptr_names = set(ptr_name for ptr_name, _ in ptr_removals | set(ptr_moves))
+        for chunk in chunked(ptr_names, 500):
+            query = self.pdns._select_record_rows(('PTR',)).where(records.c.name.in_(chunk))
+            for row in session.execute(query):
+                row = RecordRow(*row)
+                ptr_ids[row.name, row.content].append(row)
+
+        ptr_updates = []
+        for key in ptr_removals:
+            for row in ptr_ids.get(key, []):
+                removed_ids.append(row.id)
+                changed_domain_ids.add(row.domain_id)
+        for key, change in ptr_moves.iteritems():
+            new_ptr = self._ptr_row(change.content, change.name, change.ttl, now)
+            changed_domain_ids.add(new_ptr['domain_id'])
+            rows = ptr_ids.get(key)
+            if not rows:
+                inserts.append(new_ptr)
+            for row in rows or []:
+                changed_domain_ids.add(row.domain_id)
+                ptr_updates.append(dict(record_id=row.id, name=new_ptr['name'],
+                                        domain_id=new_ptr['domain_id'], change_date=now))
+
+        for chunk in chunked(removed_ids, 500):
+            session.execute(records.delete().where(records.c.id.in_(chunk)))
+            if self.pdns.expiries_enabled:
+                session.execute(expiries.delete().where(expiries.c.record_id.in_(chunk)))
+        # the updated records are indexed again below
+        self.pdns._unindex_record_ids(removed_ids + [update['record_id'] for update in updates])
+
+        if updates:
+            session.execute(records.update().where(records.c.id == bindparam('record_id')).values(
+                content=bindparam('content'), ttl=bindparam('ttl'), change_date=bindparam('change_date')),
+                updates)
+        if ptr_updates:
+            session.execute(records.update().where(records.c.id == bindparam('record_id')).values(
+                name=bindparam('name'), domain_id=bindparam('domain_id'),
+                change_date=bindparam('change_date')), ptr_updates)
+        if inserts:
+            session.execute(records.insert(), inserts)
+
+        if index_ips:
+            # (re)index the added and updated A records, which need their ids
+            select_a_records = select([records.c.id, records.c.name, records.c.content]).where(
+                records.c.type == 'A')
+            index_rows = []
+            for chunk in chunked(set(name for name, _ in added_a_records), 500):
+                index_rows.extend(row for row in session.execute(select_a_records.where(records.c.name.in_(chunk)))
+                                  if (row.name, row.content) in added_a_records)
+            for chunk in chunked([update['record_id'] for update in updates], 500):
+                index_rows.extend(session.execute(select_a_records.where(records.c.id.in_(chunk))))
+            if index_rows:
+                session.execute(ip_index.insert(), [dict(record_id=row.id, ip=int(IPAddress(row.content)))
+                                                    for row in index_rows])
+            self.pdns._adjust_subnet_usage([(int(IPAddress(row.content)), 1) for row in index_rows])
+
+        self.log.debug('applied %d removals, %d updates and %d inserts', len(removed_ids),
+                       len(updates) + len(ptr_updates), len(inserts))
+        return changed_domain_ids
+
@@ -1,4 +1,5 @@
 import collections
+import gc
 import logging
 import os
 
@@ -128,12 +129,20 @@ class BasePowergloveTestCase(unittest.TestCase):
 
 class PowergloveTestCase(BasePowergloveTestCase):
 
+    @staticmethod
+    def _remove_if_present(path):
+        if os.path.exists(path):
+            os.unlink(path)
+
     def get_temporary_file(self):
         """
         simplifies getting and cleaning up a temporary file
         """
         temp = NamedTemporaryFile(delete=False)
         self.addCleanup(os.unlink, temp.name)
+        # left alongside a database in WAL mode, see SqliteSettings
+        for suffix in ('-wal', '-shm'):
+            self.addCleanup(self._remove_if_present, temp.name + suffix)
 
         return temp
 
@@ -170,6 +179,9 @@ class PowergloveTestCase(BasePowergloveTestCase):
 
 
     def setUp(self):
+        # SQLite connections can only be closed by the thread that opened them, so those a test
+        # leaves behind are collected before a later test's threads could collect them
+        self.addCleanup(gc.collect)
         self.original_sqla_connect_string = self._setup_test_sqlite_database()
         self._setup_test_config_file(self.original_sqla_connect_string)
 
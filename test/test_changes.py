@@ -0,0 +1,101 @@
+import mock
+import sqlalchemy
+
+from powerglove_dns import main
+from powerglove_dns.changes import ChangeFollower
+from powerglove_dns.model import Record
+from powerglove_dns.powerglove import PowergloveDns
+
+from test import PowergloveTestCase
+
+
+class PowergloveChangeFeedTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveChangeFeedTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def test_changes_since(self):
+
+        rows, cursor = self.powerglove.changes_since()
+        self.assertEqual(len(rows), len(self.pdns.records))
+        # none of the mock records have a change date
+        self.assertEqual(cursor, 0)
+
+        # both changes within the same second, whatever the clock
+        with mock.patch('time.time', return_value=1400000000.5):
+            self.powerglove.add_a_record('changed.test.tld', ('192.168.132.10',), text_contents='text')
+            self.powerglove.add_cname_record('changed-alias.test.tld', 'changed.test.tld')
+        rows, cursor = self.powerglove.changes_since(cursor)
+        self.assertEqual(len(rows), len(self.pdns.records) + 4)
+        self.assertGreater(cursor, 0)
+
+        rows, next_cursor = self.powerglove.changes_since(cursor)
+        self.assertEqual(sorted((row.type, row.name) for row in rows),
+                         [('A', 'changed.test.tld'), ('CNAME', 'changed-alias.test.tld'),
+                          ('PTR', '10.132.168.192.in-addr.arpa'), ('TXT', 'changed.test.tld')])
+        self.assertEqual(next_cursor, cursor)
+
+        rows, _ = self.powerglove.changes_since(cursor, types=('CNAME',))
+        self.assertEqual([row.name for row in rows], ['changed-alias.test.tld'])
+
+    def test_follower_applies_additions_changes_and_removals(self):
+
+        follower = ChangeFollower(self.powerglove, logger=self.log)
+        polls = []
+        follower.add_listener(lambda *changes: polls.append(changes))
+
+        added, changed, removed = follower.poll()
+        self.assertEqual(len(added), len(self.pdns.records))
+        self.assertEqual(follower.poll(), ([], [], []))
+
+        self.powerglove.add_a_record('followed.test.tld', ('192.168.132.10',))
+        self.powerglove.remove_fqdn(self.pdns.records.stable_a_134.name)
+        session = self.Session()
+        session.query(Record).filter_by(name='followed.test.tld').update({'ttl': 60, 'change_date': Record.change_date + 1})
+        # written by another tool, without a change date
+        session.add(Record(None, self.pdns.domains.testing_a.id, 'undated.test.tld', 'A', '192.168.132.11',
+                           change_date=None))
+        session.commit()
+
+        added, changed, removed = follower.poll()
+        self.assertEqual(sorted(row.name for row in added),
+                         ['10.132.168.192.in-addr.arpa', 'followed.test.tld', 'undated.test.tld'])
+        self.assertEqual(len(changed), 0)
+        self.assertEqual(sorted(row.name for row in removed),
+                         [self.pdns.records.stable_ptr_134.name, self.pdns.records.stable_a_134.name])
+        self.assertEqual(follower.records[[row.id for row in added if row.name == 'followed.test.tld'][0]].ttl, 60)
+
+        session.query(Record).filter_by(name='undated.test.tld').update({'content': '192.168.132.12',
+                                                                          'change_date': 2 ** 31 - 1})
+        session.commit()
+        added, changed, removed = follower.poll()
+        self.assertEqual(([], ['192.168.132.12'], []), (added, [row.content for row in changed], removed))
+        self.assertEqual(len(polls), 3)
+
+        # a removal and an undated addition between polls leave the number of records as it was
+        self.powerglove.remove_fqdn('followed.test.tld')
+        session.query(Record).filter_by(name='undated.test.tld').update({'ttl': 120})
+        session.add_all([Record(None, self.pdns.domains.testing_a.id, 'undated%d.test.tld' % number, 'A',
+                                '192.168.132.%d' % (20 + number), change_date=None) for number in (1, 2)])
+        session.commit()
+        added, changed, removed = follower.poll()
+        self.assertEqual(sorted(row.name for row in added), ['undated1.test.tld', 'undated2.test.tld'])
+        self.assertEqual(sorted(row.name for row in removed),
+                         ['10.132.168.192.in-addr.arpa', 'followed.test.tld'])
+        self.assertEqual(sorted(follower.records), sorted(self.powerglove.get_record_ids()))
+
+    def test_creating_the_change_date_index(self):
+
+        def index_names():
+            return [index['name'] for index in
+                    sqlalchemy.inspect(self.powerglove._sqla_engine).get_indexes('records')]
+
+        self.assertIn('powerglove_records_change_date', index_names())
+        self.Session().execute('DROP INDEX powerglove_records_change_date')
+        self.assertNotIn('powerglove_records_change_date', index_names())
+
+        self.assertEqual(main(['--create_indexes'], logger=self.log), 0)
+        self.assertIn('powerglove_records_change_date', index_names())
+        self.assertEqual(self.powerglove.create_indexes(), [])
@@ -0,0 +1,118 @@
+import collections
+import threading
+
+from netaddr import IPAddress
+
+from powerglove_dns.coalescer import AllocationCoalescer
+from powerglove_dns.model import Domain, RecordIpIndex, SubnetUsage
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+
+from test import PowergloveTestCase
+
+
+class PowergloveAllocationCoalescerTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveAllocationCoalescerTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.addCleanup(self.powerglove.close)
+
+    def test_add_a_records(self):
+
+        results = self.powerglove.add_a_records([('one.test.tld', ('192.168.132.0/24',)),
+                                                 ('test_existing.test.tld', ('192.168.132.0/24',)),
+                                                 ('two.test.tld', ('192.168.132.3', '192.168.132.10'), 60,
+                                                  'second'),
+                                                 ('one.test.tld', ('192.168.132.0/24',)),
+                                                 ('three.nowhere', ('192.168.132.0/24',)),
+                                                 ('three.test.tld', ('192.168.132.0/24',))])
+
+        # the existing name, the repeated name and the name outside any zone fail on their own
+        for index in (1, 3, 4):
+            self.assertIsInstance(results[index], PowergloveError)
+        # the overlapping ranges are handed out distinct addresses
+        self.assertEqual([(fqdn, str(ip)) for fqdn, ip in (results[0], results[2], results[5])],
+                         [('one.test.tld', '192.168.132.3'), ('two.test.tld', '192.168.132.4'),
+                          ('three.test.tld', '192.168.132.5')])
+
+        self.assertRecordExists(type='A', name='two.test.tld', content='192.168.132.4', ttl=60)
+        self.assertRecordExists(type='TXT', name='two.test.tld', content='second')
+        self.assertRecordExists(type='PTR', name='5.132.168.192.in-addr.arpa', content='three.test.tld')
+        self.assertRecordDoesNotExist(name='three.nowhere')
+
+        # one serial bump for the whole batch
+        session = self.Session()
+        for domain_id in (self.pdns.domains.testing_a.id, self.pdns.domains.testing_ptr_132.id):
+            self.assertEqual(session.query(Domain).get(domain_id).notified_serial % 100, 1)
+        self.assertIsNone(session.query(Domain).get(self.pdns.domains.stable_a.id).notified_serial)
+
+    def test_add_a_records_maintains_the_index(self):
+
+        self.powerglove.rebuild_subnet_usage()
+        results = self.powerglove.add_a_records([('host%d.test.tld' % number, ('192.168.133.0/24',))
+                                                 for number in xrange(5)])
+        self.assertEqual([str(ip) for _, ip in results],
+                         ['192.168.133.3', '192.168.133.4', '192.168.133.5', '192.168.133.6', '192.168.133.7'])
+
+        session = self.Session()
+        indexed = collections.Counter(ip >> 8 for ip, in session.query(RecordIpIndex.ip))
+        self.assertEqual(dict((usage.subnet, usage.used) for usage in session.query(SubnetUsage) if usage.used),
+                         dict(indexed))
+        self.assertEqual(indexed[int(IPAddress('192.168.133.0')) >> 8], 8)
+
+    def test_concurrent_requests_are_made_together(self):
+
+        names = ['host%d.test.tld' % number for number in xrange(8)]
+        names.append('test_existing.test.tld')
+        results = {}
+
+        def request(coalescer, name):
+            try:
+                results[name] = coalescer.add_a_record(name, ('192.168.132.0/24',))
+            except PowergloveError as error:
+                results[name] = error
+
+        # long enough a window that the batch is only made once it's full
+        with AllocationCoalescer(self.powerglove, window=30, batch_size=len(names)) as coalescer:
+            threads = [threading.Thread(target=request, args=(coalescer, name)) for name in names]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual((coalescer.batch_count, coalescer.request_count), (1, len(names)))
+        self.assertIsInstance(results.pop('test_existing.test.tld'), PowergloveError)
+        ips = [ip for _, ip in results.values()]
+        self.assertEqual(sorted(ips), [IPAddress('192.168.132.%d' % number) for number in xrange(3, 11)])
+        for name, ip in results.values():
+            self.assertRecordExists(type='A', name=name, content=str(ip))
+
+    def test_batches_are_limited(self):
+
+        with AllocationCoalescer(self.powerglove, window=0, batch_size=1) as coalescer:
+            self.assertEqual(str(coalescer.add_a_record('one.test.tld', ('192.168.132.0/24',))[1]),
+                             '192.168.132.3')
+            with self.assertRaises(PowergloveError):
+                coalescer.add_a_record('one.test.tld', ('192.168.132.0/24',))
+        self.assertEqual(coalescer.batch_count, 2)
+
+        with self.assertRaises(PowergloveError):
+            coalescer.add_a_record('two.test.tld', ('192.168.132.0/24',))
+
+    def test_config(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[coalescing]\nwindow = 0.02\nbatch_size = 50\n')
+        coalescer = AllocationCoalescer.from_config(self.powerglove)
+        self.assertEqual((coalescer.window, coalescer.batch_size), (0.02, 50))
+
+        with self.assertRaises(PowergloveError):
+            AllocationCoalescer(self.powerglove, batch_size=0)
+
+        with open(PowergloveDns.def_config_file) as config_file:
+            config = config_file.read()
+        with open(PowergloveDns.def_config_file, 'w') as config_file:
+            config_file.write(config.replace('batch_size = 50', 'batch_size = none'))
+        with self.assertRaises(PowergloveError):
+            AllocationCoalescer.from_config(self.powerglove)
@@ -0,0 +1,121 @@
+import ast
+import os
+import shutil
+import struct
+import tempfile
+
+from netaddr import IPAddress
+
+from powerglove_dns import main
+from powerglove_dns.columns import ColumnExport, NpyColumnWriter, load_columns
+from powerglove_dns.model import Record
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+
+from test import PowergloveTestCase, unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def read_npy(path):
+    """
+    @return: the C{tuple} of the header C{dict} and the items of a one dimensional .npy file
+    """
+
+    with open(path, 'rb') as npy_file:
+        data = npy_file.read()
+    assert data[:8] == NpyColumnWriter.magic
+    header_length, = struct.unpack_from('<H', data, 8)
+    header = ast.literal_eval(data[10:10 + header_length])
+    body = data[10 + header_length:]
+
+    count, = header['shape']
+    formats = {'<i4': 'i', '<u4': 'I', '<i8': 'q', '|u1': 'B'}
+    if header['descr'] in formats:
+        items = struct.unpack('<%d%s' % (count, formats[header['descr']]), body)
+    else:
+        width = int(header['descr'][2:])
+        items = [body[offset:offset + width].rstrip('\0') for offset in xrange(0, len(body), width)]
+    assert len(items) == count
+    return header, list(items)
+
+
+class PowergloveColumnExportTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveColumnExportTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'records')
+
+    def read_columns(self):
+        columns = {}
+        for file_name in os.listdir(self.path):
+            header, items = read_npy(os.path.join(self.path, file_name))
+            self.assertFalse(header['fortran_order'])
+            columns[file_name[:-len('.npy')]] = items
+        return columns
+
+    def test_export(self):
+
+        session = self.Session()
+        session.add(Record(None, self.pdns.domains.testing_a.id, u'caf\xe9.test.tld', 'A', '192.168.132.10'))
+        session.commit()
+        self.assertEqual(main(['--export_columns', self.path], logger=self.log), 0)
+
+        records = sorted(self.Session().query(Record), key=lambda record: record.id)
+        columns = self.read_columns()
+        self.assertEqual(sorted(columns), ['change_date', 'domain_id', 'id', 'ip', 'name_data',
+                                           'name_offsets', 'ttl', 'type'])
+
+        self.assertEqual(columns['id'], [record.id for record in records])
+        self.assertEqual(columns['domain_id'], [record.domain_id for record in records])
+        self.assertEqual(columns['type'], [record.type for record in records])
+        self.assertEqual(columns['ttl'], [-1 if record.ttl is None else record.ttl for record in records])
+        self.assertEqual(columns['ip'], [int(IPAddress(record.content)) if record.type == 'A' else 0
+                                         for record in records])
+
+        offsets, data = columns['name_offsets'], ''.join(chr(byte) for byte in columns['name_data'])
+        self.assertEqual(len(offsets), len(records) + 1)
+        self.assertEqual([data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])],
+                         [record.name for record in records])
+
+    def test_chunks_make_no_difference(self):
+
+        ColumnExport(self.powerglove).export(self.path)
+        whole = self.read_columns()
+        # exporting again replaces the previous export
+        self.assertEqual(ColumnExport(self.powerglove, chunk_size=3).export(self.path), len(whole['id']))
+        self.assertEqual(self.read_columns(), whole)
+        self.assertEqual(os.listdir(self.directory), ['records'])
+
+    def test_only_previous_exports_are_replaced(self):
+
+        os.mkdir(self.path)
+        with open(os.path.join(self.path, 'precious.txt'), 'w') as precious:
+            precious.write('keep me')
+        with self.assertRaises(PowergloveError):
+            main(['--export_columns', self.path], logger=self.log)
+        self.assertEqual(os.listdir(self.path), ['precious.txt'])
+
+        os.remove(os.path.join(self.path, 'precious.txt'))
+        with open(self.path + '.npy', 'w'):
+            pass
+        # an empty directory can be written to, a file can't
+        self.assertEqual(main(['--export_columns', self.path], logger=self.log), 0)
+        with self.assertRaises(PowergloveError):
+            ColumnExport(self.powerglove).export(self.path + '.npy')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['records', 'records.npy'])
+
+    @unittest.skipUnless(numpy, 'NumPy is not installed')
+    def test_load_columns(self):
+
+        ColumnExport(self.powerglove).export(self.path)
+        columns = load_columns(self.path)
+        self.assertIsInstance(columns['ip'], numpy.memmap)
+        self.assertEqual(columns['ip'].dtype, numpy.uint32)
+        self.assertEqual(columns['id'].tolist(), self.read_columns()['id'])
@@ -1,6 +1,13 @@
+import json
+import StringIO
+
+import mock
+
+from netaddr import IPAddress
+
 from test import PowergloveTestCase
 from powerglove_dns import main
-from powerglove_dns.powerglove import PowergloveError
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
 from powerglove_dns.model import Record
 
 # this is either unittest2 or built-in unittest if >= py 2.7
@@ -329,3 +336,200 @@ class PowergloveDNSCommandLineTestCase(PowergloveTestCase):
         with self.assertRaises(PowergloveError) as cm:
             self.run_with_args(['--add', 'fall.down'])
         self.assertIn("unable to find a suitable range", cm.exception.output)
+
+    def test_adding_from_the_zone_pool(self):
+        """
+        without a range, the address comes from the pool of the FQDN's zone
+        """
+
+        self.assertEqual(self.run_with_args(['--add', 'pooled.stable.tld']),
+                         ('pooled.stable.tld', IPAddress('192.168.134.3')))
+        self.assertRecordExists(type='PTR', name='3.134.168.192.in-addr.arpa', content='pooled.stable.tld')
+
+    def test_adding_the_next_name(self):
+
+        self.run_with_args(['--add', 'app-1.stable.tld', '192.168.134.0/24'])
+        self.assertEqual(self.run_with_args(['--add_next', 'app-{n}.stable.tld', '192.168.134.0/24']),
+                         ('app-2.stable.tld', IPAddress('192.168.134.4')))
+
+    def test_creating_cnames_in_a_batch(self):
+
+        cname_file = self.get_temporary_file()
+        with cname_file:
+            cname_file.write('# aliases for the migration\n'
+                             'batch1.test.tld %s\n'
+                             '\n'
+                             'batch2.test.tld   %s  # trailing comment\n'
+                             'batch.stable.tld %s\n' % (self.pdns.records.testing_a_132.name,
+                                                        self.pdns.records.testing_a_133.name,
+                                                        self.pdns.records.stable_a_134.name))
+
+        created = self.run_with_args(['--cname_batch', cname_file.name])
+        self.assertEqual(len(created), 3)
+        self.assertRecordExists(type='CNAME', name='batch1.test.tld', content=self.pdns.records.testing_a_132.name)
+        self.assertRecordExists(type='CNAME', name='batch.stable.tld', content=self.pdns.records.stable_a_134.name)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.stable_a.id).notified_serial)
+
+    def test_cname_batches_are_all_or_nothing(self):
+
+        existing_fqdn = self.pdns.records.testing_a_132.name
+        for pairs in ([('new.test.tld', existing_fqdn), ('other.test.tld', 'missing.test.tld')],
+                      [('new.test.tld', existing_fqdn), (self.pdns.records.cname_record.name, existing_fqdn)],
+                      [('new.test.tld', existing_fqdn), (self.pdns.records.txt_record.name, existing_fqdn)],
+                      [('new.test.tld', existing_fqdn), ('new.test.tld', self.pdns.records.testing_a_133.name)],
+                      # a CNAME can't be the target of another CNAME
+                      [('new.test.tld', self.pdns.records.cname_record.name)]):
+            with self.assertRaises(PowergloveError):
+                PowergloveDns(logger=self.log).add_cname_records(pairs)
+            self.assertRecordDoesNotExist(type='CNAME', name='new.test.tld')
+
+    def test_cascading_removal_of_record_with_cnames(self):
+        """
+        tests that cascading removes the A record along with the chain of CNAMEs pointing at it
+        """
+
+        a_fqdn = self.pdns.records.record_with_cname.name
+        PowergloveDns(logger=self.log).add_cname_record('other.stable.tld', a_fqdn)
+        session = self.Session()
+        session.add(Record(None, self.pdns.domains.testing_a.id, 'second.test.tld', 'CNAME',
+                           self.pdns.records.cname_record.name))
+        session.add(Record(None, self.pdns.domains.testing_a.id, 'second.test.tld', 'TXT', 'alias text'))
+        session.commit()
+
+        removed = self.run_with_args(['--remove', a_fqdn, '--cascade'])
+
+        self.assertEqual(sorted((row.type, row.name) for row in removed),
+                         [('A', a_fqdn), ('CNAME', self.pdns.records.cname_record.name),
+                          ('CNAME', 'other.stable.tld'), ('CNAME', 'second.test.tld'),
+                          ('TXT', 'second.test.tld')])
+        for name in (a_fqdn, self.pdns.records.cname_record.name, 'second.test.tld', 'other.stable.tld'):
+            self.assertRecordDoesNotExist(name=name)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+        self.assertRecordExists(type='A', name=self.pdns.records.testing_a_133.name)
+
+    def test_cascading_removal_also_removes_ptr_records(self):
+
+        removed = self.run_with_args(['--remove', self.pdns.records.stable_a_134.name, '--cascade'])
+        self.assertEqual(sorted(row.type for row in removed), ['A', 'PTR'])
+        self.assertRecordDoesNotExist(type='PTR', name=self.pdns.records.stable_ptr_134.name)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.stable_ptr_134.id).notified_serial)
+
+        with self.assertRaises(PowergloveError):
+            self.run_with_args(['--remove', self.pdns.records.stable_a_134.name, '--cascade'])
+
+    def test_moving_a_host(self):
+
+        a_record = self.pdns.records.testing_a_132
+        self.assertEqual(self.run_with_args(['--move', a_record.name, '192.168.133.0/24']),
+                         (a_record.name, IPAddress('192.168.133.3')))
+
+        self.assertEqual(self.getOneRecord(type='A', name=a_record.name).id, a_record.id)
+        self.assertRecordDoesNotExist(type='PTR', name=self.pdns.records.testing_ptr_132.name)
+        ptr_record = self.getOneRecord(type='PTR', content=a_record.name)
+        self.assertEqual((ptr_record.id, ptr_record.name, ptr_record.domain_id),
+                         (self.pdns.records.testing_ptr_132.id, '3.133.168.192.in-addr.arpa',
+                          self.pdns.domains.testing_ptr_133.id))
+        for domain in (self.pdns.domains.testing_a, self.pdns.domains.testing_ptr_132,
+                       self.pdns.domains.testing_ptr_133):
+            self.assertIsNotNone(self.getOneDomain(id=domain.id).notified_serial)
+
+        with self.assertRaises(PowergloveError):
+            self.run_with_args(['--move', 'missing.test.tld', '192.168.133.0/24'])
+
+    def test_renaming_a_host(self):
+
+        a_record = self.pdns.records.record_with_cname
+        updated = self.run_with_args(['--rename', a_record.name, 'renamed.stable.tld'])
+
+        self.assertEqual(sorted((row.type, row.name, row.content) for row in updated),
+                         [('A', 'renamed.stable.tld', a_record.content),
+                          ('CNAME', self.pdns.records.cname_record.name, 'renamed.stable.tld')])
+        self.assertEqual(self.getOneRecord(type='A', name='renamed.stable.tld').domain_id,
+                         self.pdns.domains.stable_a.id)
+        self.assertRecordDoesNotExist(name=a_record.name)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.stable_a.id).notified_serial)
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+
+    def test_renaming_updates_text_and_ptr_records(self):
+
+        self.run_with_args(['--rename', self.pdns.records.txt_record.name, 'text2.test.tld'])
+        self.assertRecordExists(type='TXT', name='text2.test.tld', content=self.pdns.records.txt_record.content)
+
+        self.run_with_args(['--rename', self.pdns.records.stable_a_134.name, 'renamed.stable.tld'])
+        self.assertRecordExists(type='PTR', name=self.pdns.records.stable_ptr_134.name, content='renamed.stable.tld')
+
+        with self.assertRaises(PowergloveError):
+            self.run_with_args(['--rename', 'renamed.stable.tld', self.pdns.records.stable_a_135.name])
+        with self.assertRaises(PowergloveError):
+            self.run_with_args(['--rename', 'missing.stable.tld', 'other.stable.tld'])
+
+    def run_batch(self, commands, *options):
+        output = StringIO.StringIO()
+        with mock.patch('sys.stdin', StringIO.StringIO(commands)), mock.patch('sys.stdout', output):
+            failures = self.run_with_args(['--batch', '-'] + list(options))
+        return failures, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_batch(self):
+
+        failures, results = self.run_batch('# set up the web hosts\n'
+                                           '--add web1.stable.tld 192.168.134.0/24 --ttl 60\n'
+                                           '["--cname", "www.stable.tld", "web1.stable.tld"]\n'
+                                           '\n'
+                                           '--is_present www.stable.tld\n'
+                                           '--search "web*.stable.tld"\n')
+
+        self.assertEqual(failures, 0)
+        self.assertEqual([(result['line'], result['ok']) for result in results],
+                         [(2, True), (3, True), (5, True), (6, True)])
+        self.assertEqual(results[0]['result'], ['web1.stable.tld', '192.168.134.3'])
+        self.assertEqual(results[2]['result'], True)
+        self.assertEqual([row['name'] for row in results[3]['output']], ['web1.stable.tld'])
+        self.assertRecordExists(type='A', name='web1.stable.tld', ttl=60)
+
+    def test_batch_errors(self):
+
+        commands = ('--add one.stable.tld 192.168.134.0/24\n'
+                    '--remove missing.stable.tld\n'
+                    '--set pdns_connect_string sqlite://\n'
+                    '--add two.stable.tld 192.168.134.0/24\n')
+
+        failures, results = self.run_batch(commands)
+        self.assertEqual(failures, 1)
+        self.assertEqual([result['ok'] for result in results], [True, False])
+        self.assertRecordExists(type='A', name='one.stable.tld')
+
+        failures, results = self.run_batch(commands.replace('one.', 'three.').replace('two.', 'four.'),
+                                           '--keep_going')
+        self.assertEqual(failures, 2)
+        self.assertEqual([result['ok'] for result in results], [True, False, False, True])
+        self.assertIn('cannot be used within a batch', results[2]['error'])
+        self.assertRecordExists(type='A', name='four.stable.tld')
+
+    def test_batch_commit_groups(self):
+
+        failures, results = self.run_batch('--add one.stable.tld 192.168.134.0/24\n'
+                                           '--add two.stable.tld 192.168.134.0/24\n'
+                                           '--add three.stable.tld 192.168.134.0/24\n'
+                                           '--add one.stable.tld 192.168.134.0/24\n'
+                                           '--add four.stable.tld 192.168.134.0/24\n',
+                                           '--commit_every', '2', '--keep_going')
+
+        self.assertEqual(failures, 2)
+        self.assertEqual([result['ok'] for result in results], [True, True, False, False, True])
+        self.assertTrue(results[2]['error'].startswith('rolled back'))
+        for name in ('one', 'two', 'four'):
+            self.assertRecordExists(type='A', name='%s.stable.tld' % name)
+        self.assertRecordDoesNotExist(name='three.stable.tld')
+
+        # the commands after a failure in its group still get their result line
+        failures, results = self.run_batch('--add one.stable.tld 192.168.134.0/24\n'
+                                           '--add five.stable.tld 192.168.134.0/24\n'
+                                           '--add six.stable.tld 192.168.134.0/24\n',
+                                           '--commit_every', '2', '--keep_going')
+
+        self.assertEqual(failures, 2)
+        self.assertEqual([(result['line'], result['ok']) for result in results], [(1, False), (2, False), (3, True)])
+        self.assertTrue(results[1]['error'].startswith('not run: rolled back'))
+        self.assertRecordDoesNotExist(name='five.stable.tld')
+        self.assertRecordExists(type='A', name='six.stable.tld')
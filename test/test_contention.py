@@ -0,0 +1,147 @@
+import sqlite3
+
+import mock
+import sqlalchemy.exc
+
+from powerglove_dns.powerglove import (PowergloveDns, PowergloveError, RetryPolicy,
+                                       classify_database_error)
+
+from test import PowergloveTestCase
+
+
+class FakePostgresError(Exception):
+    """
+    stands in for the psycopg2 errors, which carry the SQLSTATE as pgcode
+    """
+
+    def __init__(self, pgcode, message):
+        super(FakePostgresError, self).__init__(message)
+        self.pgcode = pgcode
+
+
+def wrapped(original):
+    return sqlalchemy.exc.OperationalError('UPDATE domains ...', {}, original)
+
+
+class PowergloveContentionTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveContentionTestCase, self).setUp()
+        self.sleeps = []
+        self.retry_policy = RetryPolicy(lock_timeout=0.05, attempts=3, sleep=self.sleeps.append,
+                                        random=lambda: 0.5)
+        self.powerglove = PowergloveDns(logger=self.log, retry_policy=self.retry_policy)
+
+        # a second writer, holding the database's write lock until it's released
+        self.locker = sqlite3.connect(self.original_sqla_connect_string[len('sqlite:///'):],
+                                      isolation_level=None)
+        self.addCleanup(self.locker.close)
+        self.locked = False
+
+    def lock(self):
+        self.locker.execute('BEGIN IMMEDIATE')
+        self.locked = True
+
+    def release(self):
+        if self.locked:
+            self.locker.execute('ROLLBACK')
+            self.locked = False
+
+    def test_classify_database_error(self):
+
+        self.assertEqual(classify_database_error(wrapped(FakePostgresError('40P01', 'deadlock detected'))),
+                         'deadlock')
+        self.assertEqual(classify_database_error(FakePostgresError('40001', 'could not serialize access')),
+                         'serialization')
+        self.assertEqual(classify_database_error(wrapped(FakePostgresError('57014', 'canceling statement'))),
+                         'statement_timeout')
+        self.assertEqual(classify_database_error(wrapped(Exception(1205, 'Lock wait timeout exceeded'))),
+                         'lock_timeout')
+        self.assertEqual(classify_database_error(wrapped(sqlite3.OperationalError('database is locked'))),
+                         'lock_timeout')
+        self.assertIsNone(classify_database_error(wrapped(FakePostgresError('23505', 'duplicate key'))))
+        self.assertIsNone(classify_database_error(wrapped(sqlite3.OperationalError('no such table: x'))))
+
+    def test_timeout_statements(self):
+
+        policy = RetryPolicy(statement_timeout=30, lock_timeout=2.5)
+        self.assertEqual(policy.timeout_statements('postgresql'),
+                         ['SET statement_timeout = 30000', 'SET lock_timeout = 2500'])
+        self.assertEqual(policy.timeout_statements('mysql'),
+                         ['SET SESSION max_execution_time = 30000',
+                          'SET SESSION innodb_lock_wait_timeout = 3'])
+        self.assertEqual(policy.timeout_statements('sqlite'), ['PRAGMA busy_timeout = 2500'])
+        self.assertEqual(RetryPolicy().timeout_statements('postgresql'), [])
+
+        self.assertEqual(self.powerglove.session.execute('PRAGMA busy_timeout').scalar(), 50)
+
+    def test_config(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\nlock_timeout = 1.5\nretry_attempts = 7\n')
+        policy = PowergloveDns(logger=self.log).retry_policy
+        self.assertEqual((policy.statement_timeout, policy.lock_timeout, policy.attempts), (None, 1.5, 7))
+
+        PowergloveDns.set_config('retry_attempts', 'many')
+        with self.assertRaises(PowergloveError):
+            PowergloveDns(logger=self.log)
+
+    def test_gives_up_behind_a_stuck_writer(self):
+
+        self.lock()
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            self.powerglove.add_a_record('blocked.test.tld', ('192.168.132.0/24',))
+        self.release()
+
+        self.assertEqual(self.powerglove.contention_counters,
+                         {'lock_timeout': 3, 'retries': 2, 'gave_up': 1})
+        # full jitter with the random number at 0.5 waits half of the exponential delay
+        self.assertEqual(self.sleeps, [0.025, 0.05])
+        self.assertRecordDoesNotExist(name='blocked.test.tld')
+
+        # the failed attempts left nothing behind for the next operation
+        self.powerglove.add_a_record('unblocked.test.tld', ('192.168.132.0/24',))
+        self.assertRecordExists(type='A', name='unblocked.test.tld')
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+
+    def test_retries_once_the_lock_is_released(self):
+
+        self.retry_policy.sleep = lambda delay: self.release()
+        self.lock()
+        self.assertEqual(self.powerglove.add_cname_record('waited.test.tld', 'cnamee.test.tld'),
+                         ('waited.test.tld', 'cnamee.test.tld'))
+
+        self.assertEqual(self.powerglove.contention_counters, {'lock_timeout': 1, 'retries': 1})
+        self.assertRecordExists(type='CNAME', name='waited.test.tld')
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+
+    def test_retries_deadlocks_but_not_statement_timeouts(self):
+
+        deadlock = wrapped(FakePostgresError('40P01', 'deadlock detected'))
+        attempts = []
+
+        def deadlocked_once(ip_range):
+            attempts.append(ip_range)
+            if len(attempts) == 1:
+                raise deadlock
+            return PowergloveDns.get_available_ip_address(self.powerglove, ip_range)
+
+        with mock.patch.object(self.powerglove, 'get_available_ip_address', side_effect=deadlocked_once):
+            self.powerglove.add_a_record('retried.test.tld', ('192.168.132.0/24',))
+        self.assertRecordExists(type='A', name='retried.test.tld')
+        self.assertEqual(self.powerglove.contention_counters, {'deadlock': 1, 'retries': 1})
+
+        timeout = wrapped(FakePostgresError('57014', 'canceling statement due to statement timeout'))
+        with mock.patch.object(self.powerglove, 'get_available_ip_address', side_effect=timeout):
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                self.powerglove.add_a_record('timed_out.test.tld', ('192.168.132.0/24',))
+        self.assertEqual(self.powerglove.contention_counters,
+                         {'deadlock': 1, 'retries': 1, 'statement_timeout': 1, 'gave_up': 1})
+
+        # within a transaction, retrying is left to whoever owns it
+        with mock.patch.object(self.powerglove, 'get_available_ip_address', side_effect=deadlock):
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                with self.powerglove.transaction():
+                    self.powerglove.add_a_record('grouped.test.tld', ('192.168.132.0/24',))
+        self.assertEqual(self.powerglove.contention_counters['retries'], 1)
@@ -1,6 +1,19 @@
-from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+import collections
+import json
+import StringIO
+import threading
+import time
 
-from test import PowergloveTestCase
+import mock
+
+from netaddr import IPAddress
+
+from powerglove_dns import main
+from powerglove_dns.model import Domain, Record, RecordExpiry, RecordIpIndex, SubnetUsage
+from powerglove_dns.powerglove import (ExclusionPolicy, PowergloveDns, PowergloveError, SqliteSettings,
+                                       parse_duration, parse_ip_span)
+
+from test import PowergloveTestCase, setup_mock_pdns
 
 class PowergloveUtilsTestCase(PowergloveTestCase):
 
@@ -49,4 +62,815 @@ class PowergloveUtilsTestCase(PowergloveTestCase):
         with self.assertRaises(PowergloveError):
             self.powerglove.get_ptr_domain_from_ptr_record_name('1.1.168.192.in-addr.arpa')
         with self.assertRaises(PowergloveError):
-            self.powerglove.get_ptr_domain_from_ptr_record_name('1.0.0.127.in-addr.arpa')
\ No newline at end of file
+            self.powerglove.get_ptr_domain_from_ptr_record_name('1.0.0.127.in-addr.arpa')
+
+    def test_scan_records(self):
+        """
+        test that scans return the requested columns of the matching records, as plain rows
+        """
+
+        orm_contents = sorted(record.content for record in self.powerglove.get_existing_records())
+        self.assertEqual(sorted(content for content, in self.powerglove.scan_records()), orm_contents)
+
+        rows = list(self.powerglove.scan_records(('name', 'content'), ('A', 'CNAME'),
+                                                 name='test_existing.stable.tld'))
+        self.assertEqual([tuple(row) for row in rows], [('test_existing.stable.tld', '192.168.134.2')])
+
+        with self.assertRaises(PowergloveError):
+            list(self.powerglove.scan_records(rec_type='MX'))
+
+    def test_record_lookups(self):
+        """
+        test that the cached lookups bind the values of each call, whichever criteria are used
+        """
+
+        records = self.pdns.records
+        for _ in range(2):
+            self.assertEqual(self.powerglove.get_record(name=records.testing_a_132.name).id,
+                             records.testing_a_132.id)
+            self.assertIsNone(self.powerglove.get_record('CNAME', name=records.testing_a_132.name))
+            self.assertEqual(self.powerglove.get_record('PTR', content=records.testing_a_133.name,
+                                                        domain_id=self.pdns.domains.testing_ptr_133.id).id,
+                             records.testing_ptr_133.id)
+            ptr_records = self.powerglove.get_records('PTR', name=records.stable_ptr_135.name)
+            self.assertEqual([record.id for record in ptr_records], [records.stable_ptr_135.id])
+            self.assertEqual(sorted(record.id for record in self.powerglove.get_existing_records(
+                domain_id=self.pdns.domains.stable_a.id)), [records.stable_a_134.id, records.stable_a_135.id])
+            self.assertTrue(self.powerglove.fqdn_is_present(records.cname_record.name))
+            self.assertFalse(self.powerglove.fqdn_is_present(records.testing_ptr_132.name))
+
+        with self.assertRaises(PowergloveError):
+            self.powerglove.get_record('MX', name=records.testing_a_132.name)
+
+class PowergloveExclusionPolicyTestCase(PowergloveTestCase):
+
+    def _write_exclusions(self, exclusions):
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n' + exclusions)
+
+    def test_default_policy(self):
+        """
+        without an [exclusions] section, addresses ending in 0, 1 or 255 are excluded, as before
+        """
+
+        powerglove = PowergloveDns(logger=self.log)
+        self.assertFalse(powerglove.is_valid_address(IPAddress('192.168.133.0')))
+        self.assertFalse(powerglove.is_valid_address(IPAddress('192.168.133.1')))
+        self.assertFalse(powerglove.is_valid_address(IPAddress('192.168.133.255')))
+        self.assertTrue(powerglove.is_valid_address(IPAddress('192.168.133.2')))
+        self.assertTrue(powerglove.is_valid_address('192.168.133.2'))
+        self.assertFalse(powerglove.is_valid_address('192.168.133.255'))
+
+    def test_iter_allowed_matches_is_excluded(self):
+        """
+        the integer walk should agree with the per-address check, across block and span edges
+        """
+
+        policy = ExclusionPolicy((0, 255), [parse_ip_span('192.168.132.250-192.168.133.4'),
+                                            parse_ip_span('192.168.133.6'),
+                                            parse_ip_span('192.168.133.7/32'),
+                                            parse_ip_span('192.168.133.100-120')])
+        first, last = int(IPAddress('192.168.132.240')), int(IPAddress('192.168.134.3'))
+        self.assertEqual(list(policy.iter_allowed(first, last)),
+                         [ip for ip in xrange(first, last + 1) if not policy.is_excluded(ip)])
+        self.assertEqual(list(policy.iter_allowed(first + 12, first + 18)), [])
+
+        with self.assertRaises(PowergloveError):
+            parse_ip_span('192.168.133.300')
+
+    def test_configured_policy(self):
+        """
+        test that subnets' network, broadcast, gateway and reserved addresses are skipped
+        """
+
+        self._write_exclusions('[exclusions]\n'
+                               'last_octets = ,\n'
+                               '[[192.168.133.0/25]]\n'
+                               'gateway_offsets = 2, 3\n'
+                               'reserved = 192.168.133.5-192.168.133.9, 192.168.133.11\n'
+                               '[[192.168.133.128/25]]\n'
+                               'network_broadcast = False\n')
+
+        powerglove = PowergloveDns(logger=self.log)
+        ip_range = powerglove.get_ip_range(('192.168.133.0', '192.168.133.12'))
+        self.assertEqual([str(IPAddress(ip)) for ip in powerglove.exclusions.iter_allowed(ip_range.first,
+                                                                                          ip_range.last)],
+                         ['192.168.133.1', '192.168.133.4', '192.168.133.10', '192.168.133.12'])
+        self.assertFalse(powerglove.is_valid_address(IPAddress('192.168.133.127')))
+        self.assertTrue(powerglove.is_valid_address(IPAddress('192.168.133.128')))
+
+        self.assertEqual(str(powerglove.add_a_record('gateway.test.tld', ('192.168.133.2', '192.168.133.12'))[1]),
+                         '192.168.133.4')
+        powerglove.rebuild_ip_index()
+        self.assertEqual(str(powerglove.add_a_record('pool.test.tld', ('192.168.133.2', '192.168.133.12'))[1]),
+                         '192.168.133.10')
+
+
+class PowergloveZonePoolTestCase(PowergloveTestCase):
+
+    def test_pools_are_inferred_from_reverse_zones(self):
+
+        powerglove = PowergloveDns(logger=self.log)
+        self.assertEqual(dict((zone, str(pool)) for zone, pool in powerglove.zone_pools.items()),
+                         {'test.tld': '192.168.132.0-192.168.133.255',
+                          'stable.tld': '192.168.134.0-192.168.135.255',
+                          'tld': '10.10.0.0-10.10.255.255'})
+
+        self.assertEqual(str(powerglove.get_ip_range((), 'host.super.stable.tld')),
+                         '192.168.134.0-192.168.135.255')
+        self.assertEqual(str(powerglove.get_ip_range((), 'host.tld')), '10.10.0.0-10.10.255.255')
+        with self.assertRaises(PowergloveError):
+            powerglove.get_ip_range((), 'host.unknowntld')
+
+    def test_configured_pools_take_precedence(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[pools]\n'
+                              'stable.tld = 192.168.135.0/24\n'
+                              'super.stable.tld = 192.168.135.10, 192.168.135.20\n')
+
+        powerglove = PowergloveDns(logger=self.log)
+        self.assertEqual(str(powerglove.get_ip_range((), 'host.stable.tld')), '192.168.135.0-192.168.135.255')
+        self.assertEqual(powerglove.add_a_record('host.super.stable.tld'),
+                         ('host.super.stable.tld', IPAddress('192.168.135.10')))
+
+    def test_pools_are_loaded_once(self):
+
+        powerglove = PowergloveDns(logger=self.log)
+        with mock.patch.object(powerglove, '_infer_zone_pools', wraps=powerglove._infer_zone_pools) as infer:
+            powerglove.get_ip_range((), 'one.stable.tld')
+            powerglove.get_ip_range((), 'two.stable.tld')
+            self.assertEqual(infer.call_count, 1)
+            # only the zone being allocated in is inferred
+            self.assertEqual(infer.call_args, mock.call(['stable.tld']))
+
+            powerglove.refresh_zone_pools()
+            powerglove.get_ip_range((), 'three.stable.tld')
+            self.assertEqual(infer.call_count, 2)
+
+    def test_configured_pools_are_not_inferred(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[pools]\nstable.tld = 192.168.135.0/24\n')
+
+        powerglove = PowergloveDns(logger=self.log)
+        with mock.patch.object(powerglove, '_infer_zone_pools', wraps=powerglove._infer_zone_pools) as infer:
+            self.assertEqual(str(powerglove.get_ip_range((), 'host.stable.tld')), '192.168.135.0-192.168.135.255')
+            self.assertEqual(infer.call_count, 0)
+
+        # a more specific zone without a configured pool is still inferred
+        self.assertEqual(str(powerglove.get_ip_range((), 'host.test.tld')), '192.168.132.0-192.168.133.255')
+
+
+class PowergloveNextNameTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveNextNameTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def test_lowest_unused_number(self):
+
+        session = self.Session()
+        for name, rec_type in (('web-001.stable.tld', 'A'), ('web-002.stable.tld', 'CNAME'),
+                               ('web-004.stable.tld', 'A'), ('web-3.stable.tld', 'A'),
+                               ('web-003.stable.tld', 'TXT'), ('web-005x.stable.tld', 'A')):
+            session.add(Record(None, self.pdns.domains.stable_a.id, name, rec_type, '192.168.134.9'))
+        session.commit()
+
+        self.assertEqual(self.powerglove.get_next_name_number('web-{n:03d}.stable.tld'), 3)
+        self.assertEqual(self.powerglove.get_next_name_number('web-{n:03d}.stable.tld', start=4), 5)
+        self.assertEqual(self.powerglove.get_next_name_number('web-{n}.stable.tld'), 1)
+
+        for pattern in ('web.stable.tld', 'web-{n}-{m}.stable.tld', 'web-{}.stable.tld'):
+            with self.assertRaises(PowergloveError):
+                self.powerglove.get_next_name_number(pattern)
+
+    def test_add_next(self):
+
+        ip_range = ('192.168.134.0/24',)
+        self.assertEqual(self.powerglove.add_next_a_record('web-{n:02d}.stable.tld', ip_range),
+                         ('web-01.stable.tld', IPAddress('192.168.134.3')))
+        self.assertEqual(self.powerglove.add_next_a_record('web-{n:02d}.stable.tld', ip_range),
+                         ('web-02.stable.tld', IPAddress('192.168.134.4')))
+        self.assertRecordExists(type='PTR', name='4.134.168.192.in-addr.arpa', content='web-02.stable.tld')
+
+    def test_concurrent_callers_get_different_names(self):
+
+        results = []
+
+        def add_next():
+            powerglove = PowergloveDns(logger=self.log)
+            for _ in range(3):
+                results.append(powerglove.add_next_a_record('worker-{n}.stable.tld', ('192.168.135.0/24',)))
+
+        threads = [threading.Thread(target=add_next) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(name for name, _ in results),
+                         sorted('worker-%d.stable.tld' % number for number in range(1, 13)))
+        self.assertEqual(len(set(ip for _, ip in results)), 12)
+
+
+class PowergloveExpiryTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveExpiryTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def test_parse_duration(self):
+
+        self.assertEqual([parse_duration(duration) for duration in ('90', '30m', '4h', '2d', '1w', 45)],
+                         [90, 1800, 14400, 172800, 604800, 45])
+        for duration in ('', '4x', 'h', '-5', '1.5h'):
+            with self.assertRaises(PowergloveError):
+                parse_duration(duration)
+
+    def test_sweep(self):
+
+        self.assertFalse(self.powerglove.expiries_enabled)
+        self.assertEqual(self.powerglove.sweep(), [])
+
+        ip_range = ('192.168.134.0/24',)
+        now = int(time.time())
+        self.powerglove.add_a_record('ci1.stable.tld', ip_range, text_contents='build 1', expires='1h')
+        self.powerglove.add_a_record('ci2.stable.tld', ip_range, expires=60)
+        self.powerglove.add_a_record('ci3.stable.tld', ip_range, expires='2h')
+        self.powerglove.add_next_a_record('ci-{n}.stable.tld', ip_range, expires='1h')
+        self.powerglove.add_a_record('kept.stable.tld', ip_range)
+        self.assertTrue(self.powerglove.expiries_enabled)
+
+        self.assertEqual(self.powerglove.sweep(now + 30), [])
+
+        session = self.Session()
+        session.query(Domain).update({'notified_serial': None})
+        session.commit()
+
+        removed = self.powerglove.sweep(now + 3600 + 10, batch_size=1)
+        self.assertEqual(sorted((row.type, row.name) for row in removed),
+                         [('A', 'ci-1.stable.tld'), ('A', 'ci1.stable.tld'), ('A', 'ci2.stable.tld'),
+                          ('PTR', '3.134.168.192.in-addr.arpa'), ('PTR', '4.134.168.192.in-addr.arpa'),
+                          ('PTR', '6.134.168.192.in-addr.arpa'), ('TXT', 'ci1.stable.tld')])
+        for name in ('ci1.stable.tld', 'ci2.stable.tld', 'ci-1.stable.tld'):
+            self.assertRecordDoesNotExist(name=name)
+            self.assertRecordDoesNotExist(content=name)
+        self.assertRecordExists(type='A', name='ci3.stable.tld')
+        self.assertRecordExists(type='A', name='kept.stable.tld')
+        self.assertIsNotNone(self.getOneDomain(id=self.pdns.domains.stable_a.id).notified_serial)
+        self.assertIsNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+        self.assertEqual(session.query(RecordExpiry).count(), 1)
+
+    def test_first_expiry_within_a_transaction(self):
+
+        ip_range = ('192.168.134.0/24',)
+        # creating the expiry table mustn't wait on the transaction's own write lock
+        powerglove = PowergloveDns(logger=self.log, sqlite_settings=SqliteSettings(busy_timeout=0.1))
+        with powerglove.transaction():
+            powerglove.add_a_record('one.stable.tld', ip_range)
+            powerglove.add_a_record('two.stable.tld', ip_range, expires='1h')
+        self.assertTrue(PowergloveDns(logger=self.log).expiries_enabled)
+        self.assertEqual([row.name for row in powerglove.sweep(int(time.time()) + 7200) if row.type == 'A'],
+                         ['two.stable.tld'])
+        self.assertRecordExists(type='A', name='one.stable.tld')
+
+    def test_sweep_keeps_aliased_hosts(self):
+
+        self.powerglove.add_a_record('aliased.stable.tld', ('192.168.134.0/24',), expires=60)
+        self.powerglove.add_cname_record('alias.stable.tld', 'aliased.stable.tld')
+        self.powerglove.add_a_record('gone.stable.tld', ('192.168.134.0/24',), expires=60)
+        self.powerglove.remove_fqdn('gone.stable.tld')
+        self.powerglove.add_a_record('removed.stable.tld', ('192.168.134.0/24',), expires=60)
+        session = self.Session()
+        session.query(Record).filter_by(name='removed.stable.tld').delete()
+        session.commit()
+
+        self.assertEqual(self.powerglove.sweep(int(time.time()) + 120), [])
+        self.assertRecordExists(type='A', name='aliased.stable.tld')
+        self.assertEqual([expiry.record_id for expiry in session.query(RecordExpiry)],
+                         [self.getOneRecord(type='A', name='aliased.stable.tld').id])
+
+        self.powerglove.remove_fqdn('alias.stable.tld')
+        self.assertEqual([row.name for row in self.powerglove.sweep(int(time.time()) + 120)
+                          if row.type == 'A'], ['aliased.stable.tld'])
+
+    def test_cascading_removal_drops_the_expiries(self):
+
+        self.assertFalse(self.powerglove.ip_index_enabled)
+        self.powerglove.add_a_record('aliased.stable.tld', ('192.168.134.0/24',), expires=60)
+        self.powerglove.add_cname_record('alias.stable.tld', 'aliased.stable.tld')
+        self.powerglove.add_a_record('kept.stable.tld', ('192.168.134.0/24',), expires=60)
+        self.powerglove.remove_fqdn('aliased.stable.tld', cascade=True)
+
+        session = self.Session()
+        self.assertEqual([expiry.record_id for expiry in session.query(RecordExpiry)],
+                         [self.getOneRecord(type='A', name='kept.stable.tld').id])
+
+    def test_reused_record_ids_are_not_swept(self):
+
+        ip_range = ('192.168.134.0/24',)
+        self.powerglove.add_a_record('tmp.stable.tld', ip_range, expires=60)
+        self.powerglove.add_a_record('renamed.stable.tld', ip_range, expires=60)
+        self.powerglove.rename_fqdn('renamed.stable.tld', 'new-name.stable.tld')
+
+        # removed by another tool, and its id handed out again
+        session = self.Session()
+        record = session.query(Record).filter_by(name='tmp.stable.tld').one()
+        record_id = record.id
+        session.delete(record)
+        session.add(Record(record_id, self.pdns.domains.stable_a.id, 'permanent.stable.tld', 'A', '192.168.134.50'))
+        session.commit()
+
+        self.assertEqual([row.name for row in self.powerglove.sweep(int(time.time()) + 120) if row.type == 'A'],
+                         ['new-name.stable.tld'])
+        self.assertRecordExists(id=record_id, name='permanent.stable.tld')
+        self.assertEqual(session.query(RecordExpiry).count(), 0)
+
+    def test_expiry_from_the_command_line(self):
+
+        main(['--add', 'ci.test.tld', '192.168.132.0/24', '--expires', '4h'], logger=self.log)
+        with mock.patch('sys.stdout', StringIO.StringIO()):
+            self.assertEqual(main(['--sweep'], logger=self.log), [])
+            with mock.patch('time.time', return_value=time.time() + 4 * 3600 + 1):
+                self.assertEqual(len(main(['--sweep'], logger=self.log)), 2)
+        self.assertRecordDoesNotExist(name='ci.test.tld')
+
+
+class PowergloveIpIndexTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveIpIndexTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def test_index_is_only_used_once_built(self):
+        """
+        the side index is optional; an unmodified Power DNS database shouldn't grow a new table
+        """
+
+        self.assertFalse(self.powerglove.ip_index_enabled)
+        self.assertEqual(self.powerglove.rebuild_ip_index(), 7)
+        self.assertTrue(self.powerglove.ip_index_enabled)
+        self.assertTrue(PowergloveDns(logger=self.log).ip_index_enabled)
+
+        # the command line's result is its exit status
+        self.assertEqual(main(['--rebuild_ip_index'], logger=self.log), 0)
+
+    def test_indexed_allocation_matches_unindexed_allocation(self):
+        """
+        the database gap search should pick the same addresses as the in-python scan
+        """
+
+        unindexed = PowergloveDns(logger=self.log)
+        ip_ranges = [('192.168.133.0', '192.168.133.255'),
+                     ('192.168.133.2', '192.168.133.2'),
+                     ('192.168.132.255', '192.168.133.3'),
+                     ('192.168.133.56', '192.168.133.70'),
+                     ('10.10.111.61', '10.10.111.62')]
+        expected = [unindexed.get_available_ip_address(unindexed.get_ip_range(ip_range))
+                    for ip_range in ip_ranges if ip_range != ('192.168.133.2', '192.168.133.2')]
+
+        self.powerglove.rebuild_ip_index()
+        with self.assertRaises(PowergloveError):
+            self.powerglove.get_available_ip_address(self.powerglove.get_ip_range(ip_ranges[1]))
+        del ip_ranges[1]
+        self.assertEqual([self.powerglove.get_available_ip_address(self.powerglove.get_ip_range(ip_range))
+                          for ip_range in ip_ranges], expected)
+
+    def test_index_is_maintained_by_adds_and_removes(self):
+
+        self.powerglove.rebuild_ip_index()
+        ip_range = ('192.168.133.2', '192.168.133.4')
+
+        name, ip = self.powerglove.add_a_record('indexed.test.tld', ip_range)
+        self.assertEqual(str(ip), '192.168.133.3')
+        self.assertEqual([record.name for record in self.powerglove.get_a_records_for_ip(ip)], [name])
+        self.assertEqual(self.powerglove.get_ip_utilization(self.powerglove.get_ip_range(ip_range)), (2, 3))
+
+        self.assertEqual(str(self.powerglove.add_a_record('indexed2.test.tld', ip_range)[1]), '192.168.133.4')
+
+        self.powerglove.remove_fqdn(name)
+        self.assertEqual(self.powerglove.get_a_records_for_ip(ip), [])
+        self.assertEqual(str(self.powerglove.add_a_record('indexed3.test.tld', ip_range)[1]), '192.168.133.3')
+
+    def test_utilization_without_index(self):
+
+        ip_range = self.powerglove.get_ip_range(('192.168.133.*',))
+        self.assertEqual(self.powerglove.get_ip_utilization(ip_range), (3, 256))
+        self.assertEqual([record.name for record in self.powerglove.get_a_records_for_ip('192.168.133.57')],
+                         [self.pdns.records.record_with_cname.name])
+
+
+class PowergloveSubnetUsageTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveSubnetUsageTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def get_usage(self):
+        return dict((usage.subnet, usage.used) for usage in self.Session().query(SubnetUsage) if usage.used)
+
+    def assertUsageMatchesIndex(self):
+        indexed = collections.Counter(ip >> 8 for ip, in self.Session().query(RecordIpIndex.ip))
+        self.assertEqual(self.get_usage(), dict(indexed))
+
+    def set_usage(self, subnet, used):
+        session = self.Session()
+        session.query(SubnetUsage).filter_by(subnet=int(IPAddress(subnet)) >> 8).update({'used': used})
+        session.commit()
+
+    def test_summary_is_maintained(self):
+
+        self.assertFalse(self.powerglove.subnet_usage_enabled)
+        self.assertEqual(main(['--rebuild_subnet_usage'], logger=self.log), 0)
+        self.assertTrue(PowergloveDns(logger=self.log).ip_index_enabled)
+        self.assertEqual(self.get_usage()[int(IPAddress('192.168.133.0')) >> 8], 3)
+        self.assertUsageMatchesIndex()
+
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.powerglove.add_a_record('one.test.tld', ('192.168.132.0/24',))
+        self.powerglove.add_a_record('two.test.tld', ('192.168.133.0/24',))
+        self.powerglove.add_cname_record('alias.test.tld', 'two.test.tld')
+        self.assertUsageMatchesIndex()
+
+        self.powerglove.move_a_record('one.test.tld', ('192.168.134.0/24',))
+        self.assertUsageMatchesIndex()
+
+        self.powerglove.remove_fqdn('one.test.tld')
+        self.powerglove.remove_fqdn('two.test.tld', cascade=True)
+        self.assertUsageMatchesIndex()
+
+        with self.powerglove.transaction():
+            self.powerglove.add_a_record('three.test.tld', ('192.168.132.0/24',), expires=1)
+            self.assertEqual(self.powerglove.get_ip_utilization(self.powerglove.get_ip_range(('192.168.132.*',))),
+                             (2, 256))
+        self.assertEqual(len(self.powerglove.sweep(now=time.time() + 10)), 2)
+        self.assertUsageMatchesIndex()
+
+        # rebuilding the index also rebuilds the summary
+        self.set_usage('192.168.132.0', 100)
+        self.powerglove.rebuild_ip_index()
+        self.assertUsageMatchesIndex()
+
+    def test_unindexed_records_are_not_counted(self):
+
+        self.powerglove.rebuild_subnet_usage()
+        # added by another tool since, so neither indexed nor counted
+        session = self.Session()
+        for name, ip in (('foreign.test.tld', '192.168.133.80'), ('foreign2.test.tld', '192.168.133.81')):
+            session.add(Record(None, self.pdns.domains.testing_a.id, name, 'A', ip))
+        session.commit()
+
+        self.powerglove.remove_fqdn('foreign.test.tld', cascade=True)
+        self.powerglove.remove_fqdn('foreign2.test.tld')
+        self.assertUsageMatchesIndex()
+        self.assertEqual(self.get_usage()[int(IPAddress('192.168.133.0')) >> 8], 3)
+
+    def test_full_subnets_are_skipped(self):
+
+        self.powerglove.rebuild_subnet_usage()
+        ip_range = self.powerglove.get_ip_range(('192.168.132.0/23',))
+
+        # addresses that are excluded but in use count towards a subnet being full
+        self.set_usage('192.168.132.0', 253)
+        with mock.patch.object(self.powerglove, '_get_free_ip_gaps', wraps=self.powerglove._get_free_ip_gaps) as gaps:
+            self.assertEqual(str(self.powerglove.get_available_ip_address(ip_range)), '192.168.133.3')
+        self.assertEqual(gaps.call_args_list, [mock.call(int(IPAddress('192.168.133.0')), ip_range.last)])
+
+        # so subnets that look full are still tried, last
+        self.set_usage('192.168.133.0', 253)
+        self.assertEqual(str(self.powerglove.get_available_ip_address(ip_range)), '192.168.132.3')
+
+    def test_utilization(self):
+
+        # an address held by two A records is used once
+        session = self.Session()
+        session.add(Record(100, self.pdns.domains.testing_a.id, 'shared.test.tld', 'A', '192.168.133.57'))
+        session.commit()
+
+        self.powerglove.rebuild_subnet_usage()
+        self.assertEqual(self.get_usage()[int(IPAddress('192.168.133.0')) >> 8], 4)
+        for ip_range, used in ((('192.168.133.*',), 3),
+                               (('192.168.132.255', '192.168.133.3'), 1),
+                               (('192.168.133.2', '192.168.133.60'), 2),
+                               (('192.168.132.0', '192.168.135.0'), 5)):
+            ip_range = self.powerglove.get_ip_range(ip_range)
+            self.assertEqual(self.powerglove.get_ip_utilization(ip_range), (used, ip_range.size))
+
+
+class PowergloveSerialSchedulingTestCase(PowergloveTestCase):
+
+    def get_serial(self, domain):
+        return self.getOneDomain(id=domain.id).notified_serial
+
+    def test_each_change_bumps_each_zone_once(self):
+
+        powerglove = PowergloveDns(logger=self.log)
+        powerglove.add_a_record('serial.test.tld', ('192.168.132.10',), text_contents='text')
+
+        a_serial = self.get_serial(self.pdns.domains.testing_a)
+        self.assertEqual(a_serial % 100, 1)
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_ptr_132) % 100, 1)
+        self.assertIsNone(self.get_serial(self.pdns.domains.stable_a))
+
+    def test_batched_serial_updates(self):
+
+        powerglove = PowergloveDns(logger=self.log, serial_batch=3)
+        powerglove.add_a_record('batched1.test.tld', ('192.168.132.10',))
+        powerglove.add_a_record('batched2.test.tld', ('192.168.132.11',))
+        self.assertIsNone(self.get_serial(self.pdns.domains.testing_a))
+        self.assertRecordExists(type='A', name='batched2.test.tld')
+
+        powerglove.add_cname_record('batched3.test.tld', 'batched1.test.tld')
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 1)
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_ptr_132) % 100, 1)
+
+        powerglove.remove_fqdn('batched3.test.tld')
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 1)
+        powerglove.flush_serials()
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 2)
+
+    def test_windowed_serial_updates(self):
+
+        powerglove = PowergloveDns(logger=self.log, serial_window=60)
+        clock = powerglove.serial_scheduler.clock = mock.Mock(return_value=1000.0)
+        powerglove.serial_scheduler.last_flush = 1000.0
+
+        powerglove.add_a_record('windowed1.test.tld', ('192.168.132.10',))
+        clock.return_value = 1059.0
+        powerglove.add_a_record('windowed2.test.tld', ('192.168.132.11',))
+        self.assertIsNone(self.get_serial(self.pdns.domains.testing_a))
+
+        clock.return_value = 1060.0
+        powerglove.add_a_record('windowed3.test.tld', ('192.168.132.12',))
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 1)
+
+    def test_pending_serial_updates_are_flushed_on_close(self):
+
+        powerglove = PowergloveDns(logger=self.log, serial_window=3600)
+        powerglove.add_a_record('closing.test.tld', ('192.168.132.10',))
+        self.assertIsNone(self.get_serial(self.pdns.domains.testing_a))
+
+        powerglove.close()
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 1)
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_ptr_132) % 100, 1)
+        # closing again has nothing left to flush
+        powerglove.close()
+        self.assertEqual(self.get_serial(self.pdns.domains.testing_a) % 100, 1)
+
+
+class PowergloveTransactionTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveTransactionTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+
+    def test_changes_are_committed_together(self):
+
+        with self.powerglove.transaction():
+            _, first_ip = self.powerglove.add_a_record('unit1.test.tld', ('192.168.132.10', '192.168.132.20'))
+            _, second_ip = self.powerglove.add_a_record('unit2.test.tld', ('192.168.132.10', '192.168.132.20'))
+            self.powerglove.add_cname_record('unit3.test.tld', 'unit1.test.tld')
+            self.assertTrue(self.powerglove.fqdn_is_present('unit3.test.tld'))
+            # nothing is visible outside of the unit of work yet
+            self.assertRecordDoesNotExist(type='A', name='unit1.test.tld')
+
+        self.assertEqual((str(first_ip), str(second_ip)), ('192.168.132.10', '192.168.132.11'))
+        self.assertRecordExists(type='A', name='unit2.test.tld')
+        self.assertRecordExists(type='CNAME', name='unit3.test.tld')
+        self.assertEqual(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial % 100, 1)
+
+    def test_changes_are_rolled_back_together(self):
+
+        with self.assertRaises(PowergloveError):
+            with self.powerglove.transaction():
+                self.powerglove.add_a_record('unit1.test.tld', ('192.168.132.10',))
+                self.powerglove.remove_fqdn(self.pdns.records.stable_a_134.name)
+                with self.powerglove.transaction():
+                    self.powerglove.add_cname_record('unit2.test.tld', 'not-there.test.tld')
+
+        self.assertRecordDoesNotExist(type='A', name='unit1.test.tld')
+        self.assertRecordExists(type='A', name=self.pdns.records.stable_a_134.name)
+        self.assertIsNone(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial)
+
+        # the instance is still usable afterwards
+        self.powerglove.add_a_record('unit1.test.tld', ('192.168.132.10',))
+        self.assertRecordExists(type='A', name='unit1.test.tld')
+        self.assertIsNone(self.getOneDomain(id=self.pdns.domains.stable_a.id).notified_serial)
+
+    def test_bulk_load_commits_in_batches(self):
+
+        with self.assertRaises(PowergloveError):
+            with self.powerglove.bulk_load(commit_every=2):
+                self.powerglove.add_a_record('bulk1.test.tld', ('192.168.132.10', '192.168.132.20'))
+                self.assertRecordDoesNotExist(type='A', name='bulk1.test.tld')
+                self.powerglove.add_cname_records([('bulk2.test.tld', 'bulk1.test.tld')])
+                # the first two operations have been committed, along with their serials
+                self.assertRecordExists(type='CNAME', name='bulk2.test.tld')
+                self.assertEqual(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial % 100, 1)
+                self.powerglove.add_a_record('bulk3.test.tld', ('192.168.132.10', '192.168.132.20'))
+                self.powerglove.add_a_record('bulk3.test.tld', ('192.168.132.10', '192.168.132.20'))
+
+        # only the operations since the last commit were rolled back
+        self.assertRecordExists(type='PTR', content='bulk1.test.tld')
+        self.assertRecordDoesNotExist(name='bulk3.test.tld')
+        self.assertEqual(self.getOneDomain(id=self.pdns.domains.testing_a.id).notified_serial % 100, 1)
+
+        with self.powerglove.bulk_load(commit_every=2):
+            self.powerglove.add_a_record('bulk3.test.tld', ('192.168.132.10', '192.168.132.20'))
+        self.assertRecordExists(type='A', name='bulk3.test.tld', content='192.168.132.11')
+
+        with self.assertRaises(PowergloveError):
+            with self.powerglove.transaction():
+                with self.powerglove.bulk_load():
+                    pass
+
+
+class PowergloveSqliteSettingsTestCase(PowergloveTestCase):
+
+    def get_pragmas(self, powerglove):
+        session = powerglove.session
+        return [session.execute('PRAGMA %s' % pragma).scalar()
+                for pragma in ('journal_mode', 'synchronous', 'cache_size', 'busy_timeout')]
+
+    def test_default_settings(self):
+
+        self.assertEqual(self.get_pragmas(PowergloveDns(logger=self.log)), ['wal', 1, -16000, 5000])
+        replica = PowergloveDns(logger=self.log, pdns_read_sqla_url=self.original_sqla_connect_string)
+        self.assertEqual(replica.read_session.execute('PRAGMA synchronous').scalar(), 1)
+
+    def test_configured_settings(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[sqlite]\njournal_mode = delete\nsynchronous = full\n'
+                              'cache_size = default\nbusy_timeout = 0.5\n')
+        settings = SqliteSettings.from_config(PowergloveDns.def_config_file)
+        self.assertEqual(settings.pragmas(), ['PRAGMA busy_timeout = 500', 'PRAGMA journal_mode = DELETE',
+                                              'PRAGMA synchronous = FULL'])
+        self.assertEqual(self.get_pragmas(PowergloveDns(logger=self.log)), ['delete', 2, -2000, 500])
+
+        with self.assertRaises(PowergloveError):
+            SqliteSettings(journal_mode='sideways')
+
+
+class PowergloveReadReplicaTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveReadReplicaTestCase, self).setUp()
+        # the replica starts as a copy of the primary, but doesn't see anything done afterwards
+        self.replica_connect_string = 'sqlite:///%s' % self.get_temporary_file().name
+        setup_mock_pdns(self.get_session_from_connect_string(self.replica_connect_string)())
+        self.powerglove = PowergloveDns(logger=self.log, pdns_read_sqla_url=self.replica_connect_string)
+
+        PowergloveDns(logger=self.log).add_a_record('primary-only.test.tld', ('192.168.132.10',))
+
+    def test_lookups_use_the_replica(self):
+
+        self.assertFalse(self.powerglove.fqdn_is_present('primary-only.test.tld'))
+        self.assertTrue(self.powerglove.fqdn_is_present('primary-only.test.tld', self.powerglove.session))
+        self.assertEqual(self.powerglove.get_a_records_for_ip('192.168.132.10'), [])
+
+    def test_lookups_see_the_replica_change(self):
+
+        record, = self.powerglove.get_a_records_for_ip('192.168.132.2')
+        self.assertEqual(record.ttl, 3600)
+        # the lookup's transaction is over, and the record it found stays usable
+        self.assertEqual(len(self.powerglove.read_session.identity_map), 0)
+        self.assertEqual(record.name, 'test_existing.test.tld')
+
+        replica = self.get_session_from_connect_string(self.replica_connect_string)()
+        replica.query(Record).filter_by(name='test_existing.test.tld', type='A').update({'ttl': 60})
+        replica.commit()
+        record, = self.powerglove.get_a_records_for_ip('192.168.132.2')
+        self.assertEqual(record.ttl, 60)
+
+        # as do those of searches and retried operations
+        self.assertEqual(len(list(self.powerglove.search('test_existing*'))), 4)
+        self.assertEqual(len(self.powerglove.read_session.identity_map), 0)
+        self.powerglove.add_a_record('next.test.tld', ('192.168.132.10', '192.168.132.20'))
+        self.assertEqual(len(self.powerglove.read_session.identity_map), 0)
+
+    def test_changes_are_checked_against_the_primary(self):
+
+        with self.assertRaises(PowergloveError):
+            self.powerglove.add_a_record('primary-only.test.tld', ('192.168.132.0/24',))
+
+        # the replica offers 192.168.132.10 first, but the primary has already reserved it
+        _, ip = self.powerglove.add_a_record('next.test.tld', ('192.168.132.10', '192.168.132.20'))
+        self.assertEqual(str(ip), '192.168.132.11')
+        self.assertRecordExists(type='PTR', content='next.test.tld')
+
+    def test_replica_from_config_file(self):
+
+        PowergloveDns.set_config('pdns_read_connect_string', self.replica_connect_string)
+        self.assertFalse(PowergloveDns(logger=self.log).fqdn_is_present('primary-only.test.tld'))
+        # a replica from the config file doesn't apply to a different main connection
+        self.assertIsNone(PowergloveDns(self.original_sqla_connect_string, logger=self.log).sqla_read_session_obj)
+
+
+class PowergloveLookupTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveLookupTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.ips = ['192.168.134.2', '192.168.133.57', '10.10.111.61', '192.168.134.2', '192.168.134.3']
+        self.expected = [(self.pdns.records.stable_a_134.name,), (self.pdns.records.record_with_cname.name,),
+                         (self.pdns.records.tld_a.name,), (self.pdns.records.stable_a_134.name,), ()]
+
+    def assertLookups(self, lookups):
+
+        self.assertEqual([lookup.ip for lookup in lookups], self.ips)
+        self.assertEqual([tuple(lookup.a_names) for lookup in lookups], self.expected)
+        # the mock CNAME'd record doesn't have a PTR record
+        self.assertEqual([lookup.mismatched for lookup in lookups], [False, True, False, False, False])
+
+    def test_lookup(self):
+
+        self.assertLookups(self.powerglove.lookup_ips(self.ips))
+        self.assertLookups(self.powerglove.lookup_ips(self.ips, chunk_size=2))
+        self.powerglove.rebuild_ip_index()
+        self.assertLookups(self.powerglove.lookup_ips(self.ips, chunk_size=2))
+
+        with self.assertRaises(PowergloveError):
+            self.powerglove.lookup_ips(['not-an-ip'])
+
+    def test_ptr_disagreeing_with_a_record(self):
+
+        session = self.Session()
+        session.query(Record).filter_by(name=self.pdns.records.stable_ptr_134.name).update(
+            {'content': 'someone-else.stable.tld'})
+        session.commit()
+        lookup, = self.powerglove.lookup_ips(['192.168.134.2'])
+        self.assertEqual(lookup.ptr_names, ['someone-else.stable.tld'])
+        self.assertTrue(lookup.mismatched)
+
+    def test_lookup_from_the_command_line(self):
+
+        with mock.patch('sys.stdin', StringIO.StringIO('\n'.join(self.ips) + '\n')):
+            with mock.patch('sys.stdout', StringIO.StringIO()) as stdout:
+                self.assertLookups(main(['--lookup', '-'], logger=self.log))
+
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([result['ip'] for result in results], self.ips)
+        self.assertTrue(results[1]['mismatched'])
+
+
+class PowergloveSearchTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveSearchTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        with self.powerglove.transaction():
+            for number in range(12):
+                self.powerglove.add_a_record('web-%03d.stable.tld' % number, ('192.168.134.0/24',))
+            self.powerglove.add_a_record('web_x.stable.tld', ('192.168.134.0/24',))
+            self.powerglove.add_a_record('web-001.test.tld', ('192.168.132.0/24',))
+
+    def names(self, pattern, **kwargs):
+        return [row.name for row in self.powerglove.search(pattern, **kwargs)]
+
+    def test_patterns(self):
+
+        web_hosts = ['web-%03d.stable.tld' % number for number in range(12)]
+        self.assertEqual(self.names('web-*.stable.tld'), web_hosts)
+        self.assertEqual(self.names('web-00?.stable.tld'), web_hosts[:10])
+        self.assertEqual(self.names('*-001.*'), ['web-001.stable.tld', 'web-001.test.tld'])
+        # _ is a literal underscore, not a LIKE wildcard
+        self.assertEqual(self.names('web_*'), ['web_x.stable.tld'])
+        self.assertEqual(self.names('nothing*'), [])
+        self.assertEqual(self.names('test_existing.stable.tld'), ['test_existing.stable.tld'])
+
+    def test_filters(self):
+
+        self.assertEqual(self.names('*.test.tld', types=('CNAME',)), [self.pdns.records.cname_record.name])
+        self.assertEqual(self.names('web-001*', zone='test.tld'), ['web-001.test.tld'])
+        self.assertEqual(self.names('*', zone='134.168.192.in-addr.arpa', types=('PTR',))[:2],
+                         ['10.134.168.192.in-addr.arpa', '11.134.168.192.in-addr.arpa'])
+        with self.assertRaises(PowergloveError):
+            self.names('*', zone='unknown.tld')
+
+    def test_pages_continue_from_the_last_record(self):
+
+        # the A and TXT records share names, so pages have to continue by id too
+        self.assertEqual([(row.name, row.type) for row in self.powerglove.search('text.*', page_size=1)],
+                         [('text.test.tld', 'TXT'), ('text.test.tld', 'A')])
+        self.assertEqual(self.names('web-*', page_size=5), self.names('web-*'))
+
+    def test_search_from_the_command_line(self):
+
+        with mock.patch('sys.stdout', StringIO.StringIO()) as stdout:
+            self.assertEqual(main(['--search', 'web-0??.*', '--type', 'A', '--zone', 'stable.tld'],
+                                  logger=self.log), 0)
+
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(len(results), 12)
+        self.assertEqual(results[0]['name'], 'web-000.stable.tld')
+        self.assertEqual(results[0]['content'], '192.168.134.3')
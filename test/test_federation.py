@@ -0,0 +1,165 @@
+import StringIO
+import threading
+
+import mock
+
+from powerglove_dns import main
+from powerglove_dns.federation import FederatedPowergloveDns
+from powerglove_dns.model import Base, Domain
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+
+from test import PowergloveTestCase
+
+
+class PowergloveFederationTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveFederationTestCase, self).setUp()
+
+        # the "east" backend is the usual mock install, "west" only has its own zones
+        self.west_connect_string = 'sqlite:///%s' % self.get_temporary_file().name
+        self.WestSession = self.get_session_from_connect_string(self.west_connect_string)
+        west_session = self.WestSession()
+        Base.metadata.create_all(west_session.bind)
+        west_session.add_all([Domain(1, 'west.tld'), Domain(2, '50.10.in-addr.arpa')])
+        west_session.commit()
+
+        self.federation = FederatedPowergloveDns({'east': self.original_sqla_connect_string,
+                                                  'west': self.west_connect_string},
+                                                 logger=self.log)
+        self.addCleanup(self.federation.close)
+
+    def write_backends_config(self):
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[backends]\neast = %r\nwest = %r\n' % (self.original_sqla_connect_string,
+                                                                      self.west_connect_string))
+
+    def test_changes_are_routed_by_zone_ownership(self):
+
+        self.assertEqual(self.federation.get_backend_for_fqdn('host.west.tld')[0], 'west')
+        self.assertEqual(self.federation.get_backend_for_fqdn('host.stable.tld')[0], 'east')
+        self.assertEqual(self.federation.get_backend_for_fqdn('host.tld')[0], 'east')
+
+        self.federation.add_a_record('host.west.tld', ('10.50.0.*',))
+        self.assertRecordExists(session=self.WestSession(), type='A', name='host.west.tld')
+        self.assertRecordExists(session=self.WestSession(), type='PTR', content='host.west.tld')
+        self.assertRecordDoesNotExist(type='A', name='host.west.tld')
+
+        self.federation.add_cname_record('alias.west.tld', 'host.west.tld')
+        self.assertRecordExists(session=self.WestSession(), type='CNAME', name='alias.west.tld')
+
+        with self.assertRaises(PowergloveError):
+            self.federation.add_a_record('host.west.tld', ('10.50.0.*',))
+
+    def test_lookups_are_merged_across_backends(self):
+
+        self.federation.add_a_record('host.west.tld', ('10.50.0.*',))
+
+        self.assertTrue(self.federation.fqdn_is_present('host.west.tld'))
+        self.assertTrue(self.federation.fqdn_is_present(self.pdns.records.testing_a_132.name))
+        self.assertFalse(self.federation.fqdn_is_present('nowhere.west.tld'))
+        self.assertEqual([(name, record.name) for name, record in
+                          self.federation.get_a_records_for_ip('10.50.0.2')], [('west', 'host.west.tld')])
+        self.assertEqual(self.federation.get_ip_utilization(
+            self.federation.get_ip_range(('10.0.0.0/8',))), (2, 2 ** 24))
+
+        self.assertEqual([(lookup.a_names, lookup.ptr_names) for lookup in
+                          self.federation.lookup_ips(['10.50.0.2', '10.10.111.61'])],
+                         [(['host.west.tld'], ['host.west.tld']), (['big.domain.tld'], ['big.domain.tld'])])
+
+        self.federation.remove_fqdn('host.west.tld')
+        self.assertFalse(self.federation.fqdn_is_present('host.west.tld'))
+
+    def test_lookups_run_in_parallel(self):
+        """
+        every backend's lookup has to be running at the same time for any of them to finish
+        """
+
+        started = []
+        all_started = threading.Event()
+
+        def fqdn_is_present(powerglove, fqdn, session=None):
+            started.append(powerglove)
+            if len(started) == 2:
+                all_started.set()
+            return all_started.wait(5)
+
+        original = PowergloveDns.fqdn_is_present
+        PowergloveDns.fqdn_is_present = fqdn_is_present
+        self.addCleanup(setattr, PowergloveDns, 'fqdn_is_present', original)
+
+        self.assertTrue(self.federation.fqdn_is_present('anything.tld'))
+
+    def test_backends_from_config_file(self):
+
+        self.assertIsNone(FederatedPowergloveDns.from_config())
+
+        self.write_backends_config()
+        federation = FederatedPowergloveDns.from_config(logger=self.log)
+        self.addCleanup(federation.close)
+        self.assertEqual(list(federation.backends), ['east', 'west'])
+
+        # the command line uses the configured backends unless given a connection string
+        main(['--add', 'cli.west.tld', '10.50.0.*'], logger=self.log)
+        self.assertRecordExists(session=self.WestSession(), type='A', name='cli.west.tld')
+        self.assertFalse(main(['--pdns_connect_string', self.original_sqla_connect_string,
+                               '--is_present', 'cli.west.tld'], logger=self.log))
+
+    def test_indexes_are_created_on_every_backend(self):
+
+        west_session = self.WestSession()
+        west_session.execute('DROP INDEX powerglove_records_change_date')
+        west_session.close()
+        self.assertEqual(self.federation.create_indexes(), ['powerglove_records_change_date'])
+        self.assertEqual(self.federation.create_indexes(), [])
+
+    def test_single_connection_actions_are_rejected(self):
+
+        self.write_backends_config()
+        path = self.get_temporary_file().name
+        for args in (['--export_snapshot', path], ['--export_columns', path]):
+            with self.assertRaises(PowergloveError):
+                main(args, logger=self.log)
+
+    def test_searches_are_merged_across_backends(self):
+
+        self.federation.add_a_record('test.west.tld', ('10.50.0.*',))
+        self.federation.add_a_record('test_late.stable.tld', ('192.168.134.0/24',))
+
+        self.assertEqual([row.name for row in self.federation.search('test*', types=('A',), page_size=1)],
+                         ['test.west.tld', 'test_existing.stable.tld', 'test_existing.test.tld',
+                          'test_existing2.stable.tld', 'test_existing2.test.tld', 'test_late.stable.tld'])
+        self.assertEqual([row.name for row in self.federation.search('*', zone='west.tld')], ['test.west.tld'])
+        with self.assertRaises(PowergloveError):
+            list(self.federation.search('*', zone='nowhere.tld'))
+
+    def test_cname_batches_are_routed_by_target(self):
+
+        self.federation.add_a_record('host.west.tld', ('10.50.0.*',))
+        target = self.pdns.records.testing_a_132.name
+        self.assertEqual(self.federation.add_cname_records([('alias.west.tld', 'host.west.tld'),
+                                                            ('alias.test.tld', target)]),
+                         [('alias.west.tld', 'host.west.tld'), ('alias.test.tld', target)])
+        self.assertRecordExists(session=self.WestSession(), type='CNAME', name='alias.west.tld')
+        self.assertRecordExists(type='CNAME', name='alias.test.tld', content=target)
+
+        # an alias existing on another backend, or a missing target, stops the whole batch
+        for pairs in ([('new.test.tld', target), ('alias.west.tld', target)],
+                      [('new.test.tld', target), ('other.west.tld', 'nowhere.west.tld')]):
+            with self.assertRaises(PowergloveError):
+                self.federation.add_cname_records(pairs)
+        self.assertRecordDoesNotExist(name='new.test.tld')
+
+    def test_cascading_removal(self):
+
+        self.federation.add_a_record('host.west.tld', ('10.50.0.*',))
+        self.federation.add_cname_record('alias.west.tld', 'host.west.tld')
+        self.write_backends_config()
+
+        with mock.patch('sys.stdout', StringIO.StringIO()) as stdout:
+            removed = main(['--remove', 'host.west.tld', '--cascade'], logger=self.log)
+        self.assertEqual(sorted((row.type, row.name) for row in removed),
+                         [('A', 'host.west.tld'), ('CNAME', 'alias.west.tld'), ('PTR', '2.0.50.10.in-addr.arpa')])
+        self.assertEqual(len(stdout.getvalue().splitlines()), 3)
+        self.assertRecordDoesNotExist(session=self.WestSession(), name='alias.west.tld')
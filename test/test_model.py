@@ -36,4 +36,21 @@ class PowergloveModelTestCase(BasePowergloveTestCase):
         test.touch_serial()
         self.assertEqual(test.notified_serial, 2013121101)
         test.touch_serial()
-        self.assertEqual(test.notified_serial, 2013121102)
\ No newline at end of file
+        self.assertEqual(test.notified_serial, 2013121102)
+
+    def test_domain_incrementing_notified_serial_past_a_days_worth_of_changes(self):
+
+        test = Domain(0, 'domain.name', notified_serial=2013121198)
+        test.touch_serial()
+        self.assertEqual(test.notified_serial, 2013121199)
+        test.touch_serial()
+        self.assertEqual(test.notified_serial, 2013121200)
+        for _ in range(150):
+            test.touch_serial()
+        self.assertEqual(test.notified_serial, 2013121350)
+
+    def test_domain_incrementing_notified_serial_never_goes_backwards(self):
+
+        test = Domain(0, 'domain.name', notified_serial=2013121305)
+        test.touch_serial()
+        self.assertEqual(test.notified_serial, 2013121306)
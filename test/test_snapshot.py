@@ -0,0 +1,89 @@
+import time
+
+from netaddr import IPAddress
+
+from powerglove_dns import main
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+from powerglove_dns.snapshot import OccupancySnapshot, PlanningPowergloveDns
+
+from test import PowergloveTestCase
+
+
+class PowergloveSnapshotTestCase(PowergloveTestCase):
+
+    def setUp(self):
+
+        super(PowergloveSnapshotTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.snapshot_path = self.get_temporary_file().name
+        self.snapshot = OccupancySnapshot.export(self.powerglove, self.snapshot_path)
+        self.addCleanup(self.snapshot.close)
+
+    def test_lookups(self):
+
+        self.assertEqual(self.snapshot.address_count, 7)
+        self.assertEqual(self.snapshot.name_count, 8)
+
+        self.assertTrue(self.snapshot.fqdn_is_present(self.pdns.records.testing_a_132.name))
+        self.assertTrue(self.snapshot.fqdn_is_present(self.pdns.records.cname_record.name))
+        self.assertFalse(self.snapshot.fqdn_is_present(self.pdns.records.testing_ptr_132.name))
+        self.assertFalse(self.snapshot.fqdn_is_present('missing.test.tld'))
+
+        self.assertTrue(self.snapshot.ip_is_reserved('192.168.133.57'))
+        self.assertFalse(self.snapshot.ip_is_reserved('192.168.133.58'))
+        self.assertEqual(self.snapshot.get_owners('192.168.133.57'), [self.pdns.records.record_with_cname.name])
+        self.assertEqual(self.snapshot.get_owners('192.168.133.58'), [])
+        self.assertEqual(list(self.snapshot.iter_reserved(int(IPAddress('192.168.133.0')),
+                                                          int(IPAddress('192.168.133.255')))),
+                         [int(IPAddress(ip)) for ip in ('192.168.133.2', '192.168.133.57', '192.168.133.61')])
+
+    def test_planning_matches_the_database_and_changes_nothing(self):
+
+        planner = PlanningPowergloveDns(self.snapshot_path, logger=self.log)
+        ip_range = ('192.168.133.0', '192.168.133.255')
+
+        self.assertEqual(planner.plan_a_record('planned.test.tld', ip_range)[1],
+                         self.powerglove.get_available_ip_address(self.powerglove.get_ip_range(ip_range)))
+        self.assertEqual(str(planner.plan_a_record('planned2.test.tld', ip_range)[1]), '192.168.133.4')
+        with self.assertRaises(PowergloveError):
+            planner.plan_a_record('planned.test.tld', ip_range)
+        with self.assertRaises(PowergloveError):
+            planner.add_a_record('added.test.tld', ip_range)
+        self.assertRecordDoesNotExist(type='A', name='planned.test.tld')
+
+    def test_snapshot_from_the_command_line(self):
+
+        snapshot_path = self.get_temporary_file().name
+        self.assertEqual(main(['--export_snapshot', snapshot_path], logger=self.log), 0)
+        self.assertTrue(main(['--snapshot', snapshot_path, '--is_present',
+                              self.pdns.records.testing_a_132.name], logger=self.log))
+        self.assertEqual(main(['--snapshot', snapshot_path, '--add', 'planned.test.tld', '192.168.132.2',
+                               '192.168.132.5'], logger=self.log)[1], IPAddress('192.168.132.3'))
+        self.assertRecordDoesNotExist(type='A', name='planned.test.tld')
+        with self.assertRaises(PowergloveError):
+            main(['--snapshot', snapshot_path, '--remove', self.pdns.records.testing_a_132.name], logger=self.log)
+
+    def test_planning_in_configured_pools(self):
+
+        with open(PowergloveDns.def_config_file, 'a') as config_file:
+            config_file.write('\n[pools]\nstable.tld = 192.168.134.0/24\n')
+
+        self.assertEqual(main(['--snapshot', self.snapshot_path, '--add', 'new.stable.tld'], logger=self.log),
+                         ('new.stable.tld', IPAddress('192.168.134.3')))
+        planner = PlanningPowergloveDns(self.snapshot_path, logger=self.log)
+        self.assertEqual(str(planner.plan_a_record('new.super.stable.tld')[1]), '192.168.134.3')
+        # without a configured pool there's no inferring one from the snapshot
+        with self.assertRaises(PowergloveError):
+            planner.plan_a_record('new.test.tld')
+
+    def test_loading_is_cheap(self):
+
+        start = time.time()
+        for _ in range(100):
+            OccupancySnapshot(self.snapshot_path).close()
+        self.assertLess(time.time() - start, 1)
+
+    def test_not_a_snapshot(self):
+
+        with self.assertRaises(PowergloveError):
+            OccupancySnapshot(self.get_temporary_file().name)
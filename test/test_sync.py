@@ -0,0 +1,172 @@
+import collections
+import json
+import StringIO
+
+import mock
+
+from netaddr import IPAddress
+
+from powerglove_dns import main
+from powerglove_dns.model import Record, RecordExpiry, RecordIpIndex, SubnetUsage
+from powerglove_dns.powerglove import PowergloveDns, PowergloveError
+from powerglove_dns.sync import DesiredRecord, InventorySync, load_inventory
+
+from test import PowergloveTestCase
+
+
+class PowergloveSyncTestCase(PowergloveTestCase):
+
+    inventory = ('type,name,content,ttl\n'
+                 'A,test_existing.test.tld,192.168.132.2,\n'
+                 'A,test_existing2.test.tld,192.168.133.20,\n'
+                 'A,cnamee.test.tld,192.168.133.57,60\n'
+                 '# aliases\n'
+                 'CNAME,cnamer.test.tld,test_existing.test.tld\n'
+                 '\n'
+                 'A,new.test.tld,192.168.132.30\n')
+
+    expected_plan = [('update', 'A', 'cnamee.test.tld', '192.168.133.57'),
+                     ('update', 'CNAME', 'cnamer.test.tld', 'test_existing.test.tld'),
+                     ('add', 'A', 'new.test.tld', '192.168.132.30'),
+                     ('update', 'A', 'test_existing2.test.tld', '192.168.133.20'),
+                     ('remove', 'A', 'text.test.tld', '192.168.133.61'),
+                     ('remove', 'TXT', 'text.test.tld', 'this is a text record')]
+
+    def setUp(self):
+
+        super(PowergloveSyncTestCase, self).setUp()
+        self.powerglove = PowergloveDns(logger=self.log)
+        self.inventory_file = self.get_temporary_file()
+        with self.inventory_file:
+            self.inventory_file.write(self.inventory)
+
+    def run_with_args(self, args):
+        output = StringIO.StringIO()
+        with mock.patch('sys.stdout', output):
+            result = main(args, logger=self.log)
+        return result, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_load_inventory(self):
+
+        desired = load_inventory(self.inventory_file.name)
+        self.assertEqual(len(desired), 5)
+        self.assertEqual(desired[2], DesiredRecord('A', 'cnamee.test.tld', '192.168.133.57', 60))
+        self.assertEqual(desired[4], DesiredRecord('A', 'new.test.tld', '192.168.132.30', None))
+
+    def test_plan_only_lists_the_changes(self):
+
+        changes, output = self.run_with_args(['--sync', self.inventory_file.name, '--plan'])
+        self.assertEqual([(change.action, change.type, change.name, change.content) for change in changes],
+                         self.expected_plan)
+        self.assertEqual([(line['action'], line['type'], line['name'], line['content']) for line in output],
+                         self.expected_plan)
+        self.assertEqual(output[0]['ttl'], 60)
+        self.assertEqual(output[3]['old']['content'], self.pdns.records.testing_a_133.content)
+
+        self.assertRecordExists(type='TXT', name='text.test.tld')
+        self.assertRecordDoesNotExist(name='new.test.tld')
+
+    def test_sync(self):
+
+        # builds the IP index too
+        self.powerglove.rebuild_subnet_usage()
+        self.run_with_args(['--sync', self.inventory_file.name])
+
+        self.assertEqual(self.getOneRecord(type='A', name='cnamee.test.tld').ttl, 60)
+        self.assertRecordExists(type='CNAME', name='cnamer.test.tld', content='test_existing.test.tld')
+        self.assertRecordExists(type='A', name='new.test.tld', content='192.168.132.30', ttl=300)
+        self.assertRecordExists(type='PTR', name='30.132.168.192.in-addr.arpa', content='new.test.tld',
+                                domain_id=self.pdns.domains.testing_ptr_132.id)
+        self.assertRecordExists(type='A', id=self.pdns.records.testing_a_133.id, content='192.168.133.20')
+        self.assertRecordExists(type='PTR', id=self.pdns.records.testing_ptr_133.id,
+                                name='20.133.168.192.in-addr.arpa')
+        self.assertRecordDoesNotExist(name='text.test.tld')
+        self.assertRecordExists(name=self.pdns.records.stable_a_134.name)
+
+        for domain in (self.pdns.domains.testing_a, self.pdns.domains.testing_ptr_132,
+                       self.pdns.domains.testing_ptr_133):
+            self.assertIsNotNone(self.getOneDomain(id=domain.id).notified_serial)
+        self.assertIsNone(self.getOneDomain(id=self.pdns.domains.stable_a.id).notified_serial)
+
+        session = self.Session()
+        self.assertEqual(dict(session.query(RecordIpIndex.record_id, RecordIpIndex.ip)),
+                         dict((record.id, int(IPAddress(record.content)))
+                              for record in session.query(Record).filter_by(type='A')))
+        self.assertEqual(len(self.powerglove.get_a_records_for_ip('192.168.133.20')), 1)
+        self.assertEqual(len(self.powerglove.get_a_records_for_ip('192.168.132.30')), 1)
+        self.assertEqual(self.powerglove.get_a_records_for_ip('192.168.133.61'), [])
+        self.assertEqual(dict((usage.subnet, usage.used) for usage in session.query(SubnetUsage) if usage.used),
+                         collections.Counter(ip >> 8 for ip, in session.query(RecordIpIndex.ip)))
+
+        # once in sync, there's nothing left to do
+        self.assertEqual(InventorySync(self.powerglove, load_inventory(self.inventory_file.name)).plan(), [])
+
+    def test_unindexed_removals_are_not_counted(self):
+
+        self.powerglove.rebuild_subnet_usage()
+        # added by another tool since, so neither indexed nor counted
+        session = self.Session()
+        session.add(Record(None, self.pdns.domains.testing_a.id, 'foreign.test.tld', 'A', '192.168.133.80'))
+        session.commit()
+
+        desired = [DesiredRecord('A', name, content, None) for name, content in session.query(
+            Record.name, Record.content).filter(Record.type == 'A', Record.name != 'foreign.test.tld')]
+        InventorySync(self.powerglove, desired, logger=self.log).apply()
+
+        self.assertRecordDoesNotExist(name='foreign.test.tld')
+        self.assertEqual(dict((usage.subnet, usage.used) for usage in session.query(SubnetUsage) if usage.used),
+                         collections.Counter(ip >> 8 for ip, in session.query(RecordIpIndex.ip)))
+
+    def test_removals_forget_expiries(self):
+
+        self.powerglove.add_a_record('tmp.test.tld', ('192.168.132.0/24',), expires='1h')
+        desired = [DesiredRecord(record.type, record.name, record.content, None)
+                   for record in self.Session().query(Record).filter(Record.type.in_(('A', 'CNAME', 'TXT')),
+                                                                     Record.name != 'tmp.test.tld')]
+        InventorySync(self.powerglove, desired, logger=self.log).apply()
+
+        self.assertRecordDoesNotExist(name='tmp.test.tld')
+        self.assertEqual(self.Session().query(RecordExpiry).count(), 0)
+
+    def test_cross_zone_aliases(self):
+
+        desired = [DesiredRecord('A', 'test_existing.stable.tld', '192.168.134.2', None),
+                   DesiredRecord('A', 'test_existing2.stable.tld', '192.168.135.2', None),
+                   DesiredRecord('CNAME', 'www.stable.tld', 'text.test.tld', None)]
+        sync = InventorySync(self.powerglove, desired, logger=self.log)
+        # the target's zone isn't synced, so none of its records are removed
+        self.assertEqual([(change.action, change.type, change.name, change.content) for change in sync.plan()],
+                         [('add', 'CNAME', 'www.stable.tld', 'text.test.tld')])
+        sync.apply()
+
+        self.assertRecordExists(type='CNAME', name='www.stable.tld', content='text.test.tld',
+                                domain_id=self.pdns.domains.testing_a.id)
+        for record in self.pdns.records:
+            self.assertRecordExists(id=record.id)
+        # the alias is found in its target's domain
+        self.assertEqual(InventorySync(self.powerglove, desired, logger=self.log).plan(), [])
+        # and removed once the inventory drops it, leaving the target's domain alone
+        self.assertEqual([(change.action, change.name) for change in
+                          InventorySync(self.powerglove, desired[:2], logger=self.log).plan()],
+                         [('remove', 'www.stable.tld')])
+
+        # targets must exist, and not be removed by the sync
+        for target in ('missing.test.tld', 'test_existing2.stable.tld'):
+            with self.assertRaises(PowergloveError):
+                InventorySync(self.powerglove, desired[:1] + [DesiredRecord('CNAME', 'www.stable.tld', target, None)],
+                              logger=self.log).plan()
+
+    def test_invalid_inventories(self):
+
+        for desired in ([DesiredRecord('MX', 'mail.test.tld', 'mx.test.tld', None)],
+                        [DesiredRecord('A', 'bad.test.tld', '192.168.132', None)],
+                        [DesiredRecord('A', 'host.unknowntld', '192.168.132.5', None)],
+                        [DesiredRecord('A', 'both.test.tld', '192.168.132.5', None),
+                         DesiredRecord('CNAME', 'both.test.tld', 'cnamee.test.tld', None)]):
+            with self.assertRaises(PowergloveError):
+                InventorySync(self.powerglove, desired, logger=self.log)
+
+        with open(self.inventory_file.name, 'w') as inventory_file:
+            inventory_file.write('A,short.test.tld\n')
+        with self.assertRaises(PowergloveError):
+            load_inventory(self.inventory_file.name)